@@ -0,0 +1,378 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Create many maps in parallel, reading the results only once.
+
+The maps to create are given in a json file as a list of jobs. Each job
+names a script and gives the arguments for it, either directly in
+``args`` or as a ``matrix`` where a map is created for every
+combination of the given values. The value ``"alle"`` in a matrix is
+replaced by all values found in the results. Example::
+
+    [
+        {
+            "script": "kart_parti_i_kommune",
+            "matrix": {"party": ["Høyre", "Rødt"], "kommune_id": "alle"}
+        },
+        {
+            "script": "kart_resultat_kommuner_i_fylke",
+            "args": {"fylker": ["50"]}
+        }
+    ]
+
+The results are parsed once and a copy is sent (pickled) to each of a
+pool of worker processes when it starts, together with the options for
+reading data (which the workers do not inherit when they are spawned).
+With ``--site``, each job writes its site to its own subdirectory. A
+summary with the timing for each job (and the errors for failed jobs)
+is written when all jobs are done::
+
+    python batch.py 2019-09-14_partifordeling_4_ko_2019.csv jobs.json
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+import importlib
+import io
+import itertools
+import json
+import os
+import time
+import traceback
+from hierarchy import load_hierarchy
+from map_basics import (
+    CSV_CACHE,
+    CSV_READING,
+    GEOJSON_CACHE,
+    GEOJSON_LOADING,
+    add_cache_arguments,
+    add_map_arguments,
+    check_choropleth_settings,
+    get_map_settings,
+    read_csv_results,
+    set_cache_options,
+)
+from profiling import profile_run
+
+
+SCRIPTS = (
+    'kart_parti_i_kommune',
+    'kart_resultat_kommuner_i_fylke',
+    'kart_resultat_parti_i_kommuner',
+    'kart_resultat_parti_i_valgkretser',
+    'kart_resultat_valgkretser_i_kommune',
+)
+
+
+# Columns to use when a matrix asks for all values of an argument:
+ALL_VALUES = {
+    'party': 'Partinavn',
+    'parties': 'Partinavn',
+    'kommune_id': 'Kommunenummer',
+    'kommuner': 'Kommunenummer',
+    'fylker': 'Fylkenummer',
+}
+
+
+# Arguments which take a list of values:
+LIST_ARGUMENTS = ('parties', 'kommuner', 'fylker')
+
+
+# Scripts making choropleth maps, see
+# :py:func:`map_basics.check_choropleth_settings`:
+CHOROPLETH_SCRIPTS = ('kart_parti_i_kommune',)
+
+
+# Scripts which take the names of the areas from the index (see
+# :py:mod:`hierarchy`):
+INDEXED_SCRIPTS = (
+    'kart_parti_i_kommune',
+    'kart_resultat_kommuner_i_fylke',
+    'kart_resultat_valgkretser_i_kommune',
+)
+
+
+RESULTS = {}
+
+
+# The module-global options which are passed on to the workers:
+WORKER_OPTIONS = {
+    'geojson_cache': GEOJSON_CACHE,
+    'geojson_loading': GEOJSON_LOADING,
+    'csv_cache': CSV_CACHE,
+    'csv_reading': CSV_READING,
+}
+
+
+def expand_jobs(job_specs, results):
+    """Expand the job specifications into single jobs.
+
+    Parameters
+    ----------
+    job_specs : list of dicts
+        The job specifications, see the module docstring.
+    results : object like pandas.DataFrame
+        The results, used for finding all values for an argument.
+
+    Returns
+    -------
+    jobs : list of dicts
+        The jobs, each with a ``script`` and the ``args`` to use.
+
+    """
+    jobs = []
+    for spec in job_specs:
+        if spec['script'] not in SCRIPTS:
+            raise ValueError('Unknown script "{}"'.format(spec['script']))
+        matrix = spec.get('matrix', {})
+        keys = list(matrix)
+        values = []
+        for key in keys:
+            val = matrix[key]
+            if val == 'alle':
+                val = sorted(results[ALL_VALUES[key]].unique().tolist())
+            if key in LIST_ARGUMENTS:
+                val = [i if isinstance(i, list) else [i] for i in val]
+            values.append(val)
+        for combination in itertools.product(*values):
+            args = dict(spec.get('args', {}))
+            args.update(zip(keys, combination))
+            jobs.append(
+                {
+                    'script': spec['script'],
+                    'args': args,
+                    'settings': spec.get('settings', {}),
+                }
+            )
+    return jobs
+
+
+def _worker_options():
+    """Return a copy of the options to pass on to the workers."""
+    return {key: dict(val) for key, val in WORKER_OPTIONS.items()}
+
+
+def _init_worker(results, options, hierarchy=None):
+    """Store the results and set the options in the worker process."""
+    RESULTS['results'] = results
+    RESULTS['hierarchy'] = hierarchy
+    for key, val in options.items():
+        WORKER_OPTIONS[key].update(val)
+
+
+def _job_site(site, index, job):
+    """Return the site settings for a job, with its own directory."""
+    site = dict(site)
+    site['directory'] = os.path.join(
+        site['directory'], '{}-{}'.format(index, job['script'])
+    )
+    return site
+
+
+def _job_settings(job, settings, index):
+    """Return the settings for a job."""
+    job_settings = dict(settings)
+    job_settings.update(job['settings'])
+    if job_settings.get('site'):
+        job_settings['site'] = _job_site(job_settings['site'], index, job)
+    return job_settings
+
+
+def check_jobs(jobs, settings):
+    """Check that the settings can be used for each job.
+
+    Raises
+    ------
+    SystemExit
+        If a job can not use its settings, before any job is run.
+
+    """
+    for index, job in enumerate(jobs):
+        if job['script'] not in CHOROPLETH_SCRIPTS:
+            continue
+        try:
+            check_choropleth_settings(_job_settings(job, settings, index))
+        except ValueError as error:
+            raise SystemExit(
+                'Job {} ({} {}): {}'.format(
+                    index, job['script'], job['args'], error
+                )
+            )
+
+
+def run_job(job, settings, index=0):
+    """Create the map for a single job.
+
+    Parameters
+    ----------
+    job : dict
+        The job to run.
+    settings : dict
+        Settings for the map, the settings given in the job
+        take precedence.
+    index : integer, optional
+        The number of the job. With a site, it is written to a
+        subdirectory named by the number and the script.
+
+    Returns
+    -------
+    summary : dict
+        The job, the output file, the time used, and the error
+        (if any).
+
+    """
+    start = time.perf_counter()
+    log = io.StringIO()
+    summary = {'job': job, 'output': None, 'error': None}
+    job_settings = _job_settings(job, settings, index)
+    kwargs = dict(job['args'])
+    if job['script'] in INDEXED_SCRIPTS:
+        kwargs['hierarchy'] = RESULTS.get('hierarchy')
+    try:
+        module = importlib.import_module(job['script'])
+        with contextlib.redirect_stdout(log):
+            summary['output'] = module.make_map(
+                RESULTS['results'], settings=job_settings, **kwargs
+            )
+    except Exception:  # pylint: disable=broad-except
+        summary['error'] = traceback.format_exc()
+        summary['log'] = log.getvalue()
+    summary['seconds'] = time.perf_counter() - start
+    summary['pid'] = os.getpid()
+    return summary
+
+
+def run_jobs(results, jobs, settings, workers=None, hierarchy=None):
+    """Run jobs in a pool of worker processes.
+
+    Parameters
+    ----------
+    results : object like pandas.DataFrame
+        The results. Each worker gets its own copy.
+    jobs : list of dicts
+        The jobs to run.
+    settings : dict
+        Settings for the maps.
+    workers : integer, optional
+        The number of worker processes to use.
+    hierarchy : object like :py:class:`hierarchy.Hierarchy`, optional
+        The index of the areas in the results.
+
+    Returns
+    -------
+    summaries : list of dicts
+        The summary for each job, in the order they were given.
+
+    """
+    summaries = [None for _ in jobs]
+    initargs = (results, _worker_options(), hierarchy)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=initargs) as executor:
+        futures = {
+            executor.submit(run_job, job, settings, index=i): i
+            for i, job in enumerate(jobs)
+        }
+        for future in as_completed(futures):
+            summary = future.result()
+            summaries[futures[future]] = summary
+            status = 'failed' if summary['error'] else 'done'
+            print(
+                '{} ({:.2f} s): {} {}'.format(
+                    status,
+                    summary['seconds'],
+                    summary['job']['script'],
+                    summary['job']['args'],
+                )
+            )
+    return summaries
+
+
+def main(raw_data, job_file, settings=None, workers=None,
+         summary_file='batch-summary.json'):
+    """Read the results once and create all the maps."""
+    start = time.perf_counter()
+    results = read_csv_results(raw_data)
+    with open(job_file, 'r') as infile:
+        jobs = expand_jobs(json.load(infile), results)
+    check_jobs(jobs, settings or {})
+    hierarchy = load_hierarchy(raw_data, results=results)
+    print('Running {} jobs'.format(len(jobs)))
+    summaries = run_jobs(
+        results, jobs, settings or {}, workers=workers, hierarchy=hierarchy
+    )
+    failed = [i for i in summaries if i['error']]
+    total = time.perf_counter() - start
+    with open(summary_file, 'w') as output:
+        json.dump(
+            {
+                'jobs': summaries,
+                'failed': len(failed),
+                'seconds': total,
+            },
+            output,
+            indent=2,
+        )
+    print(
+        'Done with {} jobs ({} failed) in {:.2f} s, see "{}"'.format(
+            len(summaries), len(failed), total, summary_file
+        )
+    )
+    for summary in failed:
+        print('Failed: {} {}'.format(
+            summary['job']['script'], summary['job']['args']
+        ))
+        print(summary['error'])
+
+
+def add_arguments(parser):
+    """Add the command line arguments for this script."""
+    parser.add_argument(
+        'raw_data',
+        help='The csv file with the election results.',
+    )
+    parser.add_argument(
+        'job_file',
+        help='A json file with the jobs to run.',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='The number of worker processes to use.',
+    )
+    parser.add_argument(
+        '--output-dir',
+        default=None,
+        help='A directory to write the maps to.',
+    )
+    parser.add_argument(
+        '--summary',
+        default='batch-summary.json',
+        help='The file to write the summary to.',
+    )
+    add_cache_arguments(parser)
+    add_map_arguments(parser)
+
+
+def run(args):
+    """Run the jobs from parsed command line arguments."""
+    set_cache_options(args)
+    settings = get_map_settings(args)
+    if settings['site'] and settings['site']['serve']:
+        raise SystemExit('--serve can not be used when running jobs')
+    settings['output_dir'] = args.output_dir
+    with profile_run(args):
+        main(
+            args.raw_data,
+            args.job_file,
+            settings=settings,
+            workers=args.workers,
+            summary_file=args.summary,
+        )
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Create many maps in parallel.'
+    )
+    add_arguments(PARSER)
+    run(PARSER.parse_args())
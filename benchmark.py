@@ -0,0 +1,425 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Time the steps of creating the maps on synthetic data.
+
+Synthetic results and geometries (see :py:mod:`synthetic_data`) are
+created for a few scales, and for each scale the time and the peak
+memory use are measured for reading the results, finding the winners,
+loading the geometries and, for every script, preparing the layers
+(``data``) and creating the full map (``map``). The measurements are
+written to a json file, and can be compared to a previous run to find
+regressions::
+
+    python benchmark.py --output benchmark-ny.json \
+        --compare benchmark-gammel.json
+
+The time reported is the best of ``--repeat`` runs. The memory is the
+peak of the memory allocated while running the step once more with
+:py:mod:`tracemalloc` enabled.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import pathlib
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+import map_basics
+from map_basics import load_json_file, read_csv_results
+from synthetic_data import create_data
+from winners import find_winners
+import kart_parti_i_kommune
+import kart_resultat_kommuner_i_fylke
+import kart_resultat_parti_i_kommuner
+import kart_resultat_parti_i_valgkretser
+import kart_resultat_valgkretser_i_kommune
+
+
+# The number of kommuner and voting areas in each kommune:
+SCALES = {
+    'small': (10, 10),
+    'medium': (50, 30),
+    'large': (200, 60),
+}
+
+
+# The arguments for each script, given the synthetic data:
+SCRIPTS = {
+    kart_parti_i_kommune: lambda info: {
+        'party': info['parties'][1],
+        'kommune_id': info['kommuner'][0],
+    },
+    kart_resultat_kommuner_i_fylke: lambda info: {
+        'fylker': info['fylker'],
+    },
+    kart_resultat_parti_i_kommuner: lambda info: {
+        'parties': info['parties'][:2],
+    },
+    kart_resultat_parti_i_valgkretser: lambda info: {
+        'parties': info['parties'][:2],
+    },
+    kart_resultat_valgkretser_i_kommune: lambda info: {
+        'kommuner': info['kommuner'],
+    },
+}
+
+
+@contextlib.contextmanager
+def working_directory(directory):
+    """Run in the given directory (the scripts use relative paths)."""
+    current = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(current)
+
+
+def _reset():
+    """Forget cached extents and stores, so each run starts cold."""
+    map_basics.GEOMETRY_EXTENTS.clear()
+    map_basics.GEOMETRY_STORES.clear()
+
+
+def measure(function, repeat=3):
+    """Time a function and find the peak memory allocated by it.
+
+    Parameters
+    ----------
+    function : callable
+        The function to measure, called without arguments.
+    repeat : integer, optional
+        The number of times to time the function.
+
+    Returns
+    -------
+    measurement : dict
+        The best and median time (in seconds) and the peak memory
+        allocated (in bytes).
+
+    """
+    timings = []
+    for _ in range(repeat):
+        _reset()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+    _reset()
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'seconds': min(timings),
+        'median': statistics.median(timings),
+        'peak_memory': peak,
+    }
+
+
+def read_stages(info, output):
+    """Return the steps for reading the results and geometries."""
+    result_file = info['results']
+
+    def read(lean=False, cache=False):
+        """Read the results with the given options."""
+        map_basics.CSV_READING['lean'] = lean
+        map_basics.CSV_CACHE['use'] = cache
+        try:
+            return read_csv_results(result_file)
+        finally:
+            map_basics.CSV_READING['lean'] = False
+            map_basics.CSV_CACHE['use'] = True
+
+    def read_cached():
+        """Read the results from the cache."""
+        return read(cache=True)
+
+    def load_geometries():
+        """Load all the voting area geometries."""
+        for path in sorted(pathlib.Path('valgkretser').glob('*.geojson')):
+            load_json_file(path)
+
+    results = read()
+    # Make sure the cache exists, so that only reading it is timed:
+    map_basics.CSV_CACHE['rebuild'] = True
+    try:
+        read_cached()
+    finally:
+        map_basics.CSV_CACHE['rebuild'] = False
+    output.mkdir(parents=True, exist_ok=True)
+    return [
+        ('read_csv', read),
+        ('read_csv_lean', lambda: read(lean=True)),
+        ('read_csv_cached', read_cached),
+        ('find_winners', lambda: find_winners(
+            results,
+            ('Kommunenummer', 'Stemmekretsnummer'),
+            columns=('Stemmekretsnavn', 'Kommunenavn'),
+        )),
+        ('load_geometries', load_geometries),
+    ], results
+
+
+def script_stages(info, results, output):
+    """Return the steps for each script."""
+    stages = []
+    for module, arguments in SCRIPTS.items():
+        args = arguments(info)
+        name = module.__name__
+        stages.append((
+            '{}:data'.format(name),
+            lambda module=module, args=args: module.get_geojson_data(
+                results, *args.values()
+            ),
+        ))
+        stages.append((
+            '{}:map'.format(name),
+            lambda module=module, args=args: module.make_map(
+                results, settings={'output_dir': str(output)}, **args
+            ),
+        ))
+    return stages
+
+
+def prepare_data(scale, kommuner, kretser, parties, data_dir):
+    """Create (or reuse) the synthetic data for a scale."""
+    directory = pathlib.Path(data_dir).joinpath(scale)
+    info_file = directory.joinpath('info.json')
+    settings = {'kommuner': kommuner, 'kretser': kretser, 'parties': parties}
+    if info_file.is_file():
+        with open(info_file, 'r') as infile:
+            info = json.load(infile)
+        if info['settings'] == settings:
+            return directory, info
+    print('Creating data for "{}" ({} kommuner x {} kretser)'.format(
+        scale, kommuner, kretser
+    ))
+    info = create_data(directory, nkommune=kommuner, nkrets=kretser,
+                       nparty=parties)
+    info['results'] = pathlib.Path(info['results']).name
+    info['settings'] = settings
+    with open(info_file, 'w') as output:
+        json.dump(info, output)
+    return directory, info
+
+
+def run_benchmarks(scales, data_dir, repeat=3, parties=12, only=None):
+    """Run the benchmarks for the given scales.
+
+    Parameters
+    ----------
+    scales : dict
+        The number of kommuner and voting areas for each scale.
+    data_dir : string
+        The directory to store the synthetic data in.
+    repeat : integer, optional
+        The number of times to time each step.
+    parties : integer, optional
+        The number of parties in the synthetic results.
+    only : list of strings, optional
+        If given, only run steps whose name contain one of these.
+
+    Returns
+    -------
+    measurements : list of dicts
+        The measurement for each scale and step.
+
+    """
+    measurements = []
+    for scale, (kommuner, kretser) in scales.items():
+        directory, info = prepare_data(
+            scale, kommuner, kretser, parties, data_dir
+        )
+        with working_directory(directory):
+            output = pathlib.Path('kart')
+            with contextlib.redirect_stdout(io.StringIO()):
+                stages, results = read_stages(info, output)
+            stages += script_stages(info, results, output)
+            for stage, function in stages:
+                if only and not any(i in stage for i in only):
+                    continue
+                measurement = measure(function, repeat=repeat)
+                measurement.update(
+                    {
+                        'scale': scale,
+                        'stage': stage,
+                        'kommuner': kommuner,
+                        'kretser': kretser,
+                        'rows': len(results),
+                    }
+                )
+                measurements.append(measurement)
+                print('{:8s} {:48s} {:9.4f} s {:9.1f} MB'.format(
+                    scale, stage, measurement['seconds'],
+                    measurement['peak_memory'] / 1e6,
+                ))
+    return measurements
+
+
+def _key(measurement):
+    """Identify a measurement when comparing runs."""
+    return measurement['scale'], measurement['stage']
+
+
+def compare(old, new, threshold=1.2):
+    """Compare measurements to a previous run.
+
+    Parameters
+    ----------
+    old : list of dicts
+        The measurements from the previous run.
+    new : list of dicts
+        The new measurements.
+    threshold : float, optional
+        A step is reported as a regression if its time or peak memory
+        has grown by more than this factor.
+
+    Returns
+    -------
+    regressions : list of tuples
+        The scale and step for the regressions.
+
+    """
+    previous = {_key(i): i for i in old}
+    regressions = []
+    print('{:8s} {:48s} {:>8s} {:>8s}'.format('', '', 'time', 'memory'))
+    for measurement in new:
+        key = _key(measurement)
+        if key not in previous:
+            continue
+        ratio_time = measurement['seconds'] / max(
+            previous[key]['seconds'], 1e-9
+        )
+        ratio_memory = measurement['peak_memory'] / max(
+            previous[key]['peak_memory'], 1
+        )
+        slower = ratio_time > threshold or ratio_memory > threshold
+        if slower:
+            regressions.append(key)
+        print('{:8s} {:48s} {:7.2f}x {:7.2f}x{}'.format(
+            key[0], key[1], ratio_time, ratio_memory,
+            ' <- regression' if slower else '',
+        ))
+    return regressions
+
+
+def parse_scales(scales):
+    """Get the scales from names or ``name=KOMMUNERxKRETSER``."""
+    parsed = {}
+    for scale in scales:
+        if scale in SCALES:
+            parsed[scale] = SCALES[scale]
+            continue
+        try:
+            name, size = scale.split('=')
+            kommuner, kretser = (int(i) for i in size.lower().split('x'))
+        except ValueError:
+            raise ValueError(
+                'Unknown scale "{}", use one of {} or '
+                'name=KOMMUNERxKRETSER'.format(scale, ', '.join(SCALES))
+            )
+        parsed[name] = (kommuner, kretser)
+    return parsed
+
+
+def main(args):
+    """Run the benchmarks and store (and compare) the measurements."""
+    scales = parse_scales(args.scales)
+    with contextlib.ExitStack() as stack:
+        data_dir = args.data_dir or stack.enter_context(
+            tempfile.TemporaryDirectory()
+        )
+        measurements = run_benchmarks(
+            scales,
+            pathlib.Path(data_dir).resolve(),
+            repeat=args.repeat,
+            parties=args.parties,
+            only=args.only,
+        )
+    with open(args.output, 'w') as output:
+        json.dump(
+            {
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'pandas': pd.__version__,
+                'machine': platform.platform(),
+                'repeat': args.repeat,
+                'measurements': measurements,
+            },
+            output,
+            indent=2,
+        )
+    print('Wrote measurements to "{}"'.format(args.output))
+    if args.compare:
+        with open(args.compare, 'r') as infile:
+            old = json.load(infile)['measurements']
+        regressions = compare(old, measurements, threshold=args.threshold)
+        if regressions:
+            print('Found {} regression(s)'.format(len(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Time the steps of creating the maps.'
+    )
+    PARSER.add_argument(
+        '--scales',
+        nargs='+',
+        default=['small', 'medium'],
+        help=(
+            'The scales to run, one of {} or name=KOMMUNERxKRETSER.'.format(
+                ', '.join(SCALES)
+            )
+        ),
+    )
+    PARSER.add_argument(
+        '--parties',
+        type=int,
+        default=12,
+        help='The number of parties in the synthetic results.',
+    )
+    PARSER.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='The number of times to time each step.',
+    )
+    PARSER.add_argument(
+        '--only',
+        nargs='+',
+        default=None,
+        help='Only run the steps whose name contain one of these.',
+    )
+    PARSER.add_argument(
+        '--data-dir',
+        default=None,
+        help='Keep the synthetic data in this directory and reuse it.',
+    )
+    PARSER.add_argument(
+        '--output',
+        default='benchmark.json',
+        help='The file to write the measurements to.',
+    )
+    PARSER.add_argument(
+        '--compare',
+        default=None,
+        help='Compare to the measurements in this file.',
+    )
+    PARSER.add_argument(
+        '--threshold',
+        type=float,
+        default=1.2,
+        help='The growth in time or memory reported as a regression.',
+    )
+    main(PARSER.parse_args())
@@ -0,0 +1,201 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Divide the values for a choropleth map into classes.
+
+All values are classified at once with numpy: the class limits are
+found with one of the ``SCHEMES`` and the class of each value is found
+with a single search in the sorted limits. The color map is sampled
+once for each class, so that the features can be styled by looking up
+their class in a short list of colors, instead of calling the color
+map for every feature.
+
+The schemes are:
+
+* ``equal``: Classes of equal width between the smallest and the
+  largest value.
+* ``quantile``: Classes with (about) the same number of values.
+* ``jenks``: Fisher-Jenks natural breaks, which minimize the sum of
+  squared deviations from the class means.
+"""
+import branca.colormap as cm
+import numpy as np
+
+
+SCHEMES = ('equal', 'quantile', 'jenks')
+# The most distinct values used for finding natural breaks. More
+# values than this are replaced by evenly spaced quantiles:
+JENKS_MAX_VALUES = 1000
+
+
+def equal_interval_breaks(values, classes, center=None):
+    """Find the limits for classes of equal width.
+
+    Parameters
+    ----------
+    values : object like numpy.ndarray
+        The values to classify.
+    classes : integer
+        The number of classes.
+    center : float, optional
+        If given, the range is made symmetric around this value.
+
+    Returns
+    -------
+    breaks : object like numpy.ndarray
+        The ``classes + 1`` limits, from the smallest to the largest
+        value.
+
+    """
+    vmin, vmax = values.min(), values.max()
+    if center is not None:
+        width = max(abs(vmin - center), abs(vmax - center))
+        vmin, vmax = center - width, center + width
+    return np.linspace(vmin, vmax, classes + 1)
+
+
+def quantile_breaks(values, classes, center=None):
+    """Find the limits for classes with the same number of values."""
+    return np.quantile(values, np.linspace(0.0, 1.0, classes + 1))
+
+
+def fisher_jenks_breaks(values, classes, center=None):
+    """Find the limits for classes by Fisher-Jenks natural breaks.
+
+    The distinct values are sorted, and the optimal classes are found
+    by dynamic programming, where the sum of squared deviations for
+    all candidate classes ending at a value is computed at once from
+    cumulative sums.
+
+    Parameters
+    ----------
+    values : object like numpy.ndarray
+        The values to classify.
+    classes : integer
+        The number of classes.
+    center : float, optional
+        Not used, the limits only depend on the values.
+
+    Returns
+    -------
+    breaks : object like numpy.ndarray
+        The ``classes + 1`` limits, from the smallest to the largest
+        value.
+
+    """
+    unique, counts = np.unique(values, return_counts=True)
+    if len(unique) > JENKS_MAX_VALUES:
+        unique = np.quantile(values, np.linspace(0, 1, JENKS_MAX_VALUES))
+        counts = np.ones_like(unique)
+    counts = counts.astype(np.float64)
+    npoint = len(unique)
+    if npoint <= classes:
+        return np.concatenate(([unique[0]], unique))
+    # Cumulative sums for the weight, sum and sum of squares:
+    weight = np.concatenate(([0.0], np.cumsum(counts)))
+    total = np.concatenate(([0.0], np.cumsum(counts * unique)))
+    square = np.concatenate(([0.0], np.cumsum(counts * unique**2)))
+    # The sum of squared deviations for a class holding the values
+    # first..last, for all pairs (first, last) at once:
+    first = np.arange(npoint)[:, None]
+    last = np.arange(npoint)[None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sums = total[last + 1] - total[first]
+        deviation = (
+            square[last + 1] - square[first] -
+            sums**2 / (weight[last + 1] - weight[first])
+        )
+    deviation[first > last] = np.inf
+    # cost[j] is the best sum for the values up to (and including) j
+    # and start[c, j] is the first value of the last class of c + 1
+    # classes ending at j:
+    start = np.zeros((classes, npoint), dtype=np.int64)
+    cost = deviation[0]
+    previous = np.concatenate(([np.inf], np.zeros(npoint - 1)))
+    for klass in range(1, classes):
+        # A class starting at 0 leaves no values for the others:
+        previous[1:] = cost[:-1]
+        candidates = previous[:, None] + deviation
+        start[klass] = np.argmin(candidates, axis=0)
+        cost = candidates[start[klass], np.arange(npoint)]
+    breaks = [unique[-1]]
+    end = npoint - 1
+    for klass in range(classes - 1, 0, -1):
+        begin = start[klass, end]
+        breaks.append(unique[begin - 1])
+        end = begin - 1
+    breaks.append(unique[0])
+    return np.array(breaks[::-1])
+
+
+BREAKS = {
+    'equal': equal_interval_breaks,
+    'quantile': quantile_breaks,
+    'jenks': fisher_jenks_breaks,
+}
+
+
+def classify(values, scheme='quantile', classes=5, center=None):
+    """Find the classes for some values.
+
+    Parameters
+    ----------
+    values : iterable of floats
+        The values to classify.
+    scheme : string, optional
+        The way to find the class limits, one of ``SCHEMES``.
+    classes : integer, optional
+        The number of classes.
+    center : float, optional
+        For the ``equal`` scheme, the classes are made symmetric
+        around this value.
+
+    Returns
+    -------
+    breaks : object like numpy.ndarray
+        The limits of the classes. Class ``i`` holds the values
+        larger than ``breaks[i]`` and up to ``breaks[i + 1]`` (the
+        first class also holds ``breaks[0]``).
+    index : object like numpy.ndarray
+        The class of each value.
+
+    """
+    if scheme not in BREAKS:
+        raise ValueError('Unknown classification scheme "{}"'.format(scheme))
+    if classes < 1:
+        raise ValueError('The number of classes must be positive')
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+        return np.zeros(classes + 1), np.zeros(0, dtype=np.int64)
+    breaks = BREAKS[scheme](values, classes, center=center)
+    index = np.searchsorted(breaks[1:-1], values, side='left')
+    return breaks, index.astype(np.int64)
+
+
+def class_colors(color_map, breaks):
+    """Sample a color map once for each class.
+
+    Parameters
+    ----------
+    color_map : object like branca.colormap.LinearColormap
+        The color map to sample.
+    breaks : object like numpy.ndarray
+        The limits of the classes, see :py:func:`classify`.
+
+    Returns
+    -------
+    colors : list of strings
+        The color for each class, taken at its middle.
+
+    """
+    middle = 0.5 * (breaks[:-1] + breaks[1:])
+    return [color_map.rgb_hex_str(i) for i in middle]
+
+
+def step_color_map(colors, breaks):
+    """Create a color map with one step for each class (for legends)."""
+    return cm.StepColormap(
+        colors,
+        index=list(breaks),
+        vmin=float(breaks[0]),
+        vmax=float(breaks[-1]),
+    )
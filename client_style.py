@@ -0,0 +1,247 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Style map layers in the browser with a shared lookup table.
+
+With a folium style function, the style for every feature is calculated
+in Python and written to the html file. Here, each feature only carries
+a class (for instance the name of the winning party, or an index into a
+list of colors) as a property. The colors for the classes are embedded
+once (by :py:class:`ClassStyle`), and a single JavaScript function
+styles all features of the layers referring to it.
+"""
+import folium
+from branca.element import MacroElement
+from jinja2 import Template
+import numpy as np
+
+
+class ClassStyle(MacroElement):
+    """Embed a lookup table and functions for styling features.
+
+    Attributes
+    ----------
+    key : string
+        The feature property holding the class.
+    colors : dict or list
+        The fill color for each class. If a list is given, the
+        classes are indices into the list.
+    default_color : string
+        The fill color for features with an unknown class.
+    style : dict
+        Other style settings for all features.
+    highlight : dict
+        The style to use when highlighting a feature.
+
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function() {
+                var colors = {{ this.colors|tojson }};
+                var key = {{ this.key|tojson }};
+                var fallback = {{ this.default_color|tojson }};
+                var base = {{ this.style|tojson }};
+                var highlight = {{ this.highlight|tojson }};
+                function style(feature) {
+                    var value = feature.properties[key];
+                    var result = Object.assign({}, base);
+                    result.fillColor =
+                        Object.prototype.hasOwnProperty.call(colors, value) ?
+                        colors[value] : fallback;
+                    return result;
+                }
+                function onEachFeature(layer) {
+                    return function(feature, item) {
+                        item.on({
+                            mouseover: function(e) {
+                                e.target.setStyle(highlight);
+                            },
+                            mouseout: function(e) {
+                                layer.resetStyle(e.target);
+                            },
+                        });
+                    };
+                }
+                return {style: style, onEachFeature: onEachFeature};
+            })();
+        {% endmacro %}
+        """)
+
+    def __init__(self, key, colors, style, highlight,
+                 default_color='#262626'):
+        """Set up the lookup table.
+
+        Parameters
+        ----------
+        key : string
+            The feature property holding the class.
+        colors : dict or list
+            The fill color for each class.
+        style : dict
+            Other style settings (e.g. the opacity) for all features.
+        highlight : dict
+            The style to use when highlighting a feature.
+        default_color : string, optional
+            The fill color for features with an unknown class.
+
+        """
+        super().__init__()
+        self._name = 'ClassStyle'
+        self.key = key
+        self.colors = colors
+        self.style = style
+        self.highlight = highlight
+        self.default_color = default_color
+
+
+_LAYER_SCRIPT = """
+            var {{ this.get_name() }} = L.geoJson(null, {
+                style: {{ this.class_style.get_name() }}.style,
+            });
+            {{ this.get_name() }}.options.onEachFeature =
+                {{ this.class_style.get_name() }}.onEachFeature(
+                    {{ this.get_name() }}
+                );
+            {{ this.get_name() }}.addData({{ data }});
+            {{ this.get_name() }}.addTo({{ this._parent.get_name() }});
+"""
+
+
+class ClassStyledGeoJson(folium.GeoJson):
+    """A geojson layer styled by a :py:class:`ClassStyle`."""
+
+    _template = Template(
+        '{% macro script(this, kwargs) %}'
+        '{% set data = this.data|tojson %}' + _LAYER_SCRIPT +
+        '{% endmacro %}'
+    )
+
+    def __init__(self, data, class_style, name=None, tooltip=None):
+        """Set up the layer.
+
+        Parameters
+        ----------
+        data : dict
+            The geojson data for the layer.
+        class_style : object like ClassStyle
+            The lookup table to style the layer with.
+        name : string, optional
+            The name of the layer.
+        tooltip : object like folium.features.GeoJsonTooltip, optional
+            A tooltip to add to the layer.
+
+        """
+        super().__init__(data, name=name, tooltip=tooltip)
+        self._name = 'ClassStyledGeoJson'
+        self.class_style = class_style
+
+
+class ClassStyledTopoJson(folium.TopoJson):
+    """A layer from an embedded topology styled by a ClassStyle."""
+
+    _template = Template(
+        '{% macro script(this, kwargs) %}'
+        '{% set topology = this.topology.get_name() %}'
+        '{% set data = "topojson.feature(" ~ topology ~ ", " ~ topology ~ '
+        '".objects[" ~ (this.object_name|tojson) ~ "])" %}' +
+        _LAYER_SCRIPT +
+        '{% endmacro %}'
+    )
+
+    def __init__(self, topology, object_name, class_style, name=None,
+                 tooltip=None):
+        """Set up the layer.
+
+        Parameters
+        ----------
+        topology : object like topojson_layer.TopologyData
+            The embedded topology.
+        object_name : string
+            The object in the topology to show in this layer.
+        class_style : object like ClassStyle
+            The lookup table to style the layer with.
+        name : string, optional
+            The name of the layer.
+        tooltip : object like folium.features.GeoJsonTooltip, optional
+            A tooltip to add to the layer.
+
+        """
+        super().__init__(
+            topology.data,
+            'objects.{}'.format(object_name),
+            name=name,
+            tooltip=tooltip,
+        )
+        self._name = 'ClassStyledTopoJson'
+        self.topology = topology
+        self.object_name = object_name
+        self.class_style = class_style
+
+    def style_data(self):
+        """Do nothing, the styles are set in the browser."""
+
+
+def color_lookup_table(color_map, index, ncolor=256):
+    """Sample a color map for the classes in use.
+
+    Parameters
+    ----------
+    color_map : object like branca.colormap.LinearColormap
+        The color map to sample.
+    index : iterable of integers
+        The classes (as found by :py:func:`color_index`) in use.
+    ncolor : integer, optional
+        The number of classes the color map is divided into.
+
+    Returns
+    -------
+    colors : dict
+        The color for each class in use.
+
+    """
+    samples = np.linspace(color_map.vmin, color_map.vmax, ncolor)
+    return {int(i): color_map(samples[i]) for i in sorted(set(index))}
+
+
+def color_index(values, vmin, vmax, ncolor=256):
+    """Find the index in a color lookup table for some values."""
+    values = np.asarray(values, dtype=np.float64)
+    if vmax <= vmin:
+        return np.zeros(len(values), dtype=np.int64)
+    index = np.rint((values - vmin) / (vmax - vmin) * (ncolor - 1))
+    return np.clip(index, 0, ncolor - 1).astype(np.int64)
+
+
+def add_class_property(geojson_layer, key, classes, class_key='klasse'):
+    """Return a copy of a layer where each feature has a class.
+
+    Parameters
+    ----------
+    geojson_layer : dict
+        The geojson layer.
+    key : string
+        The feature property used to look up the class.
+    classes : dict
+        The class for each known value of the ``key`` property.
+        Features with other values get no class.
+    class_key : string, optional
+        The feature property to store the class in.
+
+    Returns
+    -------
+    geojson_layer : dict
+        A copy of the layer, with the class added to the properties.
+
+    """
+    new_layer = {
+        prop: val for prop, val in geojson_layer.items() if prop != 'features'
+    }
+    new_layer['features'] = []
+    for feature in geojson_layer['features']:
+        new_feature = dict(feature)
+        new_feature['properties'] = dict(feature.get('properties') or {})
+        feature_key = new_feature['properties'].get(key)
+        if feature_key in classes:
+            new_feature['properties'][class_key] = classes[feature_key]
+        new_layer['features'].append(new_feature)
+    return new_layer
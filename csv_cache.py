@@ -0,0 +1,249 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Cache parsed result files as typed, columnar sidecar files.
+
+The cache is stored next to the csv file as a numpy ``.npz`` archive
+with one array per column. It is keyed by the path, size, modification
+time and a sha256 hash of the csv file, so that it is rebuilt whenever
+the csv file changes.
+"""
+import hashlib
+import json
+import pathlib
+import numpy as np
+import pandas as pd
+
+
+CACHE_SUFFIX = '.cache.npz'
+CACHE_VERSION = 2
+
+
+def get_cache_file(result_file, variant=None):
+    """Return the path to the cache file for a result file.
+
+    Parameters
+    ----------
+    result_file : string or object like pathlib.Path
+        The csv file to get the cache file for.
+    variant : string, optional
+        If given, the cache is for results read in a different way
+        (e.g. only some of the columns), and it is stored separately.
+
+    Returns
+    -------
+    cache_file : object like pathlib.Path
+        The path to the cache file.
+
+    """
+    result_file = pathlib.Path(result_file)
+    suffix = CACHE_SUFFIX if not variant else '.{}{}'.format(
+        variant, CACHE_SUFFIX
+    )
+    return result_file.with_name(result_file.name + suffix)
+
+
+def hash_file(filename, block_size=1 << 20):
+    """Calculate the sha256 hash of a file."""
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_signature(result_file, with_hash=True):
+    """Get the values used for checking if a cache is stale.
+
+    Parameters
+    ----------
+    result_file : string or object like pathlib.Path
+        The csv file to get the signature for.
+    with_hash : boolean, optional
+        If True, the sha256 hash of the file is also calculated.
+
+    Returns
+    -------
+    signature : dict
+        The path, size, modification time and (optionally) the
+        hash of the file.
+
+    """
+    result_file = pathlib.Path(result_file)
+    stat = result_file.stat()
+    signature = {
+        'path': str(result_file.resolve()),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+    if with_hash:
+        signature['sha256'] = hash_file(result_file)
+    return signature
+
+
+def _encode_column(series):
+    """Convert a column to arrays which can be stored without pickle."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = series.cat.categories
+        arrays = {
+            'codes': series.cat.codes.to_numpy(),
+            'categories': categories.to_numpy().astype(str),
+        }
+        return 'category', arrays
+    if pd.api.types.is_bool_dtype(series.dtype) or (
+            pd.api.types.is_numeric_dtype(series.dtype)
+    ):
+        return 'numeric', {'values': series.to_numpy()}
+    # Names and ids are repeated for every party in every krets, so
+    # each distinct string is stored once (missing values get code -1):
+    codes, categories = pd.factorize(series, use_na_sentinel=True)
+    arrays = {
+        'codes': pd.to_numeric(codes, downcast='integer'),
+        'categories': np.asarray(categories).astype(str),
+    }
+    return 'string', arrays
+
+
+def _decode_column(kind, arrays):
+    """Recreate a column from the stored arrays."""
+    if kind == 'category':
+        return pd.Categorical.from_codes(
+            arrays['codes'], categories=arrays['categories']
+        )
+    if kind == 'numeric':
+        return arrays['values']
+    codes = arrays['codes']
+    values = arrays['categories'].astype(object)[codes]
+    values[codes < 0] = np.nan
+    return values
+
+
+def save_cache(results, result_file, signature=None, variant=None):
+    """Store parsed results in the cache file for a result file.
+
+    If the cache file can not be written (e.g. in a read-only
+    directory or on a full disk), a warning is printed and the
+    results are not cached.
+
+    Parameters
+    ----------
+    results : object like pandas.DataFrame
+        The parsed results to store.
+    result_file : string or object like pathlib.Path
+        The csv file the results were read from.
+    signature : dict, optional
+        The signature of the csv file. It is calculated if not given.
+    variant : string, optional
+        The variant of the cache to store, see
+        :py:func:`get_cache_file`.
+
+    """
+    if signature is None:
+        signature = file_signature(result_file)
+    arrays = {}
+    columns = []
+    for i, column in enumerate(results.columns):
+        kind, column_arrays = _encode_column(results[column])
+        columns.append({'name': column, 'kind': kind})
+        for key, val in column_arrays.items():
+            arrays['{}_{}'.format(i, key)] = val
+    meta = {
+        'version': CACHE_VERSION,
+        'signature': signature,
+        'columns': columns,
+    }
+    arrays['meta'] = np.array(json.dumps(meta))
+    cache_file = get_cache_file(result_file, variant=variant)
+    tmp_file = cache_file.with_name(cache_file.name + '.tmp')
+    try:
+        with open(tmp_file, 'wb') as output:
+            np.savez(output, **arrays)
+        tmp_file.replace(cache_file)
+    except OSError as error:
+        print('Could not write cache "{}": {}'.format(cache_file, error))
+        try:
+            tmp_file.unlink()
+        except OSError:
+            pass
+
+
+def signature_is_fresh(cached, result_file):
+    """Check if a stored signature matches the current result file.
+
+    Parameters
+    ----------
+    cached : dict
+        The stored signature, see :py:func:`file_signature`.
+    result_file : string or object like pathlib.Path
+        The csv file to compare with.
+
+    Returns
+    -------
+    fresh : boolean
+        True if the content of the file is unchanged.
+    signature : dict or None
+        The new signature, if the file was touched but its content is
+        unchanged (so that it can be stored to skip hashing later).
+
+    """
+    current = file_signature(result_file, with_hash=False)
+    if cached['size'] != current['size']:
+        return False, None
+    if cached['mtime_ns'] == current['mtime_ns']:
+        return True, None
+    # The file was touched, check if the content actually changed:
+    current['sha256'] = hash_file(result_file)
+    return cached['sha256'] == current['sha256'], current
+
+
+def _is_fresh(meta, result_file):
+    """Check if a cached signature matches the current result file."""
+    if meta.get('version') != CACHE_VERSION:
+        return False, None
+    return signature_is_fresh(meta['signature'], result_file)
+
+
+def load_cache(result_file, variant=None):
+    """Load cached results for a result file.
+
+    Parameters
+    ----------
+    result_file : string or object like pathlib.Path
+        The csv file we are loading the results for.
+    variant : string, optional
+        The variant of the cache to load, see :py:func:`get_cache_file`.
+
+    Returns
+    -------
+    results : object like pandas.DataFrame or None
+        The cached results. None is returned if no cache exists,
+        or if the cache is stale.
+
+    """
+    cache_file = get_cache_file(result_file, variant=variant)
+    if not cache_file.is_file():
+        return None
+    try:
+        with np.load(cache_file, allow_pickle=False) as archive:
+            meta = json.loads(str(archive['meta']))
+            fresh, signature = _is_fresh(meta, result_file)
+            if not fresh:
+                return None
+            data = {}
+            for i, column in enumerate(meta['columns']):
+                prefix = '{}_'.format(i)
+                arrays = {
+                    key[len(prefix):]: archive[key]
+                    for key in archive.files if key.startswith(prefix)
+                }
+                data[column['name']] = _decode_column(column['kind'], arrays)
+    except (OSError, ValueError, KeyError):
+        print('Ignoring unreadable cache "{}"'.format(cache_file))
+        return None
+    results = pd.DataFrame(data)
+    if signature is not None:
+        # Content is unchanged, but the file was touched. Store the
+        # new modification time so we can skip hashing next time:
+        save_cache(
+            results, result_file, signature=signature, variant=variant
+        )
+    return results
@@ -0,0 +1,633 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Store the results from several elections in one columnar file.
+
+The results are stored in long format, with one row for each year,
+voting area and party, as a numpy ``.npz`` archive with one array per
+column::
+
+    year (int16) | area (int32) | party (int16) | oppslutning | stemmer
+
+The areas (a kommune and a krets within it) and the parties are stored
+once, in tables indexed by the ``area`` and ``party`` codes. Areas with
+the same kommune and krets number in different years share a code, so
+the results for an area can be compared directly across the years.
+
+Numbers which change between elections (for instance when kommuner are
+merged) can be aligned with an area map, a ``;`` separated file with
+the columns ``fra_kommune``, ``fra_krets``, ``til_kommune`` and
+``til_krets`` (and, optionally, ``aar`` to only use a line for one
+year). An empty ``fra_krets`` moves all kretser in the kommune, and an
+empty ``til_krets`` keeps the krets number. When several areas end up
+as one, their votes are added and the oppslutning is recalculated. The
+areas should be aligned to the numbers used by the geometries.
+
+The store is built with::
+
+    python election_store.py build valg.npz 2015=2015.csv 2019=2019.csv
+
+and the change in oppslutning between two years, for all areas and
+parties at once, is found with :py:func:`swing`.
+"""
+import argparse
+import json
+import pathlib
+import numpy as np
+import pandas as pd
+from csv_cache import file_signature
+from profiling import profiled
+from read_results import read_csv_results
+
+
+STORE_VERSION = 1
+# The column with the number of votes for a party in an area:
+VOTES = 'Antall stemmer totalt'
+# The tables describing each area:
+AREA_COLUMNS = (
+    'Fylkenummer',
+    'Fylkenavn',
+    'Kommunenummer',
+    'Kommunenavn',
+    'Stemmekretsnummer',
+    'Stemmekretsnavn',
+)
+AREA_MAP_COLUMNS = ('fra_kommune', 'fra_krets', 'til_kommune', 'til_krets')
+LEVELS = ('krets', 'kommune')
+
+
+class ElectionStore:
+    """Results from several elections, aligned by area and party.
+
+    Attributes
+    ----------
+    years : object like numpy.ndarray
+        The years stored, sorted.
+    areas : object like pandas.DataFrame
+        The number and name of the fylke, kommune and krets for each
+        area code.
+    parties : object like numpy.ndarray
+        The name of each party code.
+    columns : dict of object like numpy.ndarray
+        The columns ``year``, ``area``, ``party``, ``oppslutning``
+        and ``stemmer`` (NaN when the number of votes is not known).
+    sources : list of dicts
+        The year and signature of the files the store was built from.
+
+    """
+
+    def __init__(self, years, areas, parties, columns, sources=None):
+        """Set up the store from its tables and columns."""
+        self.years = np.asarray(years, dtype=np.int16)
+        self.areas = areas.reset_index(drop=True)
+        self.parties = np.asarray(parties, dtype=str)
+        self.columns = columns
+        self.sources = sources or []
+        self._dense = {}
+
+    def __len__(self):
+        """Return the number of rows in the store."""
+        return len(self.columns['year'])
+
+    def year_index(self, year):
+        """Return the position of a year in the store."""
+        matches = np.flatnonzero(self.years == int(year))
+        if len(matches) == 0:
+            raise ValueError(
+                'No results for {} (the store has {})'.format(
+                    year, ', '.join(str(i) for i in self.years)
+                )
+            )
+        return int(matches[0])
+
+    def party_codes(self, parties=None):
+        """Return the codes for the given parties (or for all)."""
+        if parties is None:
+            return np.arange(len(self.parties))
+        codes = []
+        for party in parties:
+            matches = np.flatnonzero(self.parties == party)
+            if len(matches) == 0:
+                raise ValueError('Unknown party "{}"'.format(party))
+            codes.append(matches[0])
+        return np.array(codes, dtype=np.int64)
+
+    def dense(self, column='oppslutning'):
+        """Return a column as an array indexed by year, area and party.
+
+        Parameters
+        ----------
+        column : string, optional
+            The column to return, ``oppslutning`` or ``stemmer``.
+
+        Returns
+        -------
+        values : object like numpy.ndarray
+            The values, with shape (years, areas, parties), and NaN
+            where an area has no result for a year and party.
+
+        """
+        if column not in self._dense:
+            values = np.full(
+                (len(self.years), len(self.areas), len(self.parties)),
+                np.nan,
+            )
+            year = np.searchsorted(self.years, self.columns['year'])
+            values[year, self.columns['area'], self.columns['party']] = (
+                self.columns[column]
+            )
+            self._dense[column] = values
+        return self._dense[column]
+
+    def to_frame(self):
+        """Return the store as a DataFrame with one row per result."""
+        frame = self.areas.iloc[self.columns['area']].reset_index(drop=True)
+        frame.insert(0, 'year', self.columns['year'])
+        frame['Partinavn'] = self.parties[self.columns['party']]
+        frame['oppslutning'] = self.columns['oppslutning']
+        frame['stemmer'] = self.columns['stemmer']
+        return frame
+
+    def is_stale(self):
+        """Check if any of the source files changed after building."""
+        for source in self.sources:
+            path = pathlib.Path(source['signature']['path'])
+            if not path.is_file():
+                continue
+            stat = path.stat()
+            if (stat.st_size, stat.st_mtime_ns) != (
+                    source['signature']['size'],
+                    source['signature']['mtime_ns']):
+                return True
+        return False
+
+    def save(self, filename):
+        """Write the store to a file."""
+        arrays = {
+            'years': self.years,
+            'parties': self.parties,
+        }
+        for column in AREA_COLUMNS:
+            arrays['area_{}'.format(column)] = (
+                self.areas[column].to_numpy().astype(str)
+            )
+        for key, val in self.columns.items():
+            arrays[key] = val
+        meta = {'version': STORE_VERSION, 'sources': self.sources}
+        arrays['meta'] = np.array(json.dumps(meta))
+        filename = pathlib.Path(filename)
+        tmp_file = filename.with_name(filename.name + '.tmp')
+        with open(tmp_file, 'wb') as output:
+            np.savez(output, **arrays)
+        tmp_file.replace(filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a store written by :py:meth:`save`."""
+        with np.load(filename, allow_pickle=False) as archive:
+            meta = json.loads(str(archive['meta']))
+            if meta.get('version') != STORE_VERSION:
+                raise ValueError(
+                    'Unsupported store version in "{}"'.format(filename)
+                )
+            areas = pd.DataFrame({
+                column: archive['area_{}'.format(column)].astype(object)
+                for column in AREA_COLUMNS
+            })
+            columns = {
+                key: archive[key]
+                for key in ('year', 'area', 'party', 'oppslutning', 'stemmer')
+            }
+            return cls(
+                archive['years'], areas, archive['parties'], columns,
+                sources=meta['sources'],
+            )
+
+
+def parse_inputs(inputs):
+    """Parse inputs given as ``YEAR=FILE``.
+
+    Parameters
+    ----------
+    inputs : list of strings
+        The inputs to parse.
+
+    Returns
+    -------
+    out : list of tuples
+        The year and file for each input, sorted by year.
+
+    """
+    out = []
+    for item in inputs:
+        year, sep, filename = item.partition('=')
+        if not sep or not year.strip().isdigit() or not filename:
+            raise ValueError(
+                'Expected YEAR=FILE, got "{}"'.format(item)
+            )
+        out.append((int(year), filename))
+    years = [i[0] for i in out]
+    if len(set(years)) != len(years):
+        raise ValueError('A year is given more than once')
+    return sorted(out)
+
+
+def read_area_map(filename):
+    """Read a file with the area numbers to align.
+
+    Parameters
+    ----------
+    filename : string
+        The file to read, see the module documentation.
+
+    Returns
+    -------
+    area_map : object like pandas.DataFrame
+        The lines in the file, with empty strings for empty numbers
+        and NaN as ``aar`` for lines used for all years.
+
+    """
+    area_map = pd.read_csv(filename, sep=';', dtype=str).fillna('')
+    missing = set(AREA_MAP_COLUMNS) - set(area_map.columns)
+    if missing:
+        raise ValueError('Missing columns in "{}": {}'.format(
+            filename, ', '.join(sorted(missing))
+        ))
+    for column in AREA_MAP_COLUMNS:
+        values = area_map[column].str.strip()
+        area_map[column] = values.where(values == '', values.str.zfill(4))
+    if (area_map['fra_kommune'] == '').any() or (
+            area_map['til_kommune'] == '').any():
+        raise ValueError(
+            'Missing kommune numbers in "{}"'.format(filename)
+        )
+    if 'aar' not in area_map.columns:
+        area_map['aar'] = ''
+    area_map['aar'] = pd.to_numeric(area_map['aar'], errors='coerce')
+    return area_map
+
+
+def align_areas(kommune, krets, year, area_map):
+    """Translate the kommune and krets numbers for one year.
+
+    Parameters
+    ----------
+    kommune : object like pandas.Series
+        The kommune number for each result.
+    krets : object like pandas.Series
+        The krets number for each result.
+    year : integer
+        The year of the results.
+    area_map : object like pandas.DataFrame
+        The numbers to translate, see :py:func:`read_area_map`.
+
+    Returns
+    -------
+    kommune, krets : object like pandas.Series
+        The aligned numbers.
+
+    """
+    lines = area_map[area_map['aar'].isna() | (area_map['aar'] == year)]
+    keys = pd.DataFrame({
+        'fra_kommune': kommune.to_numpy(),
+        'fra_krets': krets.to_numpy(),
+    })
+    columns = ['til_kommune', 'til_krets']
+    # Lines for a single krets are used before lines for a kommune:
+    single = keys.merge(
+        lines.loc[lines['fra_krets'] != '', list(AREA_MAP_COLUMNS)],
+        how='left',
+        on=['fra_kommune', 'fra_krets'],
+        validate='many_to_one',
+    )[columns]
+    whole = keys.merge(
+        lines.loc[lines['fra_krets'] == '', ['fra_kommune'] + columns],
+        how='left',
+        on='fra_kommune',
+        validate='many_to_one',
+    )[columns]
+    found = single['til_kommune'].notna().to_numpy()
+    new_kommune = single['til_kommune'].where(found, whole['til_kommune'])
+    new_kommune = new_kommune.fillna(keys['fra_kommune'])
+    new_krets = single['til_krets'].where(found, whole['til_krets'])
+    new_krets = new_krets.fillna('')
+    new_krets = new_krets.where(new_krets != '', keys['fra_krets'])
+    return new_kommune, new_krets
+
+
+def _read_election(year, result_file, area_map=None):
+    """Read the results for one election into the store columns."""
+    results = read_csv_results(result_file)
+    election = pd.DataFrame({
+        column: results[column].astype(str).str.strip()
+        for column in AREA_COLUMNS
+    })
+    election['Kommunenummer'] = election['Kommunenummer'].str.zfill(4)
+    election['Stemmekretsnummer'] = (
+        election['Stemmekretsnummer'].str.zfill(4)
+    )
+    if area_map is not None:
+        election['Kommunenummer'], election['Stemmekretsnummer'] = (
+            align_areas(
+                election['Kommunenummer'],
+                election['Stemmekretsnummer'],
+                year,
+                area_map,
+            )
+        )
+    election['year'] = year
+    election['Partinavn'] = results['Partinavn'].astype(str).to_numpy()
+    election['oppslutning'] = (
+        results['Oppslutning prosentvis'].to_numpy(dtype=float)
+    )
+    if VOTES in results.columns:
+        election['stemmer'] = results[VOTES].to_numpy(dtype=float)
+    else:
+        election['stemmer'] = np.nan
+    return election
+
+
+def _merge_areas(elections):
+    """Combine results for areas which were aligned into one."""
+    keys = ['year', 'Kommunenummer', 'Stemmekretsnummer', 'Partinavn']
+    grouped = elections.groupby(keys, sort=False)
+    if (grouped['oppslutning'].transform('size') == 1).all():
+        return elections
+    merged = grouped.agg(
+        **{column: (column, 'last') for column in AREA_COLUMNS
+           if column not in keys},
+        oppslutning=('oppslutning', 'mean'),
+        stemmer=('stemmer', lambda x: x.sum(min_count=len(x))),
+        count=('oppslutning', 'size'),
+    ).reset_index()
+    # Recalculate the oppslutning in merged areas from the votes, if
+    # they are known for all parties there:
+    area = merged.groupby(keys[:3])
+    total = area['stemmer'].transform('sum')
+    recalculate = (area['count'].transform('max') > 1) & (
+        area['stemmer'].transform('count') == area['stemmer'].transform(
+            'size'
+        )
+    )
+    merged['oppslutning'] = merged['oppslutning'].where(
+        ~recalculate, 100 * merged['stemmer'] / total
+    )
+    return merged.drop(columns='count')
+
+
+def build_store(inputs, area_map=None):
+    """Read the results for several elections into a store.
+
+    Parameters
+    ----------
+    inputs : list of tuples
+        The year and the csv file with the results for each election.
+    area_map : string, optional
+        A file with area numbers to align, see :py:func:`read_area_map`.
+
+    Returns
+    -------
+    store : object like ElectionStore
+        The store with the results.
+
+    """
+    lines = None if area_map is None else read_area_map(area_map)
+    elections = pd.concat(
+        [
+            _read_election(year, result_file, area_map=lines)
+            for year, result_file in inputs
+        ],
+        ignore_index=True,
+    )
+    if lines is not None:
+        elections = _merge_areas(elections)
+    # The areas are sorted by number, and get the names used last:
+    area_key = ['Kommunenummer', 'Stemmekretsnummer']
+    areas = elections.drop_duplicates(area_key, keep='last')[
+        list(AREA_COLUMNS)
+    ].sort_values(area_key, ignore_index=True)
+    area_codes = pd.MultiIndex.from_frame(areas[area_key]).get_indexer(
+        pd.MultiIndex.from_frame(elections[area_key])
+    )
+    party_codes, parties = pd.factorize(elections['Partinavn'], sort=True)
+    columns = {
+        'year': elections['year'].to_numpy(dtype=np.int16),
+        'area': area_codes.astype(np.int32),
+        'party': party_codes.astype(np.int16),
+        'oppslutning': elections['oppslutning'].to_numpy(dtype=float),
+        'stemmer': elections['stemmer'].to_numpy(dtype=float),
+    }
+    sources = [
+        {
+            'year': year,
+            'signature': file_signature(result_file, with_hash=False),
+        }
+        for year, result_file in inputs
+    ]
+    return ElectionStore(
+        sorted(year for year, _ in inputs),
+        areas,
+        np.asarray(parties),
+        columns,
+        sources=sources,
+    )
+
+
+def kommune_values(store):
+    """Sum up the results in each kommune.
+
+    The oppslutning in a kommune is found from the votes in its areas
+    when they are known, and as the mean over the areas otherwise.
+
+    Parameters
+    ----------
+    store : object like ElectionStore
+        The store with the results.
+
+    Returns
+    -------
+    kommuner : object like pandas.DataFrame
+        The number and name of the fylke and kommune for each index.
+    values : object like numpy.ndarray
+        The oppslutning with shape (years, kommuner, parties).
+
+    """
+    kommune, kommune_codes = np.unique(
+        store.areas['Kommunenummer'].to_numpy().astype(str),
+        return_inverse=True,
+    )
+    shape = (len(kommune), len(store.years), len(store.parties))
+    # Add up the areas in each kommune, with kommuner along the first
+    # axis so that all years and parties are added in one step:
+    votes = store.dense('stemmer').transpose(1, 0, 2)
+    vote_sum = np.zeros(shape)
+    np.add.at(vote_sum, kommune_codes, np.nan_to_num(votes))
+    vote_count = np.zeros(shape)
+    np.add.at(vote_count, kommune_codes, np.isfinite(votes))
+    share = store.dense('oppslutning').transpose(1, 0, 2)
+    share_sum = np.zeros(shape)
+    np.add.at(share_sum, kommune_codes, np.nan_to_num(share))
+    share_count = np.zeros(shape)
+    np.add.at(share_count, kommune_codes, np.isfinite(share))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        from_votes = 100 * vote_sum / vote_sum.sum(axis=2, keepdims=True)
+        mean = share_sum / share_count
+    # Use the votes only if they are known for all results:
+    known = (vote_count == share_count).all(axis=2, keepdims=True) & (
+        share_count.sum(axis=2, keepdims=True) > 0
+    )
+    values = np.where(known, from_votes, mean)
+    values[share_count == 0] = np.nan
+    first = np.unique(kommune_codes, return_index=True)[1]
+    kommuner = store.areas.iloc[first][
+        ['Fylkenummer', 'Fylkenavn', 'Kommunenummer', 'Kommunenavn']
+    ].reset_index(drop=True)
+    return kommuner, values.transpose(1, 0, 2)
+
+
+@profiled('extract')
+def swing(store, from_year, to_year, level='krets', parties=None):
+    """Find the change in oppslutning between two elections.
+
+    The change is calculated for all areas and parties at once, as
+    the difference between two arrays indexed by area and party.
+
+    Parameters
+    ----------
+    store : object like ElectionStore
+        The store with the results.
+    from_year : integer
+        The earlier election.
+    to_year : integer
+        The later election.
+    level : string, optional
+        Compare the areas (``krets``) or the kommuner (``kommune``).
+    parties : list of strings, optional
+        The parties to include. All parties are included if not given.
+
+    Returns
+    -------
+    change : object like pandas.DataFrame
+        The oppslutning in both years (``fra`` and ``til``) and the
+        change (``endring``, in percentage points) for each area and
+        party with results in both years.
+
+    """
+    if level not in LEVELS:
+        raise ValueError('Unknown level "{}"'.format(level))
+    first = store.year_index(from_year)
+    second = store.year_index(to_year)
+    codes = store.party_codes(parties)
+    if level == 'kommune':
+        areas, values = kommune_values(store)
+    else:
+        areas, values = store.areas, store.dense('oppslutning')
+    before = values[first][:, codes]
+    after = values[second][:, codes]
+    change = after - before
+    area_idx, party_idx = np.nonzero(np.isfinite(change))
+    frame = areas.iloc[area_idx].reset_index(drop=True)
+    frame['Partinavn'] = store.parties[codes[party_idx]]
+    frame['fra'] = before[area_idx, party_idx]
+    frame['til'] = after[area_idx, party_idx]
+    frame['endring'] = change[area_idx, party_idx]
+    return frame
+
+
+def main(inputs, output, area_map=None):
+    """Build a store and write it to a file."""
+    store = build_store(parse_inputs(inputs), area_map=area_map)
+    store.save(output)
+    print('Stored {} results for {} areas and {} parties ({}) in "{}"'.format(
+        len(store), len(store.areas), len(store.parties),
+        ', '.join(str(i) for i in store.years), output,
+    ))
+
+
+def load_store(filename):
+    """Read a store, warning if the results have changed since."""
+    print('Reading results from "{}"'.format(filename))
+    store = ElectionStore.load(filename)
+    if store.is_stale():
+        print('Warning: the results changed after "{}" was built'.format(
+            filename
+        ))
+    return store
+
+
+def print_swing(store_file, from_year, to_year, level='krets',
+                parties=None, output=None):
+    """Print (or write to a csv file) the change between two years."""
+    change = swing(
+        load_store(store_file), from_year, to_year, level=level,
+        parties=parties,
+    )
+    if output is None:
+        print(change.to_string(index=False))
+        return
+    change.to_csv(output, sep=';', decimal=',', index=False)
+    print('Wrote {} changes to "{}"'.format(len(change), output))
+
+
+def add_arguments(parser):
+    """Add the command line arguments for this script."""
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    build = subparsers.add_parser(
+        'build', help='Build a store from csv files.'
+    )
+    build.add_argument('store', help='The file to write the store to.')
+    build.add_argument(
+        'inputs',
+        nargs='+',
+        metavar='YEAR=CSV',
+        help='The year and the csv file with the results for it.',
+    )
+    build.add_argument(
+        '--area-map',
+        default=None,
+        help='A file with kommune and krets numbers to align.',
+    )
+    change = subparsers.add_parser(
+        'swing', help='Show the change in oppslutning between two years.'
+    )
+    change.add_argument('store', help='The store to read.')
+    change.add_argument('from_year', type=int, help='The earlier year.')
+    change.add_argument('to_year', type=int, help='The later year.')
+    change.add_argument(
+        '--level',
+        choices=LEVELS,
+        default='krets',
+        help='Compare voting areas or kommuner.',
+    )
+    change.add_argument(
+        '--party',
+        nargs='+',
+        default=None,
+        help='Only show these parties.',
+    )
+    change.add_argument(
+        '--output',
+        default=None,
+        help='Write the changes to this csv file.',
+    )
+
+
+def run(args):
+    """Build a store, or show changes, from parsed arguments."""
+    try:
+        if args.action == 'build':
+            main(args.inputs, args.store, area_map=args.area_map)
+        else:
+            print_swing(
+                args.store, args.from_year, args.to_year, level=args.level,
+                parties=args.party, output=args.output,
+            )
+    except ValueError as error:
+        raise SystemExit(str(error))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Store the results from several elections.'
+    )
+    add_arguments(PARSER)
+    run(PARSER.parse_args())
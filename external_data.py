@@ -0,0 +1,236 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Store the geometries of map layers in separate, cacheable files.
+
+Normally, all data is embedded in the html file for a map. With an
+:py:class:`ExternalGeoJson` layer, only the properties of the features
+(the results, tooltips and styles) are embedded, while the geometries
+are written to a GeoJSON file which the page fetches. The file is
+named by a hash of its content, so maps showing the same areas share
+the file, and a browser (or a server) can cache it for good. Gzip (and,
+if the brotli package is installed, brotli) compressed copies are
+written next to it, so that a server can send them directly.
+"""
+import gzip
+import hashlib
+import json
+import pathlib
+import folium
+from jinja2 import Template
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# The directory, next to the html file, to store the geometries in:
+DATA_DIR = 'geodata'
+
+
+def geometry_content(geojson_layer):
+    """Serialize the geometries (only) of a layer.
+
+    Parameters
+    ----------
+    geojson_layer : dict
+        The geojson layer.
+
+    Returns
+    -------
+    content : bytes
+        A feature collection (as compact json) with the geometries
+        and no properties.
+
+    """
+    collection = {
+        'type': 'FeatureCollection',
+        'features': [
+            {
+                'type': 'Feature',
+                'properties': None,
+                'geometry': feature['geometry'],
+            }
+            for feature in geojson_layer['features']
+        ],
+    }
+    return json.dumps(collection, separators=(',', ':')).encode('utf-8')
+
+
+def write_compressed(filename, content):
+    """Write a file and its compressed copies, unless already written.
+
+    Parameters
+    ----------
+    filename : object like pathlib.Path
+        The file to write.
+    content : bytes
+        The content of the file.
+
+    Returns
+    -------
+    written : list of object like pathlib.Path
+        The files written.
+
+    """
+    variants = [(filename, lambda x: x)]
+    variants.append((
+        filename.with_name(filename.name + '.gz'),
+        lambda x: gzip.compress(x, compresslevel=9, mtime=0),
+    ))
+    if brotli is not None:
+        variants.append((
+            filename.with_name(filename.name + '.br'),
+            lambda x: brotli.compress(x, quality=11),
+        ))
+    written = []
+    for path, compress in variants:
+        # The name depends on the content, so an existing file is done:
+        if path.is_file():
+            continue
+        temporary = path.with_name(path.name + '.tmp')
+        temporary.write_bytes(compress(content))
+        temporary.replace(path)
+        written.append(path)
+    return written
+
+
+class ExternalGeoJson(folium.GeoJson):
+    """A geojson layer with the geometries in a separate file."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.geoJson(null, {
+            {%- if this.class_style %}
+                style: {{ this.class_style.get_name() }}.style,
+            {%- else %}
+                style: function(feature) {
+                    return feature.properties.style;
+                },
+            {%- endif %}
+            });
+            {%- if this.class_style %}
+            {{ this.get_name() }}.options.onEachFeature =
+                {{ this.class_style.get_name() }}.onEachFeature(
+                    {{ this.get_name() }}
+                );
+            {%- else %}
+            {{ this.get_name() }}.options.onEachFeature = function(
+                feature, layer
+            ) {
+                layer.on({
+                    mouseover: function(e) {
+                        e.target.setStyle(feature.properties.highlight);
+                    },
+                    mouseout: function(e) {
+                        {{ this.get_name() }}.resetStyle(e.target);
+                    },
+                });
+            };
+            {%- endif %}
+            {{ this.get_name() }}.addTo({{ this._parent.get_name() }});
+            (function(layer, properties) {
+                fetch({{ this.url|tojson }}).then(function(response) {
+                    return response.json();
+                }).then(function(data) {
+                    data.features.forEach(function(feature, i) {
+                        feature.properties = properties[i];
+                    });
+                    layer.addData(data);
+                });
+            })({{ this.get_name() }}, {{ this.properties|tojson }});
+        {% endmacro %}
+        """)
+
+    def __init__(self, data, directory=DATA_DIR, class_style=None,
+                 style_function=None, highlight_function=None, name=None,
+                 tooltip=None):
+        """Set up the layer.
+
+        Parameters
+        ----------
+        data : dict
+            The geojson data for the layer.
+        directory : string, optional
+            The directory (relative to the html file) to store the
+            geometries in.
+        class_style : object like client_style.ClassStyle, optional
+            If given, the layer is styled in the browser with this
+            lookup table.
+        style_function : callable, optional
+            Otherwise, the style for each feature is found with this
+            function and stored with its properties.
+        highlight_function : callable, optional
+            A function defining the style to use when highlighting.
+        name : string, optional
+            The name of the layer.
+        tooltip : object like folium.features.GeoJsonTooltip, optional
+            A tooltip to add to the layer.
+
+        """
+        super().__init__(data, name=name, tooltip=tooltip)
+        self._name = 'ExternalGeoJson'
+        self.class_style = class_style
+        self.content = geometry_content(self.data)
+        # The name is matched by map_server.HASHED_FILE:
+        digest = hashlib.sha256(self.content).hexdigest()[:20]
+        self.filename = '{}.geojson'.format(digest)
+        self.directory = directory
+        self.url = '{}/{}'.format(directory, self.filename)
+        self.properties = []
+        for feature in self.data['features']:
+            properties = dict(feature.get('properties') or {})
+            if class_style is None:
+                properties['style'] = (
+                    style_function(feature) if style_function else {}
+                )
+                properties['highlight'] = (
+                    highlight_function(feature) if highlight_function
+                    else {}
+                )
+            self.properties.append(properties)
+
+    def style_data(self):
+        """Do nothing, the styles are stored with the properties."""
+
+    def write(self, output_dir):
+        """Write the geometries next to the html file.
+
+        Parameters
+        ----------
+        output_dir : object like pathlib.Path
+            The directory the html file is written to.
+
+        Returns
+        -------
+        written : list of object like pathlib.Path
+            The files written (files which exist are not rewritten).
+
+        """
+        directory = pathlib.Path(output_dir).joinpath(self.directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        return write_compressed(directory.joinpath(self.filename),
+                                self.content)
+
+
+def write_external_data(the_map, output):
+    """Write the geometries for the external layers in a map.
+
+    Parameters
+    ----------
+    the_map : object like folium.folium.Map
+        The map with the layers.
+    output : string
+        The html file the map is written to.
+
+    Returns
+    -------
+    written : list of object like pathlib.Path
+        The files written.
+
+    """
+    output_dir = pathlib.Path(output).parent
+    written = []
+    for child in the_map._children.values():  # pylint: disable=W0212
+        if isinstance(child, ExternalGeoJson):
+            written += child.write(output_dir)
+    return written
@@ -0,0 +1,424 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Methods for working with polygon geometries as flat arrays.
+
+The coordinates of many features are concatenated into one array, and
+the structure is described by offset arrays:
+
+* ``rings[i]:rings[i+1]`` are the coordinates of ring ``i``.
+* ``parts[j]:parts[j+1]`` are the rings of polygon ``j``, where the
+  first ring is the exterior and the rest are holes.
+* ``features[k]:features[k+1]`` are the polygons of feature ``k``.
+"""
+import numpy as np
+
+
+GEOMETRY_TYPES = {
+    None: 0,
+    'Polygon': 1,
+    'MultiPolygon': 2,
+}
+
+
+GEOMETRY_NAMES = {val: key for key, val in GEOMETRY_TYPES.items()}
+
+
+def _polygons(geometry):
+    """Return the polygons for a Polygon or MultiPolygon geometry."""
+    if geometry is None:
+        return []
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    raise ValueError(
+        'Unsupported geometry type "{}"'.format(geometry['type'])
+    )
+
+
+def flatten_features(features):
+    """Concatenate the coordinates of features into flat arrays.
+
+    Parameters
+    ----------
+    features : list of dicts
+        The GeoJSON features to flatten.
+
+    Returns
+    -------
+    flat : dict of numpy.arrays
+        The ``coordinates``, the offsets ``rings``, ``parts`` and
+        ``features`` and the ``geometry_type`` of each feature.
+
+    """
+    coordinates = []
+    rings = [0]
+    parts = [0]
+    offsets = [0]
+    geometry_type = []
+    for feature in features:
+        geometry = feature.get('geometry')
+        geometry_type.append(
+            GEOMETRY_TYPES[None if geometry is None else geometry['type']]
+        )
+        for polygon in _polygons(geometry):
+            for ring in polygon:
+                coordinates.extend(point[:2] for point in ring)
+                rings.append(len(coordinates))
+            parts.append(len(rings) - 1)
+        offsets.append(len(parts) - 1)
+    return {
+        'coordinates': np.array(coordinates, dtype=np.float64).reshape(-1, 2),
+        'rings': np.array(rings, dtype=np.int64),
+        'parts': np.array(parts, dtype=np.int64),
+        'features': np.array(offsets, dtype=np.int64),
+        'geometry_type': np.array(geometry_type, dtype=np.int8),
+    }
+
+
+def concatenate_flats(flats):
+    """Concatenate flat arrays for several sets of features.
+
+    Parameters
+    ----------
+    flats : list of dicts of numpy.arrays
+        The flat arrays as returned by :py:func:`flatten_features`.
+
+    Returns
+    -------
+    flat : dict of numpy.arrays
+        The combined flat arrays, where the offsets have been shifted
+        to point into the concatenated arrays.
+
+    """
+    merged = {
+        'coordinates': [np.zeros((0, 2))],
+        'rings': [np.zeros(1, dtype=np.int64)],
+        'parts': [np.zeros(1, dtype=np.int64)],
+        'features': [np.zeros(1, dtype=np.int64)],
+        'geometry_type': [np.zeros(0, dtype=np.int8)],
+    }
+    shift = {'coordinates': 0, 'rings': 0, 'parts': 0}
+    for flat in flats:
+        merged['coordinates'].append(flat['coordinates'])
+        merged['rings'].append(flat['rings'][1:] + shift['coordinates'])
+        merged['parts'].append(flat['parts'][1:] + shift['rings'])
+        merged['features'].append(flat['features'][1:] + shift['parts'])
+        merged['geometry_type'].append(flat['geometry_type'])
+        shift['coordinates'] += len(flat['coordinates'])
+        shift['rings'] += len(flat['rings']) - 1
+        shift['parts'] += len(flat['parts']) - 1
+    return {key: np.concatenate(val) for key, val in merged.items()}
+
+
+def unflatten_geometry(flat, index):
+    """Recreate the GeoJSON geometry for a single feature.
+
+    Parameters
+    ----------
+    flat : dict of numpy.arrays
+        The flat arrays as returned by :py:func:`flatten_features`.
+    index : integer
+        The feature to recreate the geometry for.
+
+    Returns
+    -------
+    geometry : dict or None
+        The GeoJSON geometry for the feature.
+
+    """
+    geometry_type = GEOMETRY_NAMES[int(flat['geometry_type'][index])]
+    if geometry_type is None:
+        return None
+    rings, parts = flat['rings'], flat['parts']
+    coordinates = flat['coordinates']
+    polygons = []
+    for part in range(flat['features'][index], flat['features'][index + 1]):
+        polygon = []
+        for ring in range(parts[part], parts[part + 1]):
+            polygon.append(
+                coordinates[rings[ring]:rings[ring + 1]].tolist()
+            )
+        polygons.append(polygon)
+    if geometry_type == 'Polygon':
+        return {'type': 'Polygon', 'coordinates': polygons[0]}
+    return {'type': 'MultiPolygon', 'coordinates': polygons}
+
+
+def round_coordinates(flat, decimals):
+    """Round the coordinates and remove repeated points.
+
+    Parameters
+    ----------
+    flat : dict of numpy.arrays
+        The flat arrays as returned by :py:func:`flatten_features`.
+    decimals : integer
+        The number of decimals to keep.
+
+    Returns
+    -------
+    flat : dict of numpy.arrays
+        The flat arrays with rounded coordinates, where points equal
+        to the previous point in the same ring are removed. Rings
+        which would get fewer than four points keep all their points.
+
+    """
+    coordinates = np.round(flat['coordinates'], decimals)
+    rings = flat['rings']
+    nring = len(rings) - 1
+    ring_id = np.repeat(np.arange(nring), np.diff(rings))
+    keep = np.ones(len(coordinates), dtype=bool)
+    keep[1:] = np.any(coordinates[1:] != coordinates[:-1], axis=1) | (
+        ring_id[1:] != ring_id[:-1]
+    )
+    counts = np.bincount(ring_id[keep], minlength=nring)
+    short = counts < 4
+    if short.any():
+        keep |= short[ring_id]
+        counts = np.bincount(ring_id[keep], minlength=nring)
+    new_flat = dict(flat)
+    new_flat['coordinates'] = coordinates[keep]
+    new_flat['rings'] = np.concatenate(([0], np.cumsum(counts)))
+    return new_flat
+
+
+def _ring_sums(values, rings, count):
+    """Sum values over each ring (zero for empty rings)."""
+    sums = np.zeros(len(rings) - 1)
+    nonempty = count > 0
+    sums[nonempty] = np.add.reduceat(values, rings[:-1][nonempty])
+    return sums
+
+
+def ring_moments(coordinates, rings):
+    """Calculate the signed area and centroid of all rings.
+
+    Parameters
+    ----------
+    coordinates : numpy.array
+        The concatenated coordinates.
+    rings : numpy.array
+        The offsets for the rings.
+
+    Returns
+    -------
+    area : numpy.array
+        The signed area of each ring.
+    center : numpy.array
+        The centroid of each ring. For degenerate rings (with zero
+        area) the average of the vertices is used.
+
+    """
+    nring = len(rings) - 1
+    area = np.zeros(nring)
+    center = np.zeros((nring, 2))
+    if len(coordinates) == 0:
+        return area, center
+    count = np.diff(rings)
+    x, y = coordinates[:, 0], coordinates[:, 1]
+    # Shift the coordinates to improve the precision:
+    x0, y0 = x.mean(), y.mean()
+    x, y = x - x0, y - y0
+    # The next vertex, wrapping around at the end of each ring:
+    first, last = rings[:-1][count > 0], rings[1:][count > 0] - 1
+    x_next, y_next = np.empty_like(x), np.empty_like(y)
+    x_next[:-1], y_next[:-1] = x[1:], y[1:]
+    x_next[last], y_next[last] = x[first], y[first]
+    cross = x * y_next - x_next * y
+    area = 0.5 * _ring_sums(cross, rings, count)
+    cx = _ring_sums((x + x_next) * cross, rings, count)
+    cy = _ring_sums((y + y_next) * cross, rings, count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        center[:, 0] = cx / (6.0 * area)
+        center[:, 1] = cy / (6.0 * area)
+        degenerate = np.abs(area) < 1e-15
+        if np.any(degenerate):
+            center[degenerate, 0] = (
+                _ring_sums(x, rings, count)[degenerate] / count[degenerate]
+            )
+            center[degenerate, 1] = (
+                _ring_sums(y, rings, count)[degenerate] / count[degenerate]
+            )
+    center[:, 0] += x0
+    center[:, 1] += y0
+    return area, center
+
+
+def _ring_weights(flat):
+    """Weights for rings when combining them: Holes are subtracted."""
+    area, center = ring_moments(flat['coordinates'], flat['rings'])
+    weight = np.abs(area)
+    exterior = flat['parts'][:-1]
+    hole = np.ones(len(weight), dtype=bool)
+    hole[exterior[exterior < len(weight)]] = False
+    weight[hole] *= -1
+    return weight, center
+
+
+def _ring_feature_ids(flat):
+    """Return the feature index for each ring."""
+    parts, features = flat['parts'], flat['features']
+    part_feature = np.repeat(np.arange(len(features) - 1), np.diff(features))
+    return np.repeat(part_feature, np.diff(parts))
+
+
+def feature_centroids(flat):
+    """Calculate the area weighted centroid for each feature.
+
+    Parameters
+    ----------
+    flat : dict of numpy.arrays
+        The flat arrays as returned by :py:func:`flatten_features`.
+
+    Returns
+    -------
+    centroids : numpy.array
+        The (x, y) centroid for each feature. It is NaN for features
+        without a geometry.
+
+    """
+    nfeat = len(flat['features']) - 1
+    weight, center = _ring_weights(flat)
+    feature_id = _ring_feature_ids(flat)
+    total = np.bincount(feature_id, weights=weight, minlength=nfeat)
+    centroids = np.full((nfeat, 2), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(2):
+            centroids[:, i] = np.bincount(
+                feature_id, weights=weight * center[:, i], minlength=nfeat
+            ) / total
+    # Features with zero area, use the average of the ring centers:
+    zero = ~np.isfinite(centroids[:, 0])
+    if np.any(zero):
+        count = np.bincount(feature_id, minlength=nfeat)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(2):
+                mean = np.bincount(
+                    feature_id, weights=center[:, i], minlength=nfeat
+                ) / count
+                centroids[zero, i] = mean[zero]
+    return centroids
+
+
+def centroid(flat):
+    """Calculate the area weighted centroid for all features together."""
+    return _combine_rings(*_ring_weights(flat))
+
+
+def feature_bounds(flat):
+    """Calculate the bounding box for each feature.
+
+    Parameters
+    ----------
+    flat : dict of numpy.arrays
+        The flat arrays as returned by :py:func:`flatten_features`.
+
+    Returns
+    -------
+    bounds : numpy.array
+        The (min x, min y, max x, max y) for each feature. It is NaN
+        for features without a geometry.
+
+    """
+    nfeat = len(flat['features']) - 1
+    bounds = np.full((nfeat, 4), np.nan)
+    coordinates = flat['coordinates']
+    # Index of the first and last+1 coordinate of each feature:
+    start = flat['rings'][flat['parts'][flat['features'][:-1]]]
+    end = flat['rings'][flat['parts'][flat['features'][1:]]]
+    has_coords = end > start
+    if not np.any(has_coords):
+        return bounds
+    start = start[has_coords]
+    # Reduce each column separately, this is faster than using axis=0:
+    for i in range(2):
+        column = np.ascontiguousarray(coordinates[:, i])
+        bounds[has_coords, i] = np.minimum.reduceat(column, start)
+        bounds[has_coords, i + 2] = np.maximum.reduceat(column, start)
+    return bounds
+
+
+def bounds(flat):
+    """Calculate the bounding box for all features together."""
+    coordinates = flat['coordinates']
+    if len(coordinates) == 0:
+        return np.full(4, np.nan)
+    x, y = coordinates[:, 0], coordinates[:, 1]
+    return np.array([x.min(), y.min(), x.max(), y.max()])
+
+
+def _combine_rings(weight, center):
+    """Area weighted average of ring centers."""
+    if len(weight) == 0:
+        return np.array([np.nan, np.nan])
+    total = weight.sum()
+    if abs(total) < 1e-15:
+        return center.mean(axis=0)
+    return weight @ center / total
+
+
+def area(flat):
+    """Calculate the total area of all features (holes subtracted)."""
+    weight, _ = _ring_weights(flat)
+    return float(weight.sum())
+
+
+def extent(flat):
+    """Calculate the bounding box, area and centroid of some features.
+
+    Parameters
+    ----------
+    flat : dict of numpy.arrays
+        The flat arrays as returned by :py:func:`flatten_features`.
+
+    Returns
+    -------
+    extent : dict
+        The ``bbox`` (min x, min y, max x, max y), the ``area`` and
+        the area weighted ``centroid`` (x, y).
+
+    """
+    weight, center = _ring_weights(flat)
+    return {
+        'bbox': bounds(flat).tolist(),
+        'area': float(weight.sum()),
+        'centroid': _combine_rings(weight, center).tolist(),
+    }
+
+
+def combine_extents(extents):
+    """Combine the extents of several sets of features.
+
+    Parameters
+    ----------
+    extents : list of dicts
+        The extents as returned by :py:func:`extent`.
+
+    Returns
+    -------
+    extent : dict
+        The extent of all features together. The centroid is the
+        area weighted average of the centroids.
+
+    """
+    extents = [
+        i for i in extents if np.all(np.isfinite(i['centroid']))
+    ]
+    if not extents:
+        return {
+            'bbox': [np.nan] * 4, 'area': 0.0, 'centroid': [np.nan] * 2
+        }
+    bbox = np.array([i['bbox'] for i in extents], dtype=np.float64)
+    weight = np.abs(np.array([i['area'] for i in extents], dtype=np.float64))
+    center = np.array([i['centroid'] for i in extents], dtype=np.float64)
+    if weight.sum() < 1e-15:
+        weight = np.ones_like(weight)
+    return {
+        'bbox': np.concatenate(
+            (np.nanmin(bbox[:, :2], axis=0), np.nanmax(bbox[:, 2:], axis=0))
+        ).tolist(),
+        'area': float(weight.sum()),
+        'centroid': (
+            (weight[:, np.newaxis] * center).sum(axis=0) / weight.sum()
+        ).tolist(),
+    }
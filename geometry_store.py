@@ -0,0 +1,339 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Pack GeoJSON files into one indexed, memory-mappable geometry store.
+
+The store is a single file with the layout::
+
+    b'VALGGEO1' | header length (uint64) | JSON header | data
+
+The JSON header contains an index with one entry for each of the packed
+GeoJSON files (e.g. ``krets-0301``). Each entry holds the range of
+features belonging to it, its bounding box, area, centroid, feature
+count and the byte offset of its properties. The data section holds the
+flat coordinate arrays (see :py:mod:`geometry`) which are memory-mapped
+when reading, so that a single kommune can be fetched without parsing
+the others. All byte offsets in the header are relative to the start of
+the data section, which starts directly after the header.
+
+The store is built with::
+
+    python geometry_store.py valgkretser kommuner
+
+which creates ``valgkretser/geometri.valggeo`` and
+``kommuner/geometri.valggeo``.
+"""
+import argparse
+import json
+import pathlib
+import struct
+import numpy as np
+from geometry import (
+    concatenate_flats,
+    extent,
+    feature_bounds,
+    feature_centroids,
+    flatten_features,
+    unflatten_geometry,
+)
+
+
+MAGIC = b'VALGGEO1'
+STORE_VERSION = 1
+STORE_FILE = 'geometri.valggeo'
+ALIGN = 16
+ARRAYS = (
+    'coordinates',
+    'rings',
+    'parts',
+    'features',
+    'geometry_type',
+    'feature_bounds',
+    'feature_centroids',
+)
+
+
+def _pad(length):
+    """Return the padding needed to align a length."""
+    return (-length) % ALIGN
+
+
+def _store_arrays(flats):
+    """Concatenate flat arrays and add bounds and centroids."""
+    arrays = concatenate_flats(flats)
+    if flats:
+        arrays['feature_bounds'] = np.concatenate(
+            [feature_bounds(flat) for flat in flats]
+        )
+        arrays['feature_centroids'] = np.concatenate(
+            [feature_centroids(flat) for flat in flats]
+        )
+    else:
+        arrays['feature_bounds'] = np.zeros((0, 4))
+        arrays['feature_centroids'] = np.zeros((0, 2))
+    return arrays
+
+
+def _feature_extras(feature):
+    """Return the items of a feature other than the geometry."""
+    return {
+        key: val for key, val in feature.items()
+        if key not in ('geometry', 'type')
+    }
+
+
+def build_store(directory, output=None, pattern='*.geojson'):
+    """Pack all GeoJSON files in a directory into a geometry store.
+
+    Parameters
+    ----------
+    directory : string or object like pathlib.Path
+        The directory containing the GeoJSON files.
+    output : string or object like pathlib.Path, optional
+        The file to write the store to. The default is
+        ``STORE_FILE`` in the given directory.
+    pattern : string, optional
+        A pattern for selecting the GeoJSON files.
+
+    Returns
+    -------
+    output : object like pathlib.Path
+        The file the store was written to.
+
+    """
+    directory = pathlib.Path(directory)
+    if output is None:
+        output = directory.joinpath(STORE_FILE)
+    output = pathlib.Path(output)
+    index = {}
+    flats = []
+    blobs = []
+    nfeat = 0
+    for filename in sorted(directory.glob(pattern)):
+        print('Packing file "{}"'.format(filename))
+        with open(filename, 'r') as infile:
+            data = json.load(infile)
+        features = data.get('features', [])
+        flat = flatten_features(features)
+        flats.append(flat)
+        blob = json.dumps(
+            [_feature_extras(feature) for feature in features]
+        ).encode('utf-8')
+        stat = filename.stat()
+        index[filename.stem] = {
+            'feature_start': nfeat,
+            'feature_count': len(features),
+            **extent(flat),
+            'collection': {
+                key: val for key, val in data.items() if key != 'features'
+            },
+            'source': {
+                'name': filename.name,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+            },
+            'properties': [sum(len(i) for i in blobs), len(blob)],
+        }
+        blobs.append(blob)
+        nfeat += len(features)
+    arrays = _store_arrays(flats)
+    # Lay out the data section, offsets are relative to its start:
+    layout = {}
+    position = 0
+    for key in ARRAYS:
+        array = np.ascontiguousarray(arrays[key])
+        arrays[key] = array
+        layout[key] = {
+            'offset': position,
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+        }
+        position += array.nbytes + _pad(array.nbytes)
+    for entry in index.values():
+        entry['properties'][0] += position
+    header = {
+        'version': STORE_VERSION,
+        'arrays': layout,
+        'index': index,
+    }
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * _pad(len(MAGIC) + 8 + len(header_bytes))
+    tmp_file = output.with_name(output.name + '.tmp')
+    with open(tmp_file, 'wb') as outfile:
+        outfile.write(MAGIC)
+        outfile.write(struct.pack('<Q', len(header_bytes)))
+        outfile.write(header_bytes)
+        for key in ARRAYS:
+            outfile.write(arrays[key].tobytes())
+            outfile.write(b'\0' * _pad(arrays[key].nbytes))
+        for blob in blobs:
+            outfile.write(blob)
+    tmp_file.replace(output)
+    print('Wrote {} features to "{}"'.format(nfeat, output))
+    return output
+
+
+class GeometryStore:
+    """Read geometries from a geometry store.
+
+    Attributes
+    ----------
+    filename : object like pathlib.Path
+        The file containing the store.
+    index : dict
+        The index, with one entry for each packed GeoJSON file.
+    arrays : dict of numpy.memmap
+        The memory-mapped flat geometry arrays.
+    data_start : integer
+        The position in the file where the data section starts.
+
+    """
+
+    def __init__(self, filename):
+        """Open the store and memory-map the arrays."""
+        self.filename = pathlib.Path(filename)
+        with open(self.filename, 'rb') as infile:
+            if infile.read(len(MAGIC)) != MAGIC:
+                raise ValueError(
+                    '"{}" is not a geometry store'.format(self.filename)
+                )
+            length, = struct.unpack('<Q', infile.read(8))
+            header = json.loads(infile.read(length).decode('utf-8'))
+        self.data_start = len(MAGIC) + 8 + length
+        if header['version'] != STORE_VERSION:
+            raise ValueError(
+                'Unsupported geometry store version in "{}"'.format(
+                    self.filename
+                )
+            )
+        self.index = header['index']
+        self.arrays = {}
+        for key, info in header['arrays'].items():
+            shape = tuple(info['shape'])
+            if 0 in shape:
+                self.arrays[key] = np.zeros(shape, dtype=info['dtype'])
+                continue
+            self.arrays[key] = np.memmap(
+                self.filename,
+                dtype=info['dtype'],
+                mode='r',
+                offset=self.data_start + info['offset'],
+                shape=shape,
+            )
+
+    def __contains__(self, key):
+        """Check if the given key is in the store."""
+        return key in self.index
+
+    def keys(self):
+        """Return the keys of the packed GeoJSON files."""
+        return self.index.keys()
+
+    def is_fresh(self, key, filename):
+        """Check if the stored data matches the given source file."""
+        source = self.index[key]['source']
+        stat = pathlib.Path(filename).stat()
+        return (
+            stat.st_size == source['size'] and
+            stat.st_mtime_ns == source['mtime_ns']
+        )
+
+    def _feature_range(self, key):
+        """Return the index of the first and last+1 feature for a key."""
+        entry = self.index[key]
+        start = entry['feature_start']
+        return start, start + entry['feature_count']
+
+    def bbox(self, key):
+        """Return the bounding box for all features for a key."""
+        return self.index[key]['bbox']
+
+    def centroid(self, key):
+        """Return the area weighted centroid for a key."""
+        return self.index[key]['centroid']
+
+    def extent(self, key):
+        """Return the bounding box, area and centroid for a key.
+
+        None is returned for stores built before the area was stored.
+        """
+        entry = self.index[key]
+        if 'area' not in entry:
+            return None
+        return {
+            'bbox': entry['bbox'],
+            'area': entry['area'],
+            'centroid': entry['centroid'],
+        }
+
+    def feature_bounds(self, key):
+        """Return the bounding box of each feature for a key."""
+        start, end = self._feature_range(key)
+        return np.asarray(self.arrays['feature_bounds'][start:end])
+
+    def feature_centroids(self, key):
+        """Return the centroid of each feature for a key."""
+        start, end = self._feature_range(key)
+        return np.asarray(self.arrays['feature_centroids'][start:end])
+
+    def properties(self, key):
+        """Return the properties (and ids) for the features of a key."""
+        offset, length = self.index[key]['properties']
+        with open(self.filename, 'rb') as infile:
+            infile.seek(self.data_start + offset)
+            return json.loads(infile.read(length).decode('utf-8'))
+
+    def flat(self, key):
+        """Return the flat arrays for the features of a key."""
+        start, end = self._feature_range(key)
+        features = self.arrays['features'][start:end + 1]
+        parts = self.arrays['parts'][features[0]:features[-1] + 1]
+        rings = self.arrays['rings'][parts[0]:parts[-1] + 1]
+        return {
+            'coordinates': self.arrays['coordinates'][rings[0]:rings[-1]],
+            'rings': rings - rings[0],
+            'parts': parts - parts[0],
+            'features': features - features[0],
+            'geometry_type': self.arrays['geometry_type'][start:end],
+        }
+
+    def load(self, key):
+        """Recreate the GeoJSON feature collection for a key."""
+        flat = self.flat(key)
+        features = []
+        for i, extras in enumerate(self.properties(key)):
+            feature = {'type': 'Feature'}
+            feature.update(extras)
+            feature['geometry'] = unflatten_geometry(flat, i)
+            features.append(feature)
+        data = dict(self.index[key]['collection'])
+        data['features'] = features
+        return data
+
+
+def main(directories):
+    """Build geometry stores for the given directories."""
+    for directory in directories:
+        build_store(directory)
+
+
+def add_arguments(parser):
+    """Add the command line arguments for this script."""
+    parser.add_argument(
+        'directories',
+        nargs='*',
+        default=['valgkretser', 'kommuner'],
+        help='The directories with GeoJSON files to pack.',
+    )
+
+
+def run(args):
+    """Build the geometry stores from parsed command line arguments."""
+    main(args.directories)
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Pack GeoJSON files into geometry stores.'
+    )
+    add_arguments(PARSER)
+    run(PARSER.parse_args())
@@ -1,19 +1,41 @@
 # Copyright (c) 2019, Anders Lervik.
 # Distributed under the MIT License. See LICENSE for more info.
 """Print the municipalities in a given county."""
-import sys
-from map_basics import read_csv_results
+import argparse
+from hierarchy import load_hierarchy
+from read_results import add_cache_arguments, set_cache_options
 
 
 def main(raw_data, fylke_id):
     """Get the municipalities in a county."""
-    results = read_csv_results(raw_data)
-    data = results[results['Fylkenummer'] == fylke_id].groupby(
-        ['Kommunenummer']
-    )
-    kommuner = [str(name) for name, _ in data]
+    hierarchy = load_hierarchy(raw_data)
+    try:
+        kommuner = hierarchy.kommuner_i_fylke(fylke_id)
+    except KeyError as error:
+        raise SystemExit(error.args[0])
     print(' '.join(kommuner))
 
 
+def add_arguments(parser):
+    """Add the command line arguments for this script."""
+    parser.add_argument(
+        'raw_data',
+        help='The csv file with the election results.',
+    )
+    parser.add_argument(
+        'fylke_id',
+        help='The identifier for the county.',
+    )
+    add_cache_arguments(parser)
+
+
+def run(args):
+    """Print the municipalities from parsed command line arguments."""
+    set_cache_options(args)
+    main(args.raw_data, args.fylke_id)
+
+
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2])
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    add_arguments(PARSER)
+    run(PARSER.parse_args())
@@ -0,0 +1,430 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""An index of the fylker, kommuner and kretser in a result file.
+
+The ids and names of the fylker, the kommuner in each fylke and the
+voting areas (kretser) in each kommune are found once from the csv
+file and stored in a small json file next to it. The geometry files
+which exist for the kommuner are also recorded. The index is rebuilt
+when the csv file changes, and the list of geometry files is updated
+when one of the geometry directories changes, so that lookups like
+"all kommuner in fylke 50" do not need to read the results::
+
+    python hierarchy.py 2019-09-14_partifordeling_4_ko_2019.csv --fylke 50
+"""
+import argparse
+import json
+import pathlib
+from csv_cache import file_signature, signature_is_fresh
+from read_results import (
+    add_cache_arguments,
+    read_csv_results,
+    set_cache_options,
+)
+
+
+INDEX_SUFFIX = '.hierarki.json'
+INDEX_VERSION = 1
+
+
+# The geometry files for each kommune, by the kind of geometry:
+GEOMETRY_FILES = {
+    'valgkretser': ('valgkretser', 'krets-{}.geojson'),
+    'kommuner': ('kommuner', 'kommune-{}.geojson'),
+}
+
+
+# The columns describing the areas, from the largest to the smallest:
+LEVELS = (
+    ('Fylkenummer', 'Fylkenavn'),
+    ('Kommunenummer', 'Kommunenavn'),
+    ('Stemmekretsnummer', 'Stemmekretsnavn'),
+)
+
+
+def get_index_file(result_file):
+    """Return the path to the index file for a result file."""
+    result_file = pathlib.Path(result_file)
+    return result_file.with_name(result_file.name + INDEX_SUFFIX)
+
+
+def _directory_signature(directory):
+    """Return the modification time of a directory (None if missing)."""
+    try:
+        return pathlib.Path(directory).stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def scan_geometry_files(kommuner, geometry_files=None):
+    """Find the geometry files which exist for the given kommuner.
+
+    Parameters
+    ----------
+    kommuner : iterable of strings
+        The kommuner to look for.
+    geometry_files : dict, optional
+        The directory and file name pattern for each kind of geometry.
+        If not given, ``GEOMETRY_FILES`` is used.
+
+    Returns
+    -------
+    files : dict
+        For each kind of geometry, the ``directory``, the ``signature``
+        of the directory and the ``kommuner`` which have a file.
+
+    """
+    if geometry_files is None:
+        geometry_files = GEOMETRY_FILES
+    files = {}
+    for kind, (directory, pattern) in geometry_files.items():
+        signature = _directory_signature(directory)
+        found = []
+        if signature is not None:
+            existing = {
+                path.name for path in pathlib.Path(directory).iterdir()
+            }
+            found = [i for i in kommuner if pattern.format(i) in existing]
+        files[kind] = {
+            'directory': str(directory),
+            'pattern': pattern,
+            'signature': signature,
+            'kommuner': found,
+        }
+    return files
+
+
+def build_hierarchy(results):
+    """Find the fylker, kommuner and kretser in the results.
+
+    Parameters
+    ----------
+    results : object like pandas.DataFrame
+        The results to find the areas in.
+
+    Returns
+    -------
+    fylker : dict
+        The ``navn`` and the ``kommuner`` for each fylke.
+    kommuner : dict
+        The ``navn``, the ``fylke`` and the ``kretser`` (a dict with
+        the name of each krets) for each kommune.
+
+    """
+    columns = [column for level in LEVELS for column in level]
+    areas = results[columns].astype(str).drop_duplicates().sort_values(
+        ['Fylkenummer', 'Kommunenummer', 'Stemmekretsnummer']
+    )
+    fylker = {}
+    kommuner = {}
+    for row in areas.itertuples(index=False, name=None):
+        fylke, fylke_navn, kommune, kommune_navn, krets, krets_navn = row
+        if fylke not in fylker:
+            fylker[fylke] = {'navn': fylke_navn, 'kommuner': []}
+        if kommune not in kommuner:
+            fylker[fylke]['kommuner'].append(kommune)
+            kommuner[kommune] = {
+                'navn': kommune_navn, 'fylke': fylke, 'kretser': {},
+            }
+        kommuner[kommune]['kretser'][krets] = krets_navn
+    return fylker, kommuner
+
+
+class Hierarchy:
+    """The fylker, kommuner and kretser in a result file.
+
+    Attributes
+    ----------
+    fylker : dict
+        The ``navn`` and the ``kommuner`` for each fylke.
+    kommuner : dict
+        The ``navn``, the ``fylke`` and the ``kretser`` for each
+        kommune.
+    files : dict
+        The kommuner with geometry files, for each kind of geometry
+        (see :py:func:`scan_geometry_files`).
+
+    """
+
+    def __init__(self, fylker, kommuner, files):
+        """Set up the index."""
+        self.fylker = fylker
+        self.kommuner = kommuner
+        self.files = files
+        self._with_files = {
+            kind: set(val['kommuner']) for kind, val in files.items()
+        }
+
+    def fylke_navn(self, fylke):
+        """Return the name of a fylke."""
+        return self.fylker[fylke]['navn']
+
+    def kommune_navn(self, kommune):
+        """Return the name of a kommune."""
+        return self.kommuner[kommune]['navn']
+
+    def fylke_for_kommune(self, kommune):
+        """Return the fylke a kommune belongs to."""
+        return self.kommuner[kommune]['fylke']
+
+    def kommuner_i_fylke(self, fylke, geometry=None):
+        """Return the kommuner in a fylke.
+
+        Parameters
+        ----------
+        fylke : string
+            The fylke to get the kommuner for.
+        geometry : string, optional
+            If given, only the kommuner with a geometry file of this
+            kind (e.g. ``valgkretser``) are returned.
+
+        Returns
+        -------
+        kommuner : list of strings
+            The kommuner, sorted by their ids.
+
+        """
+        if fylke not in self.fylker:
+            raise KeyError('Unknown fylke "{}"'.format(fylke))
+        kommuner = self.fylker[fylke]['kommuner']
+        if geometry is not None:
+            kommuner = [i for i in kommuner if self.has_geometry(geometry, i)]
+        return list(kommuner)
+
+    def kretser_i_kommune(self, kommune):
+        """Return the name of each krets in a kommune."""
+        return dict(self.kommuner[kommune]['kretser'])
+
+    def has_geometry(self, kind, kommune):
+        """Check if a kommune has a geometry file of the given kind."""
+        return kommune in self._with_files.get(kind, ())
+
+    def geometry_file(self, kind, kommune):
+        """Return the path to the geometry file for a kommune."""
+        files = self.files[kind]
+        return pathlib.Path(files['directory']).joinpath(
+            files['pattern'].format(kommune)
+        )
+
+    def to_dict(self):
+        """Return the index as a dict which can be stored as json."""
+        return {
+            'fylker': self.fylker,
+            'kommuner': self.kommuner,
+            'files': self.files,
+        }
+
+
+def hierarchy_from_results(results):
+    """Build an index for results which are already read.
+
+    The index is not stored and records no geometry files. It is used
+    when maps are made from results without knowing the csv file.
+    """
+    fylker, kommuner = build_hierarchy(results)
+    return Hierarchy(fylker, kommuner, {})
+
+
+def _files_are_fresh(files, geometry_files):
+    """Check if the recorded geometry files are up to date."""
+    if set(files) != set(geometry_files):
+        return False
+    for kind, (directory, pattern) in geometry_files.items():
+        recorded = files[kind]
+        if (recorded['directory'], recorded['pattern']) != (
+                str(directory), pattern):
+            return False
+        if recorded['signature'] != _directory_signature(directory):
+            return False
+    return True
+
+
+def save_hierarchy(hierarchy, result_file, signature=None):
+    """Store the index for a result file."""
+    if signature is None:
+        signature = file_signature(result_file)
+    meta = dict(
+        hierarchy.to_dict(), version=INDEX_VERSION, signature=signature
+    )
+    index_file = get_index_file(result_file)
+    tmp_file = index_file.with_name(index_file.name + '.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as output:
+        json.dump(meta, output, ensure_ascii=False)
+    tmp_file.replace(index_file)
+
+
+def load_hierarchy(result_file, results=None, geometry_files=None,
+                   rebuild=False):
+    """Load the index for a result file, building it if needed.
+
+    Parameters
+    ----------
+    result_file : string or object like pathlib.Path
+        The csv file with the results.
+    results : object like pandas.DataFrame, optional
+        The results, if they are already read. Otherwise, they are
+        read from the csv file if the index has to be built.
+    geometry_files : dict, optional
+        The directory and file name pattern for each kind of geometry.
+        If not given, ``GEOMETRY_FILES`` is used.
+    rebuild : boolean, optional
+        If True, the index is always built again.
+
+    Returns
+    -------
+    hierarchy : object like :py:class:`Hierarchy`
+        The index.
+
+    """
+    if geometry_files is None:
+        geometry_files = GEOMETRY_FILES
+    index_file = get_index_file(result_file)
+    meta = None
+    signature = None
+    if not rebuild and index_file.is_file():
+        try:
+            with open(index_file, 'r', encoding='utf-8') as infile:
+                meta = json.load(infile)
+            fresh = meta.get('version') == INDEX_VERSION
+            if fresh:
+                fresh, signature = signature_is_fresh(
+                    meta['signature'], result_file
+                )
+        except (OSError, ValueError, KeyError):
+            print('Ignoring unreadable index "{}"'.format(index_file))
+            fresh = False
+        if not fresh:
+            meta = None
+    if meta is None:
+        print('Building index for "{}"'.format(result_file))
+        signature = file_signature(result_file)
+        if results is None:
+            results = read_csv_results(result_file)
+        fylker, kommuner = build_hierarchy(results)
+        files = scan_geometry_files(kommuner, geometry_files)
+    else:
+        fylker, kommuner, files = (
+            meta['fylker'], meta['kommuner'], meta['files']
+        )
+        changed = signature is not None
+        if not _files_are_fresh(files, geometry_files):
+            files = scan_geometry_files(kommuner, geometry_files)
+            changed = True
+        if not changed:
+            return Hierarchy(fylker, kommuner, files)
+        if signature is None:
+            signature = meta['signature']
+    hierarchy = Hierarchy(fylker, kommuner, files)
+    save_hierarchy(hierarchy, result_file, signature=signature)
+    return hierarchy
+
+
+def add_fylke_argument(parser):
+    """Add the ``--fylke`` argument for selecting kommuner by fylke."""
+    parser.add_argument(
+        '--fylke',
+        action='append',
+        default=[],
+        help=(
+            'Also show all kommuner (with voting area geometries) in '
+            'this fylke. Can be given more than once.'
+        ),
+    )
+
+
+def kommuner_with_fylker(raw_data, kommuner, fylker, results=None,
+                         hierarchy=None):
+    """Add the kommuner in some fylker to a list of kommuner.
+
+    Parameters
+    ----------
+    raw_data : string
+        The csv file with the results.
+    kommuner : list of strings
+        The kommuner given directly.
+    fylker : list of strings
+        The fylker to add the kommuner (with voting area geometries)
+        for.
+    results : object like pandas.DataFrame, optional
+        The results, if they are already read.
+    hierarchy : object like :py:class:`Hierarchy`, optional
+        The index, if it is already loaded.
+
+    Returns
+    -------
+    kommuner : list of strings
+        The kommuner, without duplicates.
+
+    """
+    kommuner = list(kommuner)
+    if not fylker:
+        return kommuner
+    if hierarchy is None:
+        hierarchy = load_hierarchy(raw_data, results=results)
+    for fylke in fylker:
+        try:
+            found = hierarchy.kommuner_i_fylke(fylke, geometry='valgkretser')
+        except KeyError as error:
+            raise SystemExit(error.args[0])
+        kommuner.extend(i for i in found if i not in kommuner)
+    return kommuner
+
+
+def main(raw_data, fylker, rebuild=False):
+    """Print the fylker, or the kommuner in some fylker."""
+    hierarchy = load_hierarchy(raw_data, rebuild=rebuild)
+    if not fylker:
+        for fylke, data in hierarchy.fylker.items():
+            print('{} {} ({} kommuner)'.format(
+                fylke, data['navn'], len(data['kommuner'])
+            ))
+        return
+    for fylke in fylker:
+        try:
+            kommuner = hierarchy.kommuner_i_fylke(fylke)
+        except KeyError as error:
+            raise SystemExit(error.args[0])
+        print('{} {}'.format(fylke, hierarchy.fylke_navn(fylke)))
+        for kommune in kommuner:
+            kinds = [
+                kind for kind in hierarchy.files
+                if hierarchy.has_geometry(kind, kommune)
+            ]
+            print('    {} {} ({} kretser) {}'.format(
+                kommune,
+                hierarchy.kommune_navn(kommune),
+                len(hierarchy.kommuner[kommune]['kretser']),
+                ', '.join(kinds),
+            ))
+
+
+def add_arguments(parser):
+    """Add the command line arguments for this script."""
+    parser.add_argument(
+        'raw_data',
+        help='The csv file with the election results.',
+    )
+    parser.add_argument(
+        '--fylke',
+        action='append',
+        default=[],
+        help='Show the kommuner in this fylke. Can be given more than once.',
+    )
+    parser.add_argument(
+        '--rebuild',
+        action='store_true',
+        help='Build the index again.',
+    )
+    add_cache_arguments(parser)
+
+
+def run(args):
+    """Print the index from parsed command line arguments."""
+    set_cache_options(args)
+    main(args.raw_data, args.fylke, rebuild=args.rebuild)
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    add_arguments(PARSER)
+    run(PARSER.parse_args())
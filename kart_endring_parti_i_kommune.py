@@ -0,0 +1,181 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Create a map showing the change for a party in the voting areas."""
+import argparse
+import pathlib
+from slugify import slugify
+from election_store import load_store, swing
+from map_basics import (
+    produce_choropleth,
+    get_extent,
+    get_map_extent,
+    load_geojson_file,
+    create_tool_tip,
+    add_map_arguments,
+    get_map_settings,
+    get_output_path,
+)
+from profiling import profile_run, profiled, stage
+
+
+VALGKRETS_DIR = pathlib.Path('valgkretser')
+VALGKRETS = 'krets-{}.geojson'
+# The change, and the oppslutning in both years, shown in the tooltip:
+CHANGE = '({:+4.2f}: {:4.2f} % til {:4.2f} %)'
+
+
+def _geojson_file(kommune_id):
+    """Return the geojson file with the voting areas in a kommune."""
+    return VALGKRETS_DIR.joinpath(VALGKRETS.format(kommune_id))
+
+
+@profiled('extract')
+def extract_data(change, kommune_id):
+    """Extract the change in the voting areas of a kommune."""
+    kommune_data = change[change['Kommunenummer'] == kommune_id]
+    raw_data = {}
+    for krets, navn, party, before, after, diff in zip(
+            kommune_data['Stemmekretsnummer'],
+            kommune_data['Stemmekretsnavn'],
+            kommune_data['Partinavn'],
+            kommune_data['fra'],
+            kommune_data['til'],
+            kommune_data['endring']):
+        raw_data[krets] = {
+            'krets': navn,
+            'partinavn': party,
+            'fra': before,
+            'til': after,
+            'endring': diff,
+        }
+    all_same = list(raw_data) == ['0000']
+    return raw_data, all_same
+
+
+def get_geojson_data(store, party, kommune_id, from_year, to_year):
+    """Produce geojson data for the change between two elections."""
+    change = swing(store, from_year, to_year, parties=[party])
+    if kommune_id not in set(change['Kommunenummer']):
+        raise ValueError(
+            'No results for "{}" in kommune {} in both {} and {}'.format(
+                party, kommune_id, from_year, to_year
+            )
+        )
+    kommune_navn = change.loc[
+        change['Kommunenummer'] == kommune_id, 'Kommunenavn'
+    ].iloc[0]
+    print('Reading data for "{}" in "{}"'.format(party, kommune_navn))
+    raw_data, all_same = extract_data(change, kommune_id)
+    geojson_data = load_geojson_file(_geojson_file(kommune_id))
+    with stage('annotate'):
+        for feature in geojson_data['features']:
+            properties = feature['properties']
+            if not all_same:
+                krets = str(properties['valgkretsnummer']).rjust(4, '0')
+            else:
+                krets = '0000'
+            properties['krets'] = krets
+            properties['partinavn'] = party
+            if krets not in raw_data:
+                # The area is new, or has changed, since the first year:
+                properties['endring'] = '(-)'
+                continue
+            values = raw_data[krets]
+            properties['endring'] = CHANGE.format(
+                values['endring'], values['fra'], values['til']
+            )
+    map_settings = {
+        'title': kommune_navn,
+        'party': party,
+        'zoom': 10,
+        'value_key': 'endring',
+        'color_map_name': 'RdBu_11',
+        'color_center': 0.0,
+        'legend': (
+            'Endring i oppslutning (prosentpoeng) for {} i {}, '
+            '{}-{}'.format(party, kommune_navn, from_year, to_year)
+        ),
+        'tooltip': create_tool_tip(
+            ('valgkretsnavn', 'partinavn', 'endring'),
+            ('Krets:', 'Parti', 'Endring (prosentpoeng)'),
+            labels=False,
+        )
+    }
+    map_settings.update(
+        get_map_extent([get_extent(_geojson_file(kommune_id), geojson_data)])
+    )
+    return geojson_data, raw_data, map_settings
+
+
+def make_map(store, party, kommune_id, from_year, to_year, settings=None):
+    """Create the map and return the name of the file written."""
+    geojson_data, raw_data, map_settings = get_geojson_data(
+        store, party, kommune_id, from_year, to_year
+    )
+    map_settings.update(settings or {})
+
+    out = 'endring-{}-{}-{}-kommune-{}-{}.html'.format(
+        slugify(party), from_year, to_year, kommune_id,
+        slugify(map_settings['title'])
+    )
+    out = get_output_path(out, settings)
+    produce_choropleth(geojson_data, raw_data, map_settings, output=out)
+    return out
+
+
+def main(store_file, party, kommune_id, from_year, to_year, settings=None):
+    """Read the store and create the map."""
+    store = load_store(store_file)
+    make_map(store, party, kommune_id, from_year, to_year, settings=settings)
+
+
+def add_arguments(parser):
+    """Add the command line arguments for this script."""
+    parser.add_argument(
+        'store',
+        help=(
+            'The file with the results for several elections '
+            '(see election_store.py).'
+        ),
+    )
+    parser.add_argument(
+        'party',
+        help='The party to show the change for.',
+    )
+    parser.add_argument(
+        'kommune_id',
+        help='The identifier for the municipality.',
+    )
+    parser.add_argument(
+        'from_year',
+        type=int,
+        help='The earlier election.',
+    )
+    parser.add_argument(
+        'to_year',
+        type=int,
+        help='The later election.',
+    )
+    add_map_arguments(parser, choropleth=True)
+
+
+def run(args):
+    """Create the map from parsed command line arguments."""
+    with profile_run(args):
+        try:
+            main(
+                args.store,
+                args.party,
+                args.kommune_id,
+                args.from_year,
+                args.to_year,
+                settings=get_map_settings(args),
+            )
+        except ValueError as error:
+            raise SystemExit(str(error))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    add_arguments(PARSER)
+    run(PARSER.parse_args())
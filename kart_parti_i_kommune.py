@@ -1,42 +1,42 @@
 # Copyright (c) 2019, Anders Lervik.
 # Distributed under the MIT License. See LICENSE for more info.
 """Create a map showing voting areas with the results for a party."""
+import argparse
 import pathlib
-import sys
 import pandas as pd
 from slugify import slugify
-import numpy as np
+from hierarchy import hierarchy_from_results, load_hierarchy
 from map_basics import (
-    create_folium_choropleth,
-    load_json_file,
+    produce_choropleth,
+    get_extent,
+    get_map_extent,
+    load_geojson_file,
     create_tool_tip,
     read_csv_results,
+    add_cache_arguments,
+    add_map_arguments,
+    get_map_settings,
+    get_output_path,
+    set_cache_options,
 )
+from profiling import profile_run, profiled, stage
 
 
 VALGKRETS_DIR = pathlib.Path('valgkretser')
 VALGKRETS = 'krets-{}.geojson'
 
 
-def _load_geojson_file(kommune_id):
-    """Load data from a geojson file."""
-    geojson_file = VALGKRETS_DIR.joinpath(
-        VALGKRETS.format(kommune_id)
-    )
-    return load_json_file(geojson_file)
+def _geojson_file(kommune_id):
+    """Return the geojson file with the voting areas in a kommune."""
+    return VALGKRETS_DIR.joinpath(VALGKRETS.format(kommune_id))
 
 
-def get_center(features):
-    """Calculate the geometric center for some features."""
-    averages = []
-    for feature in features:
-        for polygon in feature['geometry']['coordinates']:
-            coord = np.array(polygon)
-            averages.append(np.average(coord, axis=0))
-    averages = np.array(averages)
-    return np.average(averages, axis=0)
+def _load_geojson_file(kommune_id):
+    """Load data from a geojson file."""
+    return load_geojson_file(_geojson_file(kommune_id))
 
 
+@profiled('extract')
 def extract_data(results, kommune_id, party):
     """Extract the required data."""
     kommune_data = results[results['Kommunenummer'] == kommune_id]
@@ -55,31 +55,29 @@ def extract_data(results, kommune_id, party):
     return raw_data, all_same
 
 
-def get_geojson_data(result_file, party, kommune_id):
-    """Read in result files are produce corresponding geojson data."""
-    results = read_csv_results(result_file)
-    kommune_data = results[results['Kommunenummer'] == kommune_id]
-    kommune_navn = kommune_data['Kommunenavn'].tolist()[0]
+def get_geojson_data(results, party, kommune_id, hierarchy):
+    """Produce geojson data for the given results."""
+    kommune_navn = hierarchy.kommune_navn(kommune_id)
     print('Reading data for "{}" in "{}"'.format(party, kommune_navn))
     raw_data, all_same = extract_data(results, kommune_id, party)
     geojson_data = _load_geojson_file(kommune_id)
     # Check that we have data for all features:
-    for feature in geojson_data['features']:
-        if not all_same:
-            krets = str(
-                feature['properties']['valgkretsnummer']
-            ).rjust(4, '0')
-        else:
-            krets = '0000'
-        feature['properties']['oppslutning'] = '({:4.2f} %)'.format(
-            raw_data[krets]['oppslutning']
-        )
-        feature['properties']['partinavn'] = raw_data[krets]['partinavn']
-        feature['properties']['krets'] = krets
+    with stage('annotate'):
+        for feature in geojson_data['features']:
+            if not all_same:
+                krets = str(
+                    feature['properties']['valgkretsnummer']
+                ).rjust(4, '0')
+            else:
+                krets = '0000'
+            feature['properties']['oppslutning'] = '({:4.2f} %)'.format(
+                raw_data[krets]['oppslutning']
+            )
+            feature['properties']['partinavn'] = raw_data[krets]['partinavn']
+            feature['properties']['krets'] = krets
     map_settings = {
         'title': kommune_navn,
         'party': party,
-        'center': get_center(geojson_data['features'])[::-1],
         'zoom': 10,
         'value_key': 'oppslutning',
         'tooltip': create_tool_tip(
@@ -88,22 +86,71 @@ def get_geojson_data(result_file, party, kommune_id):
             labels=False,
         )
     }
+    map_settings.update(
+        get_map_extent([get_extent(_geojson_file(kommune_id), geojson_data)])
+    )
     return geojson_data, raw_data, map_settings
 
 
-def main(result_file, party, kommune_id):
-    """Read input file and create the map."""
-    geojson_data, results, map_settings = get_geojson_data(
-        result_file, party, kommune_id
+def make_map(results, party, kommune_id, settings=None, hierarchy=None):
+    """Create the map and return the name of the file written."""
+    if hierarchy is None:
+        hierarchy = hierarchy_from_results(results)
+    geojson_data, raw_data, map_settings = get_geojson_data(
+        results, party, kommune_id, hierarchy
     )
-    the_map = create_folium_choropleth(geojson_data, results, map_settings)
+    map_settings.update(settings or {})
 
     out = 'stemmekrester-{}-kommune-{}-{}.html'.format(
         slugify(party), kommune_id, slugify(map_settings['title'])
     )
-    print('Writing map to "{}"'.format(out))
-    the_map.save(out)
+    out = get_output_path(out, settings)
+    produce_choropleth(geojson_data, raw_data, map_settings, output=out)
+    return out
+
+
+def main(result_file, party, kommune_id, settings=None):
+    """Read input files and create the map."""
+    results = read_csv_results(result_file)
+    hierarchy = load_hierarchy(result_file, results=results)
+    if kommune_id not in hierarchy.kommuner:
+        raise SystemExit('Unknown kommune "{}"'.format(kommune_id))
+    make_map(
+        results, party, kommune_id, settings=settings, hierarchy=hierarchy
+    )
+
+
+def add_arguments(parser):
+    """Add the command line arguments for this script."""
+    parser.add_argument(
+        'result_file',
+        help='The csv file with the election results.',
+    )
+    parser.add_argument(
+        'party',
+        help='The party to show the results for.',
+    )
+    parser.add_argument(
+        'kommune_id',
+        help='The identifier for the municipality.',
+    )
+    add_cache_arguments(parser)
+    add_map_arguments(parser, choropleth=True)
+
+
+def run(args):
+    """Create the map from parsed command line arguments."""
+    set_cache_options(args)
+    with profile_run(args):
+        main(
+            args.result_file,
+            args.party,
+            args.kommune_id,
+            settings=get_map_settings(args),
+        )
 
 
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2], sys.argv[3])
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    add_arguments(PARSER)
+    run(PARSER.parse_args())
@@ -1,16 +1,26 @@
 # Copyright (c) 2019, Anders Lervik.
 # Distributed under the MIT License. See LICENSE for more info.
 """Create a map showing the largest party in different voting areas."""
+import argparse
 import pathlib
-import sys
-import numpy as np
 from slugify import slugify
+from hierarchy import hierarchy_from_results, load_hierarchy
 from map_basics import (
     produce_map,
-    load_json_file,
+    get_extent,
+    get_map_extent,
+    load_geojson_files,
     create_tool_tip,
     read_csv_results,
+    add_cache_arguments,
+    add_map_arguments,
+    get_map_settings,
+    get_output_path,
+    is_streamed,
+    set_cache_options,
 )
+from profiling import profile_run, profiled
+from winners import area_dict, find_winners
 
 
 # Define paths to the raw geojson files:
@@ -18,86 +28,191 @@ KOMMUNE_DIR = pathlib.Path('kommuner')
 KOMMUNE = 'kommune-{}.geojson'
 
 
-def _add_coordinates(feature, coordinates):
-    """Add coordinates from a feature."""
-    coords = []
-    for polygon in feature['geometry']['coordinates']:
-        for row in polygon:
-            coords.append(row)
-    coordinates.append(np.average(coords, axis=0))
-
-
-def extract_data(results, fylke):
-    """Extract the data we want from the results."""
-    data = results[results['Fylkenummer'] == fylke]
-    fylke_data = data.groupby(['Kommunenummer'])
-    fylke_navn = data['Fylkenavn'].tolist()[0]
-    area = {}
-    for name, group in fylke_data:
-        idx = group['Oppslutning prosentvis'].idxmax()
-        maxi = results.iloc[idx, :]
-        area[name] = {
-            'partinavn': maxi['Partinavn'],
-            'oppslutning': maxi['Oppslutning prosentvis'],
-            'kommune': maxi['Kommunenavn'],
-            'fylke': maxi['Fylkenavn'],
-        }
-    return area, fylke_navn
-
-
-def get_geojson_data(raw_data, fylker):
-    """Read in result files are produce corresponding geojson data."""
-    results = read_csv_results(raw_data)
+@profiled('extract')
+def extract_data(winners, fylke):
+    """Extract the data we want from the winners."""
+    data = winners.loc[fylke]
+    return area_dict(
+        data,
+        {
+            'partinavn': 'partinavn',
+            'oppslutning': 'oppslutning',
+            'Kommunenavn': 'kommune',
+            'Fylkenavn': 'fylke',
+        },
+    )
+
+
+def _get_kommuner(results, fylker, hierarchy):
+    """Find the winner in each kommune in the fylker.
 
-    all_geojson_data = []
-    coordinates = []
-    tooltips = []
+    Returns
+    -------
+    kommuner : list of tuples
+        The id and the results for each kommune.
+    fylker_navn : list of strings
+        The names of the fylker.
+
+    """
+    winners = find_winners(
+        results,
+        ('Fylkenummer', 'Kommunenummer'),
+        columns=('Kommunenavn', 'Fylkenavn'),
+    )
     fylker_navn = []
+    kommuner = []
     for fylke in fylker:
-        area, fylke_navn = extract_data(results, fylke)
+        area = extract_data(winners, fylke)
+        fylke_navn = hierarchy.fylke_navn(fylke)
         print('Reading for "{}"'.format(fylke_navn))
         fylker_navn.append(fylke_navn)
-        for kommune, kommune_data in area.items():
-            # Read the geojson file for this kommune:
-            geojson_data = load_json_file(
-                KOMMUNE_DIR.joinpath(KOMMUNE.format(kommune))
-            )
-            # Add results to the features:
-            for feature in geojson_data['features']:
-                feature['properties']['partinavn'] = kommune_data['partinavn']
-                feature['properties']['oppslutning'] = '({:4.2f} %)'.format(
-                    kommune_data['oppslutning']
-                )
-                feature['properties']['kommunenavn'] = kommune_data['kommune']
-                _add_coordinates(feature, coordinates)
-            all_geojson_data.append((kommune_data['kommune'], geojson_data))
-            tooltips.append(
-                create_tool_tip(
-                    ('kommunenavn', 'partinavn', 'oppslutning'),
-                    ('Kommune:', 'Største parti:', 'Oppslutning (%):'),
-                    labels=False,
-                )
-            )
-    map_settings = {
-        'center': np.average(coordinates, axis=0)[::-1],
+        kommuner.extend(area.items())
+    return kommuner, fylker_navn
+
+
+def _geojson_files(kommuner):
+    """Return the geojson files for the given kommuner."""
+    return [
+        KOMMUNE_DIR.joinpath(KOMMUNE.format(kommune))
+        for kommune, _ in kommuner
+    ]
+
+
+@profiled('annotate')
+def _annotate(kommune_data, geojson_data):
+    """Add the results for a kommune to its features."""
+    for feature in geojson_data['features']:
+        properties = feature['properties']
+        properties['partinavn'] = kommune_data['partinavn']
+        properties['oppslutning'] = '({:4.2f} %)'.format(
+            kommune_data['oppslutning']
+        )
+        properties['kommunenavn'] = kommune_data['kommune']
+
+
+def _get_map_settings(kommuner):
+    """Return the settings for a map of the given kommuner."""
+    tooltips = [
+        create_tool_tip(
+            ('kommunenavn', 'partinavn', 'oppslutning'),
+            ('Kommune:', 'Største parti:', 'Oppslutning (%):'),
+            labels=False,
+        )
+        for _ in kommuner
+    ]
+    return {
         'zoom': 10,
         'tooltip': tooltips,
+        # Kommune names are not unique, the layers are told apart by id:
+        'layer_keys': [kommune for kommune, _ in kommuner],
     }
+
+
+def get_geojson_data(results, fylker, hierarchy):
+    """Produce geojson data for the given results."""
+    kommuner, fylker_navn = _get_kommuner(results, fylker, hierarchy)
+    geojson_files = _geojson_files(kommuner)
+    all_geojson_data = [None] * len(kommuner)
+    extents = [None] * len(kommuner)
+    # The kommuner are annotated as soon as their files are loaded:
+    for i, geojson_data in load_geojson_files(geojson_files):
+        kommune_data = kommuner[i][1]
+        extents[i] = get_extent(geojson_files[i], geojson_data)
+        _annotate(kommune_data, geojson_data)
+        all_geojson_data[i] = (kommune_data['kommune'], geojson_data)
+    map_settings = _get_map_settings(kommuner)
+    map_settings.update(get_map_extent(extents))
     return all_geojson_data, map_settings, fylker_navn
 
 
-def main(raw_data, fylker):
-    """Read input files and create the map."""
-    geojson_data, map_settings, fylker_navn = get_geojson_data(
-        raw_data, fylker
-    )
+def iter_geojson_data(kommuner, map_settings):
+    """Produce geojson data for some kommuner, one kommune at a time.
+
+    Parameters
+    ----------
+    kommuner : list of tuples
+        The id and the results for each kommune.
+    map_settings : dict
+        Settings for the map. When all layers have been produced, the
+        center and bounds for the map are added here.
+
+    Yields
+    ------
+    layer : tuple
+        The (name, geojson-dict) layer for each kommune, in order.
+
+    """
+    geojson_files = _geojson_files(kommuner)
+    extents = []
+    for i, geojson_data in load_geojson_files(geojson_files, ordered=True):
+        kommune_data = kommuner[i][1]
+        extents.append(get_extent(geojson_files[i], geojson_data))
+        _annotate(kommune_data, geojson_data)
+        yield kommune_data['kommune'], geojson_data
+    map_settings.update(get_map_extent(extents))
+
+
+def make_map(results, fylker, settings=None, hierarchy=None):
+    """Create the map and return the name of the file written."""
+    if hierarchy is None:
+        hierarchy = hierarchy_from_results(results)
+    if is_streamed(settings):
+        # The layers are produced while the map is written:
+        kommuner, fylker_navn = _get_kommuner(results, fylker, hierarchy)
+        map_settings = _get_map_settings(kommuner)
+        geojson_data = iter_geojson_data(kommuner, map_settings)
+    else:
+        geojson_data, map_settings, fylker_navn = get_geojson_data(
+            results, fylker, hierarchy
+        )
     idx = '-'.join(['{}'.format(i) for i in fylker])
     navn = '-'.join([slugify(i) for i in fylker_navn])
     out = 'resultat-{}-{}.html'.format(
         idx, navn
     )
+    out = get_output_path(out, settings)
+    map_settings.update(settings or {})
     produce_map(geojson_data, map_settings, output=out)
+    return out
+
+
+def main(raw_data, fylker, settings=None):
+    """Read input files and create the map."""
+    results = read_csv_results(raw_data)
+    hierarchy = load_hierarchy(raw_data, results=results)
+    for fylke in fylker:
+        if fylke not in hierarchy.fylker:
+            raise SystemExit('Unknown fylke "{}"'.format(fylke))
+    make_map(results, fylker, settings=settings, hierarchy=hierarchy)
+
+
+def add_arguments(parser):
+    """Add the command line arguments for this script."""
+    parser.add_argument(
+        'raw_data',
+        help='The csv file with the election results.',
+    )
+    parser.add_argument(
+        'fylker',
+        nargs='+',
+        help='Identifiers for the counties to show.',
+    )
+    add_cache_arguments(parser)
+    add_map_arguments(parser)
+
+
+def run(args):
+    """Create the map from parsed command line arguments."""
+    set_cache_options(args)
+    with profile_run(args):
+        main(
+            args.raw_data,
+            args.fylker,
+            settings=get_map_settings(args),
+        )
 
 
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2:])
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    add_arguments(PARSER)
+    run(PARSER.parse_args())
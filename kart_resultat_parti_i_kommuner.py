@@ -1,15 +1,25 @@
 # Copyright (c) 2019, Anders Lervik.
 # Distributed under the MIT License. See LICENSE for more info.
 """Create a map showing for which municipalities a given party is largest."""
+import argparse
 import pathlib
-import sys
 from slugify import slugify
 from map_basics import (
     produce_map,
-    load_json_file,
+    get_extent,
+    get_map_extent,
+    load_geojson_file,
     create_tool_tip,
     read_csv_results,
+    add_cache_arguments,
+    add_map_arguments,
+    get_map_settings,
+    get_output_path,
+    is_streamed,
+    set_cache_options,
 )
+from profiling import profile_run, profiled, stage
+from winners import area_dict, find_winners
 
 
 # Define paths to the raw geojson files:
@@ -17,78 +27,178 @@ KOMMUNE_DIR = pathlib.Path('kommuner')
 KOMMUNE_KRETS = 'kommune-{}.geojson'
 
 
-def extract_data(results, party):
-    """Extract the data we want from the results."""
-    area = {}
-    alle_kommuner = [
-        i for i in results.groupby(['Kommunenummer']).groups.keys()
-    ]
-    for kommune in alle_kommuner:
-        kommune_data = results[results['Kommunenummer'] == kommune]
-        idx = kommune_data['Oppslutning prosentvis'].idxmax()
-        row = results.iloc[idx, :]
-        if row['Partinavn'] == party:
-            area[kommune] = {
-                'partinavn': row['Partinavn'],
-                'oppslutning': row['Oppslutning prosentvis'],
-                'kommunenavn': row['Kommunenavn']
-            }
-    return area
-
-
-def get_geojson_data(raw_data, parties):
-    """Read in result files and produce corresponding geojson data."""
-    results = read_csv_results(raw_data)
-    all_geojson_data = []
-    tooltip = []
+@profiled('extract')
+def extract_data(winners, party):
+    """Extract the data we want from the winners."""
+    return area_dict(
+        winners[winners['partinavn'] == party],
+        {
+            'partinavn': 'partinavn',
+            'oppslutning': 'oppslutning',
+            'Kommunenavn': 'kommunenavn',
+        },
+    )
+
+
+def _create_tool_tip():
+    """Return the tooltip for a layer of kommuner."""
+    return create_tool_tip(
+        ('kommunenavn', 'partinavn', 'oppslutning'),
+        ('Kommune:', 'Største parti:', 'Oppslutning:'),
+        labels=False,
+    )
+
+
+def _iter_kommuner(results, parties, extents):
+    """Load the kommuner won by each party, one at a time.
 
+    Parameters
+    ----------
+    results : object like pandas.DataFrame
+        The results.
+    parties : list of strings
+        The parties to show the kommuner for.
+    extents : list
+        The extent of each kommune is added to this list.
+
+    Yields
+    ------
+    party : string
+        The party which won the kommune.
+    geojson_data : dict
+        The geojson data for the kommune, with the results added.
+
+    """
+    winners = find_winners(
+        results, ('Kommunenummer',), columns=('Kommunenavn',)
+    )
     for party in parties:
         print('Adding for party "{}"'.format(party))
-        new_data = {'features': []}
-        area = extract_data(results, party)
+        area = extract_data(winners, party)
         for kommune, kommune_data in area.items():
             print('Reading data for "{}"'.format(kommune_data['kommunenavn']))
-            geojson_data = load_json_file(
-                KOMMUNE_DIR.joinpath(KOMMUNE_KRETS.format(kommune))
-            )
-            for key in ('crs', 'type'):
-                if key not in new_data:
-                    new_data[key] = geojson_data[key]
-            for feature in geojson_data['features']:
-                feature['properties']['partinavn'] = kommune_data['partinavn']
-                feature['properties']['kommunenavn'] = (
-                    kommune_data['kommunenavn']
-                )
-                feature['properties']['oppslutning'] = '{:4.2f} %'.format(
-                    kommune_data['oppslutning']
-                )
-                new_data['features'].append(feature)
+            geojson_file = KOMMUNE_DIR.joinpath(KOMMUNE_KRETS.format(kommune))
+            geojson_data = load_geojson_file(geojson_file)
+            extents.append(get_extent(geojson_file, geojson_data))
+            with stage('annotate'):
+                for feature in geojson_data['features']:
+                    properties = feature['properties']
+                    properties['partinavn'] = kommune_data['partinavn']
+                    properties['kommunenavn'] = kommune_data['kommunenavn']
+                    properties['oppslutning'] = '{:4.2f} %'.format(
+                        kommune_data['oppslutning']
+                    )
+            yield party, geojson_data
+
+
+def get_geojson_data(results, parties):
+    """Produce geojson data for the given results."""
+    all_geojson_data = []
+    tooltip = []
+    extents = []
+    layers = {party: {'features': []} for party in parties}
+    for party, geojson_data in _iter_kommuner(results, parties, extents):
+        new_data = layers[party]
+        for key in ('crs', 'type'):
+            if key not in new_data:
+                new_data[key] = geojson_data[key]
+        new_data['features'].extend(geojson_data['features'])
+    for party, new_data in layers.items():
         if new_data['features']:
             all_geojson_data.append((party, new_data))
-            tooltip.append(
-                create_tool_tip(
-                    ('kommunenavn', 'partinavn', 'oppslutning'),
-                    ('Kommune:', 'Største parti:', 'Oppslutning:'),
-                    labels=False,
-                )
-            )
+            tooltip.append(_create_tool_tip())
     map_settings = {
         'center': [63.0, 10.0],
         'zoom': 10,
         'tooltip': tooltip,
     }
+    map_settings.update(get_map_extent(extents))
     return all_geojson_data, map_settings
 
 
-def main(raw_data, parties):
-    """Read input files and create the map."""
-    geojson_layers, map_settings = get_geojson_data(raw_data, parties)
+def iter_geojson_data(results, parties, map_settings):
+    """Produce geojson data for the given results, one kommune at a time.
+
+    Parameters
+    ----------
+    results : object like pandas.DataFrame
+        The results.
+    parties : list of strings
+        The parties to show the kommuner for.
+    map_settings : dict
+        Settings for the map. When all layers have been produced, the
+        center and bounds for the map are added here.
+
+    Yields
+    ------
+    layer : tuple
+        The (name, geojson-dict) for a kommune, named by the party
+        which won it. The parts of a layer are given with the same
+        name, see ``layer_parts`` in
+        :py:func:`map_basics.produce_streamed_map`.
+
+    """
+    extents = []
+    yield from _iter_kommuner(results, parties, extents)
+    map_settings.update(get_map_extent(extents))
+
+
+def make_map(results, parties, settings=None):
+    """Create the map and return the name of the file written."""
+    if is_streamed(settings):
+        # The layers are produced while the map is written:
+        map_settings = {
+            'center': [63.0, 10.0],
+            'zoom': 10,
+            'tooltip': _create_tool_tip(),
+            'layer_parts': True,
+        }
+        geojson_layers = iter_geojson_data(results, parties, map_settings)
+    else:
+        geojson_layers, map_settings = get_geojson_data(results, parties)
     if len(parties) == 1:
         out = 'kommuner-{}.html'.format(slugify(parties[0]))
     else:
         out = 'map-partier-kommuner.html'
+    out = get_output_path(out, settings)
+    map_settings.update(settings or {})
     produce_map(geojson_layers, map_settings, output=out)
+    return out
+
+
+def main(raw_data, parties, settings=None):
+    """Read input files and create the map."""
+    results = read_csv_results(raw_data)
+    make_map(results, parties, settings=settings)
+
+
+def add_arguments(parser):
+    """Add the command line arguments for this script."""
+    parser.add_argument(
+        'raw_data',
+        help='The csv file with the election results.',
+    )
+    parser.add_argument(
+        'parties',
+        nargs='+',
+        help='The parties to show.',
+    )
+    add_cache_arguments(parser)
+    add_map_arguments(parser)
+
+
+def run(args):
+    """Create the map from parsed command line arguments."""
+    set_cache_options(args)
+    with profile_run(args):
+        main(
+            args.raw_data,
+            args.parties,
+            settings=get_map_settings(args),
+        )
 
 
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2:])
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    add_arguments(PARSER)
+    run(PARSER.parse_args())
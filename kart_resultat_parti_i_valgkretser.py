@@ -1,28 +1,36 @@
 # Copyright (c) 2019, Anders Lervik.
 # Distributed under the MIT License. See LICENSE for more info.
 """Create a map showing voting areas where a given party is largest."""
+import argparse
 import pathlib
-import sys
 from slugify import slugify
+from hierarchy import kommuner_with_fylker
 from map_basics import (
     produce_map,
     COLORS_PARTY,
-    load_json_file,
+    get_extent,
+    get_map_extent,
+    load_geojson_files,
     create_tool_tip,
     read_csv_results,
+    add_cache_arguments,
+    add_map_arguments,
+    get_map_settings,
+    get_output_path,
+    is_streamed,
+    set_cache_options,
 )
+from profiling import profile_run, profiled
+from winners import area_dict, find_winners
 
 
 VALGKRETS_DIR = pathlib.Path('valgkretser')
 VALGKRETS = 'krets-{}.geojson'
 
 
-def _load_geojson_file(kommune_id):
-    """Load data from a geojson file."""
-    geojson_file = VALGKRETS_DIR.joinpath(
-        VALGKRETS.format(kommune_id)
-    )
-    return load_json_file(geojson_file)
+def _geojson_file(kommune_id):
+    """Return the geojson file with the voting areas in a kommune."""
+    return VALGKRETS_DIR.joinpath(VALGKRETS.format(kommune_id))
 
 
 def _add_dict_keys(keys, from_dict, others):
@@ -33,28 +41,38 @@ def _add_dict_keys(keys, from_dict, others):
                 to_dict[key] = from_dict[key]
 
 
-def extract_data(results, party):
-    """Extract the data we want from the results."""
+@profiled('extract')
+def extract_data(winners, parties):
+    """Extract the voting areas won by the given parties.
+
+    Parameters
+    ----------
+    winners : object like pandas.DataFrame
+        The winners, indexed by kommune and krets.
+    parties : list of strings
+        The parties we are extracting the areas for.
+
+    Returns
+    -------
+    area : dict of dicts
+        The winning party and oppslutning for the voting areas won
+        by one of the parties, grouped by the kommune.
+
+    """
     area = {}
-    alle_kommuner = [
-        i for i in results.groupby(['Kommunenummer']).groups.keys()
-    ]
-    for kommune in alle_kommuner:
-        kommune_data = results[results['Kommunenummer'] == kommune].groupby(
-            ['Stemmekretsnummer']
-        )
-        for name, group in kommune_data:
-            idx = group['Oppslutning prosentvis'].idxmax()
-            maxi = results.iloc[idx, :]
-            if maxi['Partinavn'] == party:
-                if kommune not in area:
-                    area[kommune] = {}
-                area[kommune][name] = {
-                    'partinavn': maxi['Partinavn'],
-                    'oppslutning': maxi['Oppslutning prosentvis'],
-                    'krets': maxi['Stemmekretsnavn'],
-                    'kommune_navn': maxi['Kommunenavn']
-                }
+    selected = area_dict(
+        winners[winners['partinavn'].isin(parties)],
+        {
+            'partinavn': 'partinavn',
+            'oppslutning': 'oppslutning',
+            'Stemmekretsnavn': 'krets',
+            'Kommunenavn': 'kommune_navn',
+        },
+    )
+    for (kommune, krets), krets_data in selected.items():
+        if kommune not in area:
+            area[kommune] = {}
+        area[kommune][krets] = krets_data
     return area
 
 
@@ -66,7 +84,8 @@ def _same_for_all(kretser):
     return False, None
 
 
-def add_to_features(features, kretser, party):
+@profiled('annotate')
+def add_to_features(features, kretser):
     """Add data from the areas to the features."""
     same_all, krets_data = _same_for_all(kretser)
     for feature in features:
@@ -80,7 +99,7 @@ def add_to_features(features, kretser, party):
                 krets_data = None
         if krets_data is not None:
             feature['properties']['use_this_feature'] = True
-            feature['properties']['partinavn'] = party
+            feature['properties']['partinavn'] = krets_data['partinavn']
             feature['properties']['oppslutning'] = (
                 '({:4.2f} %)'.format(
                     krets_data['oppslutning']
@@ -88,62 +107,208 @@ def add_to_features(features, kretser, party):
             )
 
 
-def get_geojson_data(raw_data, parties):
-    """Read in result files are produce corresponding geojson data."""
-    results = read_csv_results(raw_data)
+def _create_tool_tip():
+    """Return the tooltip for a layer of voting areas."""
+    return create_tool_tip(
+        ('valgkretsnavn', 'partinavn', 'oppslutning'),
+        ('Valgkrets:', 'Største parti:', 'Oppslutning (%)'),
+        labels=False,
+    )
+
+
+def _get_area(results, parties, kommuner=None):
+    """Find the voting areas won by the parties, by kommune."""
+    winners = find_winners(
+        results,
+        ('Kommunenummer', 'Stemmekretsnummer'),
+        columns=('Stemmekretsnavn', 'Kommunenavn'),
+    )
+    print('Adding for parties: {}'.format(', '.join(parties)))
+    area = extract_data(winners, parties)
+    if kommuner is not None:
+        area = {key: val for key, val in area.items() if key in kommuner}
+    return area
+
+
+def _layer_name(feature):
+    """Return the layer a feature won by a party goes to."""
+    party = feature['properties']['partinavn']
+    return party if party in COLORS_PARTY else 'Andre'
+
+
+def get_geojson_data(results, parties, kommuner=None):
+    """Produce geojson data for the given results.
+
+    Parameters
+    ----------
+    results : object like pandas.DataFrame
+        The results.
+    parties : list of strings
+        The parties to show the voting areas for.
+    kommuner : list of strings, optional
+        If given, only the voting areas in these kommuner are shown.
+
+    """
     all_geojson_data = []
+    layers = {party: {'features': []} for party in parties}
     andre = {'features': []}
     tooltip = []
+    extents = []
 
-    for party in parties:
-        print('Adding for party "{}"'.format(party))
-        new_data = {'features': []}
-        area = extract_data(results, party)
-        for kommune, kretser in area.items():
-            geojson_data = _load_geojson_file(kommune)
-            _add_dict_keys(('crs', 'type'), geojson_data, (new_data, andre))
-            add_to_features(geojson_data['features'], kretser, party)
-            for feature in geojson_data['features']:
-                if 'use_this_feature' in feature['properties']:
-                    if party in COLORS_PARTY:
-                        new_data['features'].append(feature)
-                    else:
-                        andre['features'].append(feature)
+    area = _get_area(results, parties, kommuner=kommuner)
+    # Load each kommune once, and annotate it as soon as it is loaded:
+    kommuner = list(area)
+    loaded = [None] * len(kommuner)
+    for i, geojson_data in load_geojson_files(
+            [_geojson_file(kommune) for kommune in kommuner]):
+        kommune = kommuner[i]
+        extents.append(get_extent(_geojson_file(kommune), geojson_data))
+        _add_dict_keys(
+            ('crs', 'type'), geojson_data, list(layers.values()) + [andre]
+        )
+        add_to_features(geojson_data['features'], area[kommune])
+        loaded[i] = geojson_data
+    # Sort the features by the winner, keeping the order of the kommuner:
+    for geojson_data in loaded:
+        for feature in geojson_data['features']:
+            if 'use_this_feature' in feature['properties']:
+                party = feature['properties']['partinavn']
+                if party in COLORS_PARTY:
+                    layers[party]['features'].append(feature)
+                else:
+                    andre['features'].append(feature)
+    for party, new_data in layers.items():
         if new_data['features'] and party in COLORS_PARTY:
             all_geojson_data.append((party, new_data))
-            tooltip.append(
-                create_tool_tip(
-                    ('valgkretsnavn', 'partinavn', 'oppslutning'),
-                    ('Valgkrets:', 'Største parti:', 'Oppslutning (%)'),
-                    labels=False,
-                )
-            )
+            tooltip.append(_create_tool_tip())
     if andre['features']:
         all_geojson_data.append(('Andre', andre))
-        tooltip.append(
-            create_tool_tip(
-                ('valgkretsnavn', 'partinavn', 'oppslutning'),
-                ('Valgkrets:', 'Største parti:', 'Oppslutning (%)'),
-                labels=False,
-            )
-        )
+        tooltip.append(_create_tool_tip())
     map_settings = {
         'center': [63.446827, 10.421906],
         'zoom': 10,
         'tooltip': tooltip,
     }
+    map_settings.update(get_map_extent(extents))
     return all_geojson_data, map_settings
 
 
-def main(raw_data, parties):
-    """Read input files and create the map."""
-    geojson_data, map_settings = get_geojson_data(raw_data, parties)
+def iter_geojson_data(results, parties, map_settings, kommuner=None):
+    """Produce geojson data for the given results, one kommune at a time.
+
+    Parameters
+    ----------
+    results : object like pandas.DataFrame
+        The results.
+    parties : list of strings
+        The parties to show the voting areas for.
+    map_settings : dict
+        Settings for the map. When all layers have been produced, the
+        center and bounds for the map are added here.
+    kommuner : list of strings, optional
+        If given, only the voting areas in these kommuner are shown.
+
+    Yields
+    ------
+    layer : tuple
+        The (name, geojson-dict) with the voting areas in a kommune
+        won by a party. The parts of a layer are given with the same
+        name, see ``layer_parts`` in
+        :py:func:`map_basics.produce_streamed_map`.
+
+    """
+    area = _get_area(results, parties, kommuner=kommuner)
+    kommuner = list(area)
+    extents = []
+    for i, geojson_data in load_geojson_files(
+            [_geojson_file(kommune) for kommune in kommuner], ordered=True):
+        kommune = kommuner[i]
+        extents.append(get_extent(_geojson_file(kommune), geojson_data))
+        add_to_features(geojson_data['features'], area[kommune])
+        groups = {}
+        for feature in geojson_data['features']:
+            if 'use_this_feature' in feature['properties']:
+                groups.setdefault(_layer_name(feature), []).append(feature)
+        for name, features in groups.items():
+            yield name, dict(geojson_data, features=features)
+    map_settings.update(get_map_extent(extents))
+
+
+def make_map(results, parties, settings=None, kommuner=None):
+    """Create the map and return the name of the file written."""
+    if is_streamed(settings):
+        # The layers are produced while the map is written:
+        map_settings = {
+            'center': [63.446827, 10.421906],
+            'zoom': 10,
+            'tooltip': _create_tool_tip(),
+            'layer_parts': True,
+        }
+        geojson_data = iter_geojson_data(
+            results, parties, map_settings, kommuner=kommuner
+        )
+    else:
+        geojson_data, map_settings = get_geojson_data(
+            results, parties, kommuner=kommuner
+        )
     if len(parties) == 1:
         out = 'valgkretser-{}.html'.format(slugify(parties[0]))
     else:
         out = 'map-partier-valgkretser.html'
+    out = get_output_path(out, settings)
+    map_settings.update(settings or {})
     produce_map(geojson_data, map_settings, output=out)
+    return out
+
+
+def main(raw_data, parties, settings=None, fylker=None):
+    """Read input files and create the map."""
+    results = read_csv_results(raw_data)
+    kommuner = None
+    if fylker:
+        kommuner = kommuner_with_fylker(
+            raw_data, [], fylker, results=results
+        )
+    make_map(results, parties, settings=settings, kommuner=kommuner)
+
+
+def add_arguments(parser):
+    """Add the command line arguments for this script."""
+    parser.add_argument(
+        'raw_data',
+        help='The csv file with the election results.',
+    )
+    parser.add_argument(
+        'parties',
+        nargs='+',
+        help='The parties to show.',
+    )
+    parser.add_argument(
+        '--fylke',
+        action='append',
+        default=[],
+        help=(
+            'Only show the voting areas in the kommuner in this fylke. '
+            'Can be given more than once.'
+        ),
+    )
+    add_cache_arguments(parser)
+    add_map_arguments(parser)
+
+
+def run(args):
+    """Create the map from parsed command line arguments."""
+    set_cache_options(args)
+    with profile_run(args):
+        main(
+            args.raw_data,
+            args.parties,
+            settings=get_map_settings(args),
+            fylker=args.fylke,
+        )
 
 
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2:])
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    add_arguments(PARSER)
+    run(PARSER.parse_args())
@@ -1,108 +1,379 @@
 # Copyright (c) 2019, Anders Lervik.
 # Distributed under the MIT License. See LICENSE for more info.
 """Create a map showing the largest party in different voting areas."""
+import argparse
 import pathlib
-import sys
-import numpy as np
+import threading
+import time
 from map_basics import (
     produce_map,
-    load_json_file,
+    get_page_settings,
+    get_extent,
+    get_map_extent,
+    load_geojson_files,
     create_tool_tip,
     read_csv_results,
+    add_cache_arguments,
+    add_map_arguments,
+    get_map_settings,
+    get_output_path,
+    is_streamed,
+    set_cache_options,
 )
+from hierarchy import (
+    add_fylke_argument,
+    hierarchy_from_results,
+    kommuner_with_fylker,
+    load_hierarchy,
+)
+from map_server import create_server, write_index, write_layer, write_site
+from simplify import simplify_layers
+from slim import kept_properties, slim_layers
+from watch import changed_kommuner, watch_results
+from profiling import profile_run, profiled
+from winners import area_dict, find_winners
 
 
 VALGKRETS_DIR = pathlib.Path('valgkretser')
 VALGKRETS = 'krets-{}.geojson'
 
 
-def _add_coordinates(feature, coordinates):
-    """Add coordinates from a feature."""
-    coords = []
-    for polygon in feature['geometry']['coordinates']:
-        for row in polygon:
-            coords.append(row)
-    coordinates.append(np.average(coords, axis=0))
+# Shown for voting areas without results (e.g. not counted yet):
+NOT_COUNTED = 'Ikke opptalt'
 
 
-def extract_data(results, kommune):
-    """Extract the data we want from the results."""
-    kommune_data = results[results['Kommunenummer'] == kommune].groupby(
-        ['Stemmekretsnummer']
+@profiled('extract')
+def extract_data(winners, kommune):
+    """Extract the data we want from the winners."""
+    area = area_dict(
+        winners.loc[kommune],
+        {
+            'partinavn': 'partinavn',
+            'oppslutning': 'oppslutning',
+            'Stemmekretsnavn': 'krets',
+        },
     )
-    area = {}
-    kretser = []
-    for name, group in kommune_data:
-        idx = group['Oppslutning prosentvis'].idxmax()
-        maxi = results.iloc[idx, :]
-        area[name] = {
-            'partinavn': maxi['Partinavn'],
-            'oppslutning': maxi['Oppslutning prosentvis'],
-            'krets': maxi['Stemmekretsnavn'],
-        }
-        kretser.append(maxi['Stemmekretsnavn'])
+    kretser = [i['krets'] for i in area.values()]
     all_same = len(kretser) == 1 and kretser[0] == 'Hele kommunen'
     return area, all_same
 
 
-def get_geojson_data(raw_data, kommuner):
-    """Read in result files are produce corresponding geojson data."""
-    results = read_csv_results(raw_data)
-
-    all_geojson_data = []
-    coordinates = []
-    tooltips = []
-    for kommune in kommuner:
-        # Get results for each voting area:
-        kommune_navn = results[
-            results['Kommunenummer'] == kommune
-        ]['Kommunenavn'].tolist()[0]
-        print('Reading data for "{}"'.format(kommune_navn))
-        area, all_same = extract_data(results, kommune)
-        # Read the geojson file for this kommune:
-        geojson_data = load_json_file(
-            VALGKRETS_DIR.joinpath(VALGKRETS.format(kommune))
+@profiled('annotate')
+def add_results(geojson_data, area, all_same):
+    """Add the results for each voting area to the features."""
+    for feature in geojson_data['features']:
+        if not all_same:
+            krets = str(
+                feature['properties']['valgkretsnummer']
+            ).rjust(4, '0')
+        else:
+            krets = '0000'
+        if krets not in area:
+            feature['properties']['partinavn'] = NOT_COUNTED
+            feature['properties']['oppslutning'] = ''
+            continue
+        feature['properties']['partinavn'] = area[krets]['partinavn']
+        feature['properties']['oppslutning'] = '({:4.2f} %)'.format(
+            area[krets]['oppslutning']
         )
-        # Add results to the features:
-        for feature in geojson_data['features']:
-            if not all_same:
-                krets = str(
-                    feature['properties']['valgkretsnummer']
-                ).rjust(4, '0')
-            else:
-                krets = '0000'
-            feature['properties']['partinavn'] = area[krets]['partinavn']
-            feature['properties']['oppslutning'] = '({:4.2f} %)'.format(
-                area[krets]['oppslutning']
-            )
-            _add_coordinates(feature, coordinates)
-        all_geojson_data.append((kommune_navn, geojson_data))
-        tooltips.append(
-            create_tool_tip(
-                ('valgkretsnavn', 'partinavn', 'oppslutning'),
-                ('Valgkrets:', 'Største parti:', 'Oppslutning (%):'),
-                labels=False,
-            )
+
+
+def find_kommune_winners(results):
+    """Find the winners for all voting areas."""
+    return find_winners(
+        results,
+        ('Kommunenummer', 'Stemmekretsnummer'),
+        columns=('Stemmekretsnavn', 'Kommunenavn'),
+    )
+
+
+def _annotate(winners, kommune, geojson_file, geojson_data):
+    """Add the results for a kommune to its features.
+
+    Returns
+    -------
+    kommune_navn : string
+        The name of the kommune.
+    extent : dict
+        The extent of the voting areas, see :py:func:`get_extent`.
+
+    """
+    # Get results for each voting area:
+    kommune_navn = winners.loc[kommune]['Kommunenavn'].iloc[0]
+    print('Reading data for "{}"'.format(kommune_navn))
+    area, all_same = extract_data(winners, kommune)
+    extent = get_extent(geojson_file, geojson_data)
+    add_results(geojson_data, area, all_same)
+    return kommune_navn, extent
+
+
+def _get_map_settings(kommuner):
+    """Return the settings for a map of the given kommuner."""
+    tooltips = [
+        create_tool_tip(
+            ('valgkretsnavn', 'partinavn', 'oppslutning'),
+            ('Valgkrets:', 'Største parti:', 'Oppslutning (%):'),
+            labels=False,
         )
-    map_settings = {
-        'center': np.average(coordinates, axis=0)[::-1],
+        for _ in kommuner
+    ]
+    return {
         'zoom': 10,
         'tooltip': tooltips,
+        # Kommune names are not unique, the layers are told apart by id:
+        'layer_keys': list(kommuner),
     }
+
+
+def _geojson_files(kommuner):
+    """Return the geojson files for the given kommuner."""
+    return [
+        VALGKRETS_DIR.joinpath(VALGKRETS.format(kommune))
+        for kommune in kommuner
+    ]
+
+
+def get_geojson_data(results, kommuner):
+    """Produce geojson data for the given results."""
+    winners = find_kommune_winners(results)
+    geojson_files = _geojson_files(kommuner)
+    all_geojson_data = [None] * len(kommuner)
+    extents = [None] * len(kommuner)
+    # The kommuner are annotated as soon as their files are loaded:
+    for i, geojson_data in load_geojson_files(geojson_files):
+        kommune_navn, extents[i] = _annotate(
+            winners, kommuner[i], geojson_files[i], geojson_data
+        )
+        all_geojson_data[i] = (kommune_navn, geojson_data)
+    map_settings = _get_map_settings(kommuner)
+    map_settings.update(get_map_extent(extents))
     return all_geojson_data, map_settings
 
 
-def main(raw_data, kommuner):
-    """Read input files and create the map."""
-    geojson_data, map_settings = get_geojson_data(raw_data, kommuner)
+def iter_geojson_data(results, kommuner, map_settings):
+    """Produce geojson data for the given results, one kommune at a time.
+
+    Parameters
+    ----------
+    results : object like pandas.DataFrame
+        The results.
+    kommuner : list of strings
+        The kommuner to produce the layers for.
+    map_settings : dict
+        Settings for the map. When all layers have been produced, the
+        center and bounds for the map are added here.
+
+    Yields
+    ------
+    layer : tuple
+        The (name, geojson-dict) layer for each kommune, in order.
+
+    """
+    winners = find_kommune_winners(results)
+    geojson_files = _geojson_files(kommuner)
+    extents = []
+    for i, geojson_data in load_geojson_files(geojson_files, ordered=True):
+        kommune_navn, extent = _annotate(
+            winners, kommuner[i], geojson_files[i], geojson_data
+        )
+        extents.append(extent)
+        yield kommune_navn, geojson_data
+    map_settings.update(get_map_extent(extents))
+
+
+def make_map(results, kommuner, settings=None, hierarchy=None):
+    """Create the map and return the name of the file written."""
+    if is_streamed(settings):
+        # The layers are produced while the map is written:
+        map_settings = _get_map_settings(kommuner)
+        geojson_data = iter_geojson_data(results, kommuner, map_settings)
+    else:
+        geojson_data, map_settings = get_geojson_data(results, kommuner)
     if len(kommuner) == 1:
+        if hierarchy is None:
+            hierarchy = hierarchy_from_results(results)
         out = 'valgkretser-{}-{}.html'.format(
-            kommuner[0], geojson_data[0][0]
+            kommuner[0], hierarchy.kommune_navn(kommuner[0])
         )
     else:
         out = 'map-valgkretser.html'
+    out = get_output_path(out, settings)
+    map_settings.update(settings or {})
     produce_map(geojson_data, map_settings, output=out)
+    return out
+
+
+def update_layers(layers, results, kommuner, directory):
+    """Update the results in the site for some kommuner.
+
+    Parameters
+    ----------
+    layers : dict
+        The (name, geojson-dict) layer and the index entry for each
+        kommune in the site. It is updated here.
+    results : object like pandas.DataFrame
+        The new results.
+    kommuner : list of strings
+        The kommuner to update.
+    directory : object like pathlib.Path
+        The directory containing the site.
+
+    """
+    changed = results[results['Kommunenummer'].isin(kommuner)]
+    winners = find_kommune_winners(changed)
+    found = set(winners.index.get_level_values(0))
+    for kommune in kommuner:
+        (name, data), _ = layers[kommune]
+        if kommune in found:
+            area, all_same = extract_data(winners, kommune)
+        else:
+            area, all_same = {}, False
+        add_results(data, area, all_same)
+        layers[kommune] = ((name, data), write_layer(directory, name, data))
+    write_index(directory, [entry for _, entry in layers.values()])
+
+
+def watch(raw_data, kommuner, settings, interval=2.0):
+    """Keep a site with the map up to date while the results change.
+
+    The site is written once, and each time the result file changes,
+    only the layers for kommuner with changed results are written
+    again. The page checks for updated layers every ``interval``
+    seconds.
+
+    Parameters
+    ----------
+    raw_data : string
+        The csv file with the results.
+    kommuner : list of strings
+        The kommuner to show.
+    settings : dict
+        Settings for the map, with the settings for the site given
+        by the key ``site``.
+    interval : float, optional
+        The number of seconds between checking the result file.
+
+    """
+    results = read_csv_results(raw_data)
+    geojson_data, map_settings = get_geojson_data(results, kommuner)
+    map_settings.update(settings)
+    map_settings['site'] = dict(settings['site'], refresh=interval)
+    if map_settings.get('simplify'):
+        geojson_data = simplify_layers(
+            geojson_data, **map_settings['simplify']
+        )
+    if map_settings.get('slim'):
+        # The voting area numbers are needed for updating the results:
+        geojson_data = slim_layers(
+            geojson_data,
+            [
+                keep + ('valgkretsnummer',) for keep in kept_properties(
+                    map_settings['tooltip'], len(geojson_data)
+                )
+            ],
+            **map_settings['slim']
+        )
+    directory = pathlib.Path(map_settings['site']['directory'])
+    entries = write_site(
+        geojson_data, map_settings, directory, get_page_settings()
+    )
+    layers = dict(zip(kommuner, zip(geojson_data, entries)))
+    if map_settings['site'].get('serve'):
+        server = create_server(
+            directory, port=map_settings['site'].get('port', 8000)
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print('Serving "{}" at http://127.0.0.1:{}/'.format(
+            directory, server.server_address[1]
+        ))
+    try:
+        for new_results in watch_results(raw_data, interval=interval):
+            start = time.perf_counter()
+            changed = [
+                i for i in changed_kommuner(results, new_results)
+                if i in layers
+            ]
+            results = new_results
+            if not changed:
+                print('No changes for the kommuner shown')
+                continue
+            update_layers(layers, results, changed, directory)
+            print(
+                'Updated {} kommuner in {:.3f} s: {}'.format(
+                    len(changed),
+                    time.perf_counter() - start,
+                    ', '.join(changed),
+                )
+            )
+    except KeyboardInterrupt:
+        pass
+
+
+def main(raw_data, kommuner, settings=None, fylker=None):
+    """Read input files and create the map."""
+    results = read_csv_results(raw_data)
+    hierarchy = load_hierarchy(raw_data, results=results)
+    kommuner = kommuner_with_fylker(
+        raw_data, kommuner, fylker or [], hierarchy=hierarchy
+    )
+    make_map(results, kommuner, settings=settings, hierarchy=hierarchy)
+
+
+def add_arguments(parser):
+    """Add the command line arguments for this script."""
+    parser.add_argument(
+        'raw_data',
+        help='The csv file with the election results.',
+    )
+    parser.add_argument(
+        'kommuner',
+        nargs='*',
+        help='Identifiers for the municipalities to show.',
+    )
+    add_fylke_argument(parser)
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help=(
+            'Keep the site (given by --site) updated when the csv file '
+            'changes.'
+        ),
+    )
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=2.0,
+        help='Seconds between checking the csv file with --watch.',
+    )
+    add_cache_arguments(parser)
+    add_map_arguments(parser)
+
+
+def run(args):
+    """Create the map from parsed command line arguments."""
+    set_cache_options(args)
+    settings = get_map_settings(args)
+    if not args.kommuner and not args.fylke:
+        raise SystemExit('Give the kommuner to show, or --fylke')
+    if args.watch:
+        if settings['site'] is None:
+            raise SystemExit('--watch requires --site DIRECTORY')
+    with profile_run(args):
+        if args.watch:
+            kommuner = kommuner_with_fylker(
+                args.raw_data, args.kommuner, args.fylke
+            )
+            watch(args.raw_data, kommuner, settings, interval=args.interval)
+            return
+        main(
+            args.raw_data,
+            args.kommuner,
+            settings=settings,
+            fylker=args.fylke,
+        )
 
 
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2:])
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    add_arguments(PARSER)
+    run(PARSER.parse_args())
@@ -0,0 +1,201 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Merge many small map layers and filter them in the browser.
+
+The maps for fylker and for voting areas get one layer (with its own
+tooltip and entry in the layer control) for each kommune. With many
+kommuner, this makes the page slow. Here, the layers are merged into
+one feature collection (or one for each party) with a single tooltip,
+and a key for the layer each feature came from (e.g. the kommune
+number, since names like Herøy are not unique) is stored as a
+property. A small control (:py:class:`LayerFilter`) lets the reader
+show a single kommune, by removing the other features from the merged
+layers in the browser.
+"""
+import folium
+from branca.element import MacroElement
+from jinja2 import Template
+
+
+# The property holding the key of the layer a feature came from:
+FILTER_KEY = 'lag'
+# The ways to merge layers:
+MERGE = ('all', 'party')
+
+
+def merge_layers(geojson_layers, tooltips=None, by='all', name='Alle',
+                 keys=None):
+    """Merge layers into one, or into one for each party.
+
+    Parameters
+    ----------
+    geojson_layers : list of tuples
+        Each tuple is of form (name, geojson-dict).
+    tooltips : object like folium.features.GeoJsonTooltip or list
+        The tooltip for all layers, or a list with one for each layer.
+        The first one is used (and copied) for the merged layers.
+    by : string, optional
+        Merge all layers into one (``all``) or make one layer for each
+        party (``party``), grouped by the ``partinavn`` property.
+    name : string, optional
+        The name of the merged layer when merging all layers.
+    keys : list of strings, optional
+        A key identifying each layer, e.g. the kommune number. If not
+        given, the position of each layer is used, so that layers with
+        the same name are kept apart.
+
+    Returns
+    -------
+    merged : list of tuples
+        The merged (name, geojson-dict) layers. The features are
+        copies, with the key of their original layer stored in the
+        property given by ``FILTER_KEY``.
+    tooltips : list
+        The tooltip for each merged layer.
+    choices : list of tuples
+        The (key, name) of the original layers, in order.
+
+    """
+    if by not in MERGE:
+        raise ValueError('Unknown way to merge layers "{}"'.format(by))
+    if isinstance(tooltips, (list, tuple)):
+        tooltip = next((i for i in tooltips if i is not None), None)
+    else:
+        tooltip = tooltips
+    groups = {}
+    choices = {}
+    template = None
+    for i, (layer_name, data) in enumerate(geojson_layers):
+        if template is None:
+            template = {
+                key: val for key, val in data.items() if key != 'features'
+            }
+        layer_key = str(i if keys is None else keys[i])
+        choices.setdefault(layer_key, layer_name)
+        for feature in data['features']:
+            properties = dict(feature.get('properties') or {})
+            properties[FILTER_KEY] = layer_key
+            feature = dict(feature, properties=properties)
+            group = name if by == 'all' else properties.get('partinavn')
+            groups.setdefault(group, []).append(feature)
+    merged = []
+    for group in sorted(groups, key=str):
+        merged.append((group, dict(template, features=groups[group])))
+    # A tooltip can only belong to one layer:
+    merged_tooltips = [tooltip] + [
+        copy_tooltip(tooltip) for _ in merged[1:]
+    ]
+    return merged, merged_tooltips, list(choices.items())
+
+
+def copy_tooltip(tooltip):
+    """Create a new tooltip with the same fields as a given one."""
+    if tooltip is None:
+        return None
+    return folium.GeoJsonTooltip(
+        fields=tooltip.fields,
+        aliases=tooltip.aliases,
+        labels=tooltip.labels,
+        localize=tooltip.localize,
+        style=getattr(tooltip, 'style', None),
+        **tooltip.tooltip_options
+    )
+
+
+class LayerFilter(MacroElement):
+    """A control for showing the features from one of the merged layers.
+
+    Attributes
+    ----------
+    choices : list of tuples
+        The (key, name) of the layers which can be chosen.
+    key : string
+        The feature property holding the key of the layer.
+    label : string
+        The label for the control.
+
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            (function(map) {
+                var key = {{ this.key|tojson }};
+                var groups = [];
+                var features = {};
+                map.eachLayer(function(layer) {
+                    if (layer instanceof L.GeoJSON) {
+                        groups.push(layer);
+                    }
+                });
+                function choose(value) {
+                    var bounds = L.latLngBounds([]);
+                    groups.forEach(function(group) {
+                        var id = L.stamp(group);
+                        if (!features[id] || !features[id].length) {
+                            features[id] = group.getLayers();
+                        }
+                        features[id].forEach(function(item) {
+                            var props = item.feature.properties;
+                            if (value === '' || props[key] === value) {
+                                if (!group.hasLayer(item)) {
+                                    group.addLayer(item);
+                                }
+                                bounds.extend(item.getBounds());
+                            } else if (group.hasLayer(item)) {
+                                group.removeLayer(item);
+                            }
+                        });
+                    });
+                    if (value !== '' && bounds.isValid()) {
+                        map.fitBounds(bounds);
+                    }
+                }
+                var control = L.control({position: 'topleft'});
+                control.onAdd = function() {
+                    var div = L.DomUtil.create(
+                        'div', 'leaflet-bar leaflet-control valg-filter'
+                    );
+                    div.style.background = 'white';
+                    div.style.padding = '4px';
+                    var label = L.DomUtil.create('label', '', div);
+                    label.textContent = {{ this.label|tojson }} + ' ';
+                    var select = L.DomUtil.create('select', '', label);
+                    var all = L.DomUtil.create('option', '', select);
+                    all.value = '';
+                    all.textContent = 'Alle';
+                    {{ this.choices|tojson }}.forEach(function(choice) {
+                        var option = L.DomUtil.create('option', '', select);
+                        option.value = choice[0];
+                        option.textContent = choice[1];
+                    });
+                    L.DomEvent.disableClickPropagation(div);
+                    L.DomEvent.disableScrollPropagation(div);
+                    L.DomEvent.on(select, 'change', function() {
+                        choose(select.value);
+                    });
+                    return div;
+                };
+                control.addTo(map);
+            })({{ this._parent.get_name() }});
+        {% endmacro %}
+        """)
+
+    def __init__(self, choices, key=FILTER_KEY, label='Kommune:'):
+        """Set up the control.
+
+        Parameters
+        ----------
+        choices : list of tuples
+            The (key, name) of the layers which can be chosen (in the
+            order shown). Only the names are shown.
+        key : string, optional
+            The feature property holding the key of the layer.
+        label : string, optional
+            The label for the control.
+
+        """
+        super().__init__()
+        self._name = 'LayerFilter'
+        self.choices = [list(choice) for choice in choices]
+        self.key = key
+        self.label = label
@@ -1,12 +1,66 @@
 # Copyright (c) 2019, Anders Lervik.
 # Distributed under the MIT License. See LICENSE for more info.
 """Create a map using folium."""
+import argparse
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 from functools import partial
+import itertools
 import json
-import pandas as pd
+import os
+import pathlib
+import numpy as np
 import folium
 import branca.colormap as cm
-from legend import Legend
+from classify import SCHEMES, class_colors, classify, step_color_map
+from client_style import (
+    ClassStyle,
+    ClassStyledGeoJson,
+    ClassStyledTopoJson,
+    add_class_property,
+    color_index,
+    color_lookup_table,
+)
+from external_data import DATA_DIR, ExternalGeoJson, write_external_data
+from geometry import combine_extents, extent, flatten_features
+from geometry_store import STORE_FILE, GeometryStore
+from layer_filter import MERGE, LayerFilter, merge_layers
+from legend import CSSURL, Legend
+from map_server import serve, write_site
+from profiling import add_profile_arguments, profiled, stage
+from read_results import (  # pylint: disable=unused-import
+    CSV_CACHE,
+    CSV_READING,
+    LEAN_COLUMNS,
+    add_cache_arguments,
+    read_csv_results,
+    set_cache_options,
+)
+from simplify import (
+    add_simplify_arguments,
+    get_simplify_settings,
+    simplify_layers,
+)
+from slim import (
+    add_slim_arguments,
+    get_slim_settings,
+    kept_properties,
+    slim_layers,
+)
+from stream_html import (
+    LayerSlot,
+    split_page,
+    write_bounds,
+    write_features,
+    write_layer,
+)
+from static_map import DEFAULT_SIZE, IMAGE_FORMATS, render_image
+from topojson_layer import SharedTopoJson, TopologyData
+from topology import Topology
 
 
 COLORS = {
@@ -82,20 +136,254 @@ TILES = [
 OPACITY = 0.7
 
 
-def read_csv_results(result_file):
-    """Read the results from the given csv file."""
-    print('Reading results from "{}"'.format(result_file))
-    results = pd.read_csv(
-        result_file,
-        sep=';',
-        decimal=',',
-        converters={
-            'Fylkenummer': str,
-            'Kommunenummer': str,
-            'Stemmekretsnummer': str
-        },
+GEOMETRY_STORES = {}
+
+
+GEOMETRY_EXTENTS = {}
+
+
+GEOJSON_CACHE = {
+    'memory': False,
+}
+
+
+# How to load many geojson files: the number of workers (None to use
+# one for each core, at most MAX_LOAD_WORKERS) and if they are
+# processes (which parse in parallel) instead of threads:
+GEOJSON_LOADING = {
+    'workers': None,
+    'processes': False,
+}
+MAX_LOAD_WORKERS = 8
+
+
+# Settings for maps with many layers, which choropleth maps (with a
+# single layer) do not support:
+CHOROPLETH_UNSUPPORTED = {
+    'site': 'A choropleth map can not be written as a site',
+    'merge': 'A choropleth map has no layers to merge',
+    'stream': 'A choropleth map can not be streamed',
+}
+
+
+# GeoJSON data kept in memory (when GEOJSON_CACHE['memory'] is set), by
+# file, together with the size and modification time of the file:
+GEOJSON_IN_MEMORY = {}
+
+
+def add_map_arguments(parser, choropleth=False):
+    """Add command line arguments for how the map is created.
+
+    Parameters
+    ----------
+    parser : object like argparse.ArgumentParser
+        The parser to add the arguments to.
+    choropleth : boolean, optional
+        If True, the arguments are for a choropleth map with a single
+        layer, and the arguments which only apply to maps with many
+        layers are not added.
+
+    """
+    add_simplify_arguments(parser)
+    add_slim_arguments(parser)
+    add_profile_arguments(parser)
+    parser.add_argument(
+        '--topojson',
+        action='store_true',
+        help=(
+            'Embed the layers as TopoJSON, so that shared borders are '
+            'only stored once.'
+        ),
+    )
+    parser.add_argument(
+        '--quantization',
+        type=int,
+        default=100000,
+        help='The quantization to use for TopoJSON coordinates.',
+    )
+    parser.add_argument(
+        '--external',
+        nargs='?',
+        const=DATA_DIR,
+        default=None,
+        metavar='DIRECTORY',
+        help=(
+            'Write the geometries to content-hashed files (in a directory '
+            'next to the map, default "{}") which the page fetches, '
+            'instead of embedding them.'.format(DATA_DIR)
+        ),
+    )
+    parser.add_argument(
+        '--client-style',
+        action='store_true',
+        help=(
+            'Style the layers in the browser from a lookup table, instead '
+            'of storing the style for each feature.'
+        ),
+    )
+    parser.add_argument(
+        '--load-workers',
+        type=int,
+        default=None,
+        metavar='N',
+        help=(
+            'The number of workers for loading the geojson files '
+            '(default: one for each core, at most {}).'.format(
+                MAX_LOAD_WORKERS
+            )
+        ),
+    )
+    parser.add_argument(
+        '--load-processes',
+        action='store_true',
+        help=(
+            'Load the geojson files in worker processes instead of '
+            'threads, so that they are parsed in parallel.'
+        ),
+    )
+    parser.add_argument(
+        '--scheme',
+        choices=SCHEMES,
+        default=None,
+        help=(
+            'Color choropleth maps by classes found with this scheme '
+            '(equal intervals, quantiles or natural breaks), instead of '
+            'a continuous color scale.'
+        ),
+    )
+    parser.add_argument(
+        '--classes',
+        type=int,
+        default=5,
+        help='The number of classes to use with --scheme.',
+    )
+    parser.add_argument(
+        '--image',
+        choices=IMAGE_FORMATS,
+        default=None,
+        help=(
+            'Draw the map as a static image in this format instead of '
+            'an interactive html map.'
+        ),
+    )
+    parser.add_argument(
+        '--image-size',
+        type=parse_image_size,
+        default=DEFAULT_SIZE,
+        metavar='WIDTHxHEIGHT',
+        help='The size of the image (default {}x{}).'.format(*DEFAULT_SIZE),
+    )
+    if choropleth:
+        return
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help=(
+            'Write each layer to the html file as soon as it is ready, '
+            'instead of keeping the whole map in memory. The layers are '
+            'styled in the browser.'
+        ),
+    )
+    parser.add_argument(
+        '--merge-layers',
+        choices=MERGE,
+        default=None,
+        help=(
+            'Merge the layers for each kommune into one layer (all) or '
+            'into one layer for each party (party), with one tooltip '
+            'and a control for showing a single kommune (not used with '
+            '--site).'
+        ),
+    )
+    parser.add_argument(
+        '--site',
+        default=None,
+        metavar='DIRECTORY',
+        help=(
+            'Write the map to a directory with one file per layer, '
+            'where layers are loaded when they are in view.'
+        ),
     )
-    return results
+    parser.add_argument(
+        '--serve',
+        action='store_true',
+        help='Serve the site (given by --site) on localhost.',
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8000,
+        help='The port to use with --serve.',
+    )
+    parser.add_argument(
+        '--min-zoom',
+        type=int,
+        default=9,
+        help='The zoom level at which layers are loaded with --site.',
+    )
+
+
+def parse_image_size(text):
+    """Parse an image size given as ``WIDTHxHEIGHT``."""
+    try:
+        width, height = (int(i) for i in text.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Expected WIDTHxHEIGHT, got "{}"'.format(text)
+        )
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError('The size must be positive')
+    return width, height
+
+
+def get_map_settings(args):
+    """Get settings for the map from parsed command line arguments."""
+    settings = {
+        'simplify': get_simplify_settings(args),
+        'slim': get_slim_settings(args),
+        'topojson': None,
+        'client_style': args.client_style,
+        'external': args.external,
+        'merge': getattr(args, 'merge_layers', None),
+    }
+    if args.topojson:
+        settings['topojson'] = {'quantization': args.quantization}
+    settings['stream'] = getattr(args, 'stream', False)
+    if settings['stream'] and (
+            args.topojson or args.external or settings['merge']):
+        raise SystemExit(
+            '--stream can not be combined with --topojson, --external or '
+            '--merge-layers'
+        )
+    if settings['stream'] and settings['simplify']:
+        # The layers are simplified one at a time when streamed, so
+        # shared borders would not line up and a size budget would
+        # apply to each layer:
+        raise SystemExit(
+            '--stream can not be combined with --simplify or '
+            '--simplify-size'
+        )
+    if args.load_workers is not None and args.load_workers < 1:
+        raise SystemExit('--load-workers must be positive')
+    GEOJSON_LOADING['workers'] = args.load_workers
+    GEOJSON_LOADING['processes'] = args.load_processes
+    settings['scheme'] = None
+    if args.scheme is not None:
+        if args.classes < 1:
+            raise SystemExit('--classes must be positive')
+        settings['scheme'] = {'name': args.scheme, 'classes': args.classes}
+    settings['image'] = None
+    if args.image is not None:
+        settings['image'] = {'format': args.image, 'size': args.image_size}
+    settings['site'] = None
+    if getattr(args, 'site', None) is not None:
+        settings['site'] = {
+            'directory': args.site,
+            'serve': args.serve,
+            'port': args.port,
+            'min_zoom': args.min_zoom,
+        }
+    return settings
 
 
 def default_style_function(item):
@@ -128,11 +416,71 @@ def style_function_color_map(item, key, data, color_map):
     return style
 
 
+def style_function_class(item, colors, class_key='klasse'):
+    """Style for geojson polygons with a precomputed class.
+
+    Parameters
+    ----------
+    item : dict
+        The feature to style.
+    colors : list of strings
+        The fill color for each class.
+    class_key : string, optional
+        The feature property holding the class (see
+        :py:func:`client_style.add_class_property`).
+
+    """
+    klass = item['properties'].get(class_key)
+    style = {
+        'fillColor': '#262626' if klass is None else colors[klass],
+        'fillOpacity': OPACITY,
+        'color': '#262626',
+        'weight': 0.5,
+    }
+    return style
+
+
 def default_highlight_function(item):
     """Style for geojson highlighting."""
     return {'weight': 2.0, 'fillOpacity': OPACITY + 0.15}
 
 
+def create_class_style(key, colors, geojson_layers=None):
+    """Create a lookup table for styling layers in the browser.
+
+    Parameters
+    ----------
+    key : string
+        The feature property holding the class.
+    colors : dict or list
+        The fill color for each class.
+    geojson_layers : list of tuples, optional
+        If given, a message is printed for classes in these layers
+        without a color.
+
+    Returns
+    -------
+    class_style : object like client_style.ClassStyle
+        The lookup table, which must be added to the map before
+        the layers using it.
+
+    """
+    if geojson_layers is not None and isinstance(colors, dict):
+        missing = {
+            feature['properties'].get(key)
+            for _, data in geojson_layers for feature in data['features']
+        }.difference(colors)
+        for value in sorted(missing, key=str):
+            print('Missing color for {} --- using default'.format(value))
+    return ClassStyle(
+        key,
+        colors,
+        style={'fillOpacity': OPACITY, 'color': '#262626', 'weight': 0.5},
+        highlight=default_highlight_function(None),
+        default_color='#262626',
+    )
+
+
 def create_tool_tip(fields, aliases, labels=True):
     """Create tool tip to add to the map."""
     tool = folium.GeoJsonTooltip(
@@ -153,6 +501,235 @@ def load_json_file(filename):
     return data
 
 
+def get_geometry_store(directory):
+    """Return the geometry store for a directory, if it has been built.
+
+    The store is opened again if the store file has been rebuilt.
+    """
+    directory = pathlib.Path(directory).resolve()
+    store_file = directory.joinpath(STORE_FILE)
+    try:
+        mtime = store_file.stat().st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    kept = GEOMETRY_STORES.get(directory)
+    if kept is None or kept[0] != mtime:
+        store = None if mtime is None else GeometryStore(store_file)
+        kept = (mtime, store)
+        GEOMETRY_STORES[directory] = kept
+    return kept[1]
+
+
+def _load_geojson_file(filename):
+    """Load data from a geojson file or its geometry store."""
+    store = get_geometry_store(filename.parent)
+    key = filename.stem
+    if store is not None and key in store:
+        if not filename.is_file() or store.is_fresh(key, filename):
+            print('Loading "{}" from "{}"'.format(key, store.filename))
+            return store.load(key)
+    return load_json_file(filename)
+
+
+def _copy_features(geojson_data):
+    """Copy the features and properties, sharing the geometries."""
+    data = dict(geojson_data)
+    data['features'] = []
+    for feature in geojson_data['features']:
+        new_feature = dict(feature)
+        new_feature['properties'] = dict(feature.get('properties') or {})
+        data['features'].append(new_feature)
+    return data
+
+
+@profiled('load_geojson')
+def load_geojson_file(filename):
+    """Load data from a geojson file.
+
+    If a geometry store has been built for the directory containing
+    the file, and the store is up to date, the data is read from the
+    store instead of parsing the file. If ``GEOJSON_CACHE['memory']``
+    is set (as in the daemon, see :py:mod:`valg`), the data is also
+    kept in memory and reused as long as the file is unchanged. The
+    caller gets its own copy of the features and their properties,
+    but the geometries are shared and must not be modified.
+    """
+    filename = pathlib.Path(filename)
+    if not GEOJSON_CACHE['memory']:
+        return _load_geojson_file(filename)
+    key = filename.resolve()
+    try:
+        stat = filename.stat()
+        signature = (stat.st_size, stat.st_mtime_ns)
+    except FileNotFoundError:
+        signature = None
+    kept = GEOJSON_IN_MEMORY.get(key)
+    if kept is None or kept[0] != signature:
+        kept = (signature, _load_geojson_file(filename))
+        GEOJSON_IN_MEMORY[key] = kept
+    return _copy_features(kept[1])
+
+
+def _load_geojson_in_process(filename):
+    """Load a geojson file in a worker process."""
+    return _load_geojson_file(pathlib.Path(filename))
+
+
+def load_geojson_files(filenames, workers=None, processes=None,
+                       queue_size=None, ordered=False):
+    """Load several geojson files concurrently.
+
+    The files are read and parsed by a pool of workers, and yielded as
+    soon as they are loaded (that is, not necessarily in the given
+    order), so that the caller can process one file while the others
+    are loaded. At most ``queue_size`` files are loaded ahead of the
+    caller, so that memory use stays bounded.
+
+    Parameters
+    ----------
+    filenames : list of strings or objects like pathlib.Path
+        The files to load.
+    workers : integer, optional
+        The number of workers. If not given, it is taken from
+        ``GEOJSON_LOADING``. With one worker, the files are loaded
+        one by one, in order.
+    processes : boolean, optional
+        If True, the workers are processes instead of threads. If not
+        given, it is taken from ``GEOJSON_LOADING``. Processes are
+        not used when the data is kept in memory (see
+        :py:func:`load_geojson_file`).
+    queue_size : integer, optional
+        The most files loaded (or being loaded) ahead of the caller.
+        The default is twice the number of workers.
+    ordered : boolean, optional
+        If True, the files are yielded in the given order. Files which
+        are loaded before the ones in front of them are kept (and
+        count towards ``queue_size``) until those are loaded.
+
+    Yields
+    ------
+    index : integer
+        The position of the file in ``filenames``.
+    geojson_data : dict
+        The data in the file.
+
+    """
+    filenames = list(filenames)
+    if workers is None:
+        workers = GEOJSON_LOADING['workers']
+    if workers is None:
+        workers = min(os.cpu_count() or 1, MAX_LOAD_WORKERS)
+    workers = max(1, min(workers, len(filenames)))
+    if processes is None:
+        processes = GEOJSON_LOADING['processes']
+    if workers == 1:
+        for index, filename in enumerate(filenames):
+            yield index, load_geojson_file(filename)
+        return
+    if processes and not GEOJSON_CACHE['memory']:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        load = _load_geojson_in_process
+        filenames = [str(i) for i in filenames]
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        load = load_geojson_file
+    queue_size = max(queue_size or 2 * workers, workers)
+    todo = iter(enumerate(filenames))
+    pending = {}
+    # Loaded files waiting for the ones in front of them (if ordered):
+    ready = {}
+    following = 0
+    with executor:
+        try:
+            for index, filename in itertools.islice(todo, queue_size):
+                pending[executor.submit(load, filename)] = index
+            while pending:
+                # The stages in the workers are not recorded, so the
+                # time spent waiting for them is recorded here:
+                with stage('load_geojson'):
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    if not ordered:
+                        yield index, future.result()
+                    else:
+                        ready[index] = future.result()
+                        while following in ready:
+                            yield following, ready.pop(following)
+                            following += 1
+                    # Keep the queue full:
+                    free = queue_size - len(pending) - len(ready)
+                    for index, filename in itertools.islice(todo, free):
+                        pending[executor.submit(load, filename)] = index
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def get_extent(filename, geojson_data=None):
+    """Get the bounding box, area and centroid for a geojson file.
+
+    The extent is taken from the geometry store if it is up to date,
+    otherwise it is calculated and kept for later calls.
+
+    Parameters
+    ----------
+    filename : string or object like pathlib.Path
+        The geojson file.
+    geojson_data : dict, optional
+        The data in the file, if it has already been loaded.
+
+    Returns
+    -------
+    extent : dict
+        The extent as returned by :py:func:`geometry.extent`.
+
+    """
+    filename = pathlib.Path(filename)
+    store = get_geometry_store(filename.parent)
+    key = filename.stem
+    if store is not None and key in store:
+        if not filename.is_file() or store.is_fresh(key, filename):
+            store_extent = store.extent(key)
+            if store_extent is not None:
+                return store_extent
+    mtime = filename.stat().st_mtime_ns if filename.is_file() else None
+    cache_key = (filename.resolve(), mtime)
+    if cache_key not in GEOMETRY_EXTENTS:
+        if geojson_data is None:
+            geojson_data = load_geojson_file(filename)
+        GEOMETRY_EXTENTS[cache_key] = extent(
+            flatten_features(geojson_data['features'])
+        )
+    return GEOMETRY_EXTENTS[cache_key]
+
+
+def get_map_extent(extents):
+    """Get the center and bounds for a map showing the given extents.
+
+    Parameters
+    ----------
+    extents : list of dicts
+        The extents (see :py:func:`get_extent`) of the layers.
+
+    Returns
+    -------
+    settings : dict
+        The ``center`` (latitude, longitude) and ``bounds`` (south-west
+        and north-east corners) for the map. Empty if the extents do not
+        contain any geometries.
+
+    """
+    combined = combine_extents(extents)
+    if not all(np.isfinite(combined['centroid'])):
+        return {}
+    xmin, ymin, xmax, ymax = combined['bbox']
+    return {
+        'center': combined['centroid'][::-1],
+        'bounds': [[ymin, xmin], [ymax, xmax]],
+    }
+
+
 def add_tiles_to_map(the_map):
     """Add default tiles to a folium map.
 
@@ -187,7 +764,7 @@ def add_legend_to_map(the_map):
 
 def add_geojson_layers(the_map, geojson_layers,
                        style_function=default_style_function,
-                       tooltip=None):
+                       tooltip=None, class_style=None, external=None):
     """Add geojson layers to a map.
 
     Parameters
@@ -201,11 +778,34 @@ def add_geojson_layers(the_map, geojson_layers,
         the geojson layers.
     tooltip : list of objects like folium.features.GeoJsonTooltip, optional
         A tooltip to add to the map.
+    class_style : object like client_style.ClassStyle, optional
+        If given, the layers are styled in the browser with this
+        lookup table, and the style function is not used.
+    external : string, optional
+        If given, the geometries are written to files in this
+        directory (see :py:mod:`external_data`) instead of being
+        embedded in the map.
 
     """
     if tooltip is None:
         tooltip = [None for _ in geojson_layers]
     for (name, data), tool in zip(geojson_layers, tooltip):
+        if external is not None:
+            ExternalGeoJson(
+                data,
+                directory=external,
+                class_style=class_style,
+                style_function=style_function,
+                highlight_function=default_highlight_function,
+                name=name,
+                tooltip=tool,
+            ).add_to(the_map)
+            continue
+        if class_style is not None:
+            ClassStyledGeoJson(
+                data, class_style, name=name, tooltip=tool
+            ).add_to(the_map)
+            continue
         folium.GeoJson(
             data,
             name=name,
@@ -215,6 +815,59 @@ def add_geojson_layers(the_map, geojson_layers,
         ).add_to(the_map)
 
 
+def add_topojson_layers(the_map, geojson_layers,
+                        style_function=default_style_function,
+                        tooltip=None, quantization=100000,
+                        class_style=None):
+    """Add geojson layers to a map as one shared TopoJSON topology.
+
+    Parameters
+    ----------
+    geojson_layers : list of tuples
+        Each typle is of form (name, geojson-dict) where the
+        name is used as a label and the geojson-dict contains
+        the geojson layer to be shown.
+    style_function : callable, optional
+        A style function for defining the style to use when drawing
+        the geojson layers.
+    tooltip : list of objects like folium.features.GeoJsonTooltip, optional
+        A tooltip to add to the map.
+    quantization : integer, optional
+        The number of distinct values to use for the coordinates.
+    class_style : object like client_style.ClassStyle, optional
+        If given, the layers are styled in the browser with this
+        lookup table, and the style function is not used.
+
+    """
+    if tooltip is None:
+        tooltip = [None for _ in geojson_layers]
+    topology, object_names = Topology(geojson_layers).to_topojson(
+        quantization=quantization
+    )
+    topology_data = TopologyData(topology)
+    the_map.add_child(topology_data)
+    for (name, _), object_name, tool in zip(geojson_layers, object_names,
+                                            tooltip):
+        if class_style is not None:
+            ClassStyledTopoJson(
+                topology_data,
+                object_name,
+                class_style,
+                name=name,
+                tooltip=tool,
+            ).add_to(the_map)
+            continue
+        SharedTopoJson(
+            topology_data,
+            object_name,
+            style_function=style_function,
+            highlight_function=default_highlight_function,
+            name=name,
+            tooltip=tool,
+        ).add_to(the_map)
+
+
+@profiled('build_map')
 def create_folium_map(geojson_layers, map_settings):
     """Create a folium map.
 
@@ -239,11 +892,53 @@ def create_folium_map(geojson_layers, map_settings):
         zoom_start=map_settings.get('zoom', 9),
     )
     add_tiles_to_map(the_map)
-    add_geojson_layers(
-        the_map, geojson_layers, tooltip=map_settings.get('tooltip', None)
-    )
+    tooltip = map_settings.get('tooltip', None)
+    layer_choices = None
+    if map_settings.get('merge') and len(geojson_layers) > 1:
+        geojson_layers, tooltip, layer_choices = merge_layers(
+            geojson_layers,
+            tooltips=tooltip,
+            by=map_settings['merge'],
+            keys=map_settings.get('layer_keys'),
+        )
+    if map_settings.get('simplify'):
+        geojson_layers = simplify_layers(
+            geojson_layers, **map_settings['simplify']
+        )
+    if map_settings.get('slim'):
+        geojson_layers = slim_layers(
+            geojson_layers,
+            kept_properties(tooltip, len(geojson_layers)),
+            **map_settings['slim']
+        )
+    class_style = None
+    if map_settings.get('client_style'):
+        class_style = create_class_style(
+            'partinavn', COLORS_PARTY, geojson_layers=geojson_layers
+        )
+        the_map.add_child(class_style)
+    if map_settings.get('topojson') and not map_settings.get('external'):
+        add_topojson_layers(
+            the_map,
+            geojson_layers,
+            tooltip=tooltip,
+            class_style=class_style,
+            **map_settings['topojson']
+        )
+    else:
+        add_geojson_layers(
+            the_map,
+            geojson_layers,
+            tooltip=tooltip,
+            class_style=class_style,
+            external=map_settings.get('external'),
+        )
+    if layer_choices is not None:
+        the_map.add_child(LayerFilter(layer_choices))
     folium.LayerControl().add_to(the_map)
     add_legend_to_map(the_map)
+    if map_settings.get('bounds'):
+        the_map.fit_bounds(map_settings['bounds'])
     return the_map
 
 
@@ -270,17 +965,120 @@ def extract_data_values(data, value_key):
     return values
 
 
-def create_color_map(values, color_map_name):
-    """Create a color map to use with a geojson layer."""
+def create_color_map(values, color_map_name, center=None):
+    """Create a color map to use with a geojson layer.
+
+    If a center is given, the range of the color map is made symmetric
+    around it (e.g. for diverging color maps showing changes).
+    """
     vals = [i for _, i in values.items()]
+    vmin, vmax = min(vals), max(vals)
+    if center is not None:
+        width = max(abs(vmin - center), abs(vmax - center)) or 1.0
+        vmin, vmax = center - width, center + width
     linear = cm.LinearColormap(
         COLOR_MAPS[color_map_name],
-        vmin=min(vals),
-        vmax=max(vals)
+        vmin=vmin,
+        vmax=vmax
     )
     return linear
 
 
+def choropleth_colors(data, map_settings):
+    """Find the values and the color map for a choropleth map.
+
+    Parameters
+    ----------
+    data : dict
+        The raw data to use for coloring.
+    map_settings : dict
+        A dict containing settings for the map.
+
+    Returns
+    -------
+    values : dict
+        The value for each key in the data.
+    linear : object like branca.colormap.ColorMap
+        The color map. With a classification scheme (given by the
+        ``scheme`` setting), this has one step for each class.
+    legend : string
+        The caption for the color map.
+    classes : dict or None
+        With a classification scheme, the class (``index``) for each
+        key in the data and the color (``colors``) for each class.
+
+    """
+    title = map_settings.get('title', 'Unknown')
+    party = map_settings.get('party', 'Unknown')
+    legend = map_settings.get(
+        'legend', 'Oppslutning (%) for {} i {}'.format(party, title)
+    )
+
+    values = extract_data_values(
+        data,
+        map_settings['value_key']
+    )
+    if 'color_map_name' not in map_settings:
+        color_map_name = COLORS_PARTY_MAPS.get(party, 'viridis')
+    else:
+        color_map_name = map_settings['color_map_name']
+    linear = create_color_map(
+        values, color_map_name, center=map_settings.get('color_center')
+    )
+    scheme = map_settings.get('scheme')
+    if not scheme:
+        return values, linear, legend, None
+    keys = list(values)
+    breaks, index = classify(
+        [values[key] for key in keys],
+        scheme=scheme['name'],
+        classes=scheme['classes'],
+        center=map_settings.get('color_center'),
+    )
+    colors = class_colors(linear, breaks)
+    classes = {'index': dict(zip(keys, index.tolist())), 'colors': colors}
+    return values, step_color_map(colors, breaks), legend, classes
+
+
+def choropleth_style(geojson_layer, values, linear, classes):
+    """Find the style function for a choropleth layer.
+
+    Parameters
+    ----------
+    geojson_layer : dict
+        The geojson layer to style.
+    values : dict
+        The value for each key in the data.
+    linear : object like branca.colormap.ColorMap
+        The color map.
+    classes : dict or None
+        The classes, as returned by :py:func:`choropleth_colors`.
+
+    Returns
+    -------
+    geojson_layer : dict
+        The layer. With classes, this is a copy where each feature
+        has its class in the ``klasse`` property.
+    style_function : callable
+        The style function for the layer.
+
+    """
+    if classes is None:
+        return geojson_layer, partial(
+            style_function_color_map,
+            key='krets',
+            data=values,
+            color_map=linear,
+        )
+    geojson_layer = add_class_property(
+        geojson_layer, 'krets', classes['index']
+    )
+    return geojson_layer, partial(
+        style_function_class, colors=classes['colors']
+    )
+
+
+@profiled('build_map')
 def create_folium_choropleth(geojson_layer, data, map_settings):
     """Create a folium choropleth map.
 
@@ -306,39 +1104,123 @@ def create_folium_choropleth(geojson_layer, data, map_settings):
     )
     add_tiles_to_map(the_map)
     title = map_settings.get('title', 'Unknown')
-    party = map_settings.get('party', 'Unknown')
-    legend = 'Oppslutning (%) for {} i {}'.format(party, title)
+    values, linear, legend, classes = choropleth_colors(data, map_settings)
 
-    values = extract_data_values(
-        data,
-        map_settings['value_key']
+    if map_settings.get('simplify'):
+        geojson_layer = simplify_layers(
+            [(title, geojson_layer)], **map_settings['simplify']
+        )[0][1]
+    if map_settings.get('slim'):
+        geojson_layer = slim_layers(
+            [(title, geojson_layer)],
+            kept_properties(map_settings.get('tooltip', None), 1),
+            **map_settings['slim']
+        )[0][1]
+
+    geojson_layer, style_function = choropleth_style(
+        geojson_layer, values, linear, classes
     )
-    if 'color_map_map' not in map_settings:
-        color_map_name = COLORS_PARTY_MAPS.get(party, 'viridis')
+    class_style = None
+    if map_settings.get('client_style') and classes is not None:
+        class_style = create_class_style('klasse', classes['colors'])
+        the_map.add_child(class_style)
+    elif map_settings.get('client_style'):
+        # Store the index into a sampled color map for each feature:
+        keys = list(values)
+        index = color_index(
+            [values[key] for key in keys], linear.vmin, linear.vmax
+        )
+        geojson_layer = add_class_property(
+            geojson_layer, 'krets', dict(zip(keys, index.tolist()))
+        )
+        class_style = create_class_style(
+            'klasse', color_lookup_table(linear, index.tolist())
+        )
+        the_map.add_child(class_style)
+    if map_settings.get('external'):
+        ExternalGeoJson(
+            geojson_layer,
+            directory=map_settings['external'],
+            class_style=class_style,
+            style_function=style_function,
+            highlight_function=default_highlight_function,
+            name=title,
+            tooltip=map_settings.get('tooltip', None),
+        ).add_to(the_map)
+    elif map_settings.get('topojson'):
+        add_topojson_layers(
+            the_map,
+            [(title, geojson_layer)],
+            style_function=style_function,
+            tooltip=[map_settings.get('tooltip', None)],
+            class_style=class_style,
+            **map_settings['topojson']
+        )
+    elif class_style is not None:
+        ClassStyledGeoJson(
+            geojson_layer,
+            class_style,
+            name=title,
+            tooltip=map_settings.get('tooltip', None),
+        ).add_to(the_map)
     else:
-        color_map_name = map_settings('color_map_name')
-    linear = create_color_map(values, color_map_name)
-
-    style_function = partial(
-        style_function_color_map,
-        key='krets',
-        data=values,
-        color_map=linear,
-    )
-    folium.GeoJson(
-        geojson_layer,
-        name=title,
-        style_function=style_function,
-        highlight_function=default_highlight_function,
-        tooltip=map_settings.get('tooltip', None),
-    ).add_to(the_map)
+        folium.GeoJson(
+            geojson_layer,
+            name=title,
+            style_function=style_function,
+            highlight_function=default_highlight_function,
+            tooltip=map_settings.get('tooltip', None),
+        ).add_to(the_map)
 
     linear.caption = legend
     the_map.add_child(linear)
     folium.LayerControl().add_to(the_map)
+    if map_settings.get('bounds'):
+        the_map.fit_bounds(map_settings['bounds'])
     return the_map
 
 
+def get_output_path(filename, settings=None):
+    """Return the path to write an output file to.
+
+    Parameters
+    ----------
+    filename : string
+        The name of the output file.
+    settings : dict, optional
+        Settings for the map. If it contains ``output_dir``, the file
+        is placed in that directory. If it contains ``image``, the
+        suffix is changed to the image format.
+
+    Returns
+    -------
+    output : string
+        The path to write to.
+
+    """
+    if settings and settings.get('image'):
+        filename = str(pathlib.PurePath(filename).with_suffix(
+            '.{}'.format(settings['image']['format'])
+        ))
+    if settings and settings.get('output_dir'):
+        directory = pathlib.Path(settings['output_dir'])
+        directory.mkdir(parents=True, exist_ok=True)
+        return str(directory.joinpath(filename))
+    return filename
+
+
+def is_streamed(settings):
+    """Check if the map is written one layer at a time.
+
+    When it is, :py:func:`produce_map` accepts a generator for the
+    layers, so that they do not have to be kept in memory at once.
+    """
+    return bool(
+        settings and settings.get('stream') and
+        not settings.get('image') and not settings.get('site')
+    )
+
+
 def produce_map(geojson_layers, map_settings, output='map.html'):
     """Produce the folium map and save it to a file.
 
@@ -354,6 +1236,284 @@ def produce_map(geojson_layers, map_settings, output='map.html'):
         The file name to write the map to.
 
     """
+    if map_settings.get('image'):
+        produce_image(geojson_layers, map_settings, output)
+        return
+    if map_settings.get('site'):
+        produce_site(geojson_layers, map_settings)
+        return
+    if map_settings.get('stream'):
+        produce_streamed_map(geojson_layers, map_settings, output)
+        return
     the_map = create_folium_map(geojson_layers, map_settings)
+    save_map(the_map, output)
+
+
+def produce_streamed_map(geojson_layers, map_settings, output='map.html'):
+    """Write a map, writing each layer as soon as it is produced.
+
+    The page is rendered by folium without the layers, and the layers
+    are written between the start and the end of the page (see
+    :py:mod:`stream_html`), so that only one layer is kept in memory
+    at a time when the layers are given by a generator. If the
+    ``layer_parts`` setting is given, a layer with the same name as
+    one already written is added to that layer, so that a generator
+    can give a large layer in parts (e.g. one kommune at a time).
+
+    Parameters
+    ----------
+    geojson_layers : iterable of tuples
+        Each tuple is of form (name, geojson-dict) where the
+        name is used as a label and the geojson-dict contains
+        the geojson layer to be shown. This can be a generator.
+        With a list of tooltips (in ``map_settings``), there is one
+        tooltip for each layer written (not for each part).
+    map_settings : dict
+        A dict with settings for the folium map. The ``bounds`` are
+        used after all layers are written, so they can be set by
+        the generator producing the layers. The layers can not be
+        simplified here, since they are not all available at once.
+    output : string, optional
+        The file name to write the map to.
+
+    """
+    if map_settings.get('simplify'):
+        raise ValueError('A streamed map can not be simplified')
+    the_map = folium.Map(
+        location=map_settings.get('center', [63.447, 10.422]),
+        tiles=None,
+        zoom_start=map_settings.get('zoom', 9),
+    )
+    add_tiles_to_map(the_map)
+    class_style = create_class_style('partinavn', COLORS_PARTY)
+    the_map.add_child(class_style)
+    control = folium.LayerControl()
+    control.add_to(the_map)
+    slot = LayerSlot()
+    the_map.add_child(slot)
+    add_legend_to_map(the_map)
+    with stage('render'):
+        head, tail = split_page(the_map.get_root().render())
+    names = {
+        'map': the_map.get_name(),
+        'control': control.get_name(),
+        'style': class_style.get_name(),
+        'layers': slot.get_name(),
+    }
+    tooltip = map_settings.get('tooltip', None)
+    parts = map_settings.get('layer_parts')
+    # The position of the written layers, by name (for adding parts):
+    written = {}
+    count = 0
+    print('Writing map to "{}"'.format(output))
+    with open(output, 'w', encoding='utf-8') as outfile:
+        outfile.write(head)
+        for layer in geojson_layers:
+            index = written.get(layer[0]) if parts else None
+            layer_tooltip = tooltip
+            if isinstance(tooltip, (list, tuple)):
+                layer_tooltip = tooltip[count if index is None else index]
+            if map_settings.get('slim'):
+                layer = slim_layers(
+                    [layer],
+                    kept_properties(layer_tooltip, 1),
+                    **map_settings['slim']
+                )[0]
+            with stage('save'):
+                if index is not None:
+                    write_features(outfile, index, layer[1], names)
+                    continue
+                written[layer[0]] = count
+                count += 1
+                write_layer(
+                    outfile, layer[0], layer[1], names, tooltip=layer_tooltip
+                )
+        if map_settings.get('bounds'):
+            write_bounds(outfile, names['map'], map_settings['bounds'])
+        outfile.write(tail)
+
+
+def check_choropleth_settings(map_settings):
+    """Check that the settings can be used for a choropleth map.
+
+    Raises
+    ------
+    ValueError
+        If a setting only used for maps with many layers is given.
+
+    """
+    for key, message in CHOROPLETH_UNSUPPORTED.items():
+        if map_settings.get(key):
+            raise ValueError(message)
+
+
+def produce_choropleth(geojson_layer, data, map_settings, output='map.html'):
+    """Produce a folium choropleth map and save it to a file.
+
+    Parameters
+    ----------
+    geojson_layer : dict
+        A geojson layer to add to the map.
+    data : dict
+        The raw data to use for coloring.
+    map_settings : dict
+        A dict with settings for the folium map.
+    output : string, optional
+        The file name to write the map to.
+
+    """
+    check_choropleth_settings(map_settings)
+    if map_settings.get('image'):
+        values, linear, legend, classes = choropleth_colors(
+            data, map_settings
+        )
+        geojson_layer, style_function = choropleth_style(
+            geojson_layer, values, linear, classes
+        )
+        produce_image(
+            [(map_settings.get('title', 'Unknown'), geojson_layer)],
+            map_settings,
+            output,
+            style_function=style_function,
+            legend={'title': legend, 'color_map': linear},
+        )
+        return
+    the_map = create_folium_choropleth(geojson_layer, data, map_settings)
+    save_map(the_map, output)
+
+
+def produce_image(geojson_layers, map_settings, output,
+                  style_function=default_style_function, legend=None):
+    """Draw the map as a static PNG or SVG image.
+
+    Parameters
+    ----------
+    geojson_layers : list of tuples
+        Each tuple is of form (name, geojson-dict) where the
+        name is used as a label and the geojson-dict contains
+        the geojson layer to be shown.
+    map_settings : dict
+        A dict with settings for the map. The settings for the
+        image are given by the key ``image``.
+    output : string
+        The file name to write the image to.
+    style_function : callable, optional
+        The style function for the features.
+    legend : dict, optional
+        The legend to draw (see :py:func:`static_map.legend_layout`).
+        If not given, the parties shown are listed.
+
+    """
+    if map_settings.get('simplify'):
+        geojson_layers = simplify_layers(
+            geojson_layers, **map_settings['simplify']
+        )
+    if legend is None:
+        shown = {
+            feature['properties'].get('partinavn')
+            for _, layer in geojson_layers for feature in layer['features']
+        }
+        legend = {
+            'title': 'Partier',
+            'labels': [
+                {'text': key, 'color': val, 'opacity': OPACITY}
+                for key, val in COLORS_PARTY.items() if key in shown
+            ],
+        }
+    print('Writing image to "{}"'.format(output))
+    with stage('render'):
+        render_image(
+            geojson_layers,
+            style_function,
+            output,
+            size=map_settings['image']['size'],
+            legend=legend,
+        )
+
+
+def save_map(the_map, output):
+    """Render a folium map to html and write it to a file."""
     print('Writing map to "{}"'.format(output))
-    the_map.save(output)
+    with stage('save'):
+        written = write_external_data(the_map, output)
+    if written:
+        print('Wrote {} geometry file(s) to "{}"'.format(
+            len(written), written[0].parent
+        ))
+    with stage('render'):
+        html = the_map.get_root().render()
+    with stage('save'):
+        with open(output, 'wb') as outfile:
+            outfile.write(html.encode('utf8'))
+
+
+def get_page_settings():
+    """Return the settings for the page of a site.
+
+    Returns
+    -------
+    page_settings : dict
+        The tiles, the colors for the parties and the css file for
+        the legend, as used by :py:func:`map_server.write_site`.
+
+    """
+    tiles = [
+        {
+            'name': tile['name'],
+            'url': tile['url'],
+            'attr': ''.join(tile['attr']),
+        }
+        for tile in TILES
+    ]
+    tiles.append(
+        {
+            'name': 'openstreetmap',
+            'url': 'https://tile.openstreetmap.org/{z}/{x}/{y}.png',
+            'attr': '&copy; OpenStreetMap contributors',
+        }
+    )
+    return {
+        'tiles': tiles,
+        'colors': COLORS_PARTY,
+        'default_color': '#262626',
+        'opacity': OPACITY,
+        'legend_css': pathlib.Path(__file__).with_name(CSSURL),
+    }
+
+
+def produce_site(geojson_layers, map_settings):
+    """Write the map as a site with one file per layer.
+
+    Parameters
+    ----------
+    geojson_layers : list of tuples
+        Each typle is of form (name, geojson-dict) where the
+        name is used as a label and the geojson-dict contains
+        the geojson layer to be shown.
+    map_settings : dict
+        A dict with settings for the map. The settings for the
+        site are given by the key ``site``.
+
+    """
+    site = map_settings['site']
+    if map_settings.get('simplify'):
+        geojson_layers = simplify_layers(
+            geojson_layers, **map_settings['simplify']
+        )
+    if map_settings.get('slim'):
+        geojson_layers = slim_layers(
+            geojson_layers,
+            kept_properties(
+                map_settings.get('tooltip', None), len(geojson_layers)
+            ),
+            **map_settings['slim']
+        )
+    with stage('save'):
+        write_site(
+            geojson_layers,
+            map_settings,
+            site['directory'],
+            get_page_settings(),
+        )
+    if site.get('serve'):
+        serve(site['directory'], port=site.get('port', 8000))
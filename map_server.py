@@ -0,0 +1,428 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Write maps as a small site where layers are loaded when visible.
+
+Instead of embedding all layers in one html file, each layer is written
+to its own GeoJSON file, together with an index holding the bounding
+box for each layer. The page only loads the layers that are inside the
+current view (when zoomed in sufficiently), so the initial page load
+stays small no matter how many kommuner are included.
+
+The site can be served with a small local http server::
+
+    python map_server.py map-valgkretser
+"""
+import argparse
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import pathlib
+import re
+from jinja2 import Template
+from slugify import slugify
+from geometry import bounds, flatten_features
+
+
+PAGE = Template("""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8" />
+    <meta name="viewport" content="width=device-width, initial-scale=1.0" />
+    <title>{{ title }}</title>
+    <link rel="stylesheet"
+          href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css" />
+    <link rel="stylesheet" href="legend.css" />
+    <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+    <style>
+        html, body, #map { width: 100%; height: 100%; margin: 0; }
+        .status {
+            background-color: rgba(255, 255, 255, 0.8);
+            padding: 4px 8px;
+            border-radius: 4px;
+            font-size: 14px;
+        }
+    </style>
+</head>
+<body>
+<div id="map"></div>
+<div id='maplegend' class='maplegend'
+    style='position: absolute; z-index:9999; border:2px solid grey;
+    background-color:rgba(255, 255, 255, 0.8); border-radius:6px;
+    padding: 10px; font-size:14px; right: 20px; bottom: 20px;'>
+    <div class='legend-title'>Partier</div>
+    <div class='legend-scale'>
+        <ul class='legend-labels'>
+        {% for text, color in colors.items() %}
+            <li><span style='background:{{ color }};opacity:{{ opacity }};'></span>{{ text }}</li>
+        {% endfor %}
+        </ul>
+    </div>
+</div>
+<script>
+    var settings = {{ settings|tojson }};
+    var map = L.map('map').setView(settings.center, settings.zoom);
+    if (settings.bounds) {
+        map.fitBounds(settings.bounds);
+    }
+    var baseLayers = {};
+    settings.tiles.forEach(function(tile, i) {
+        var layer = L.tileLayer(tile.url, {attribution: tile.attr});
+        if (i === 0) {
+            layer.addTo(map);
+        }
+        baseLayers[tile.name] = layer;
+    });
+    L.control.layers(baseLayers).addTo(map);
+
+    var status = L.control({position: 'topright'});
+    status.onAdd = function() {
+        this._div = L.DomUtil.create('div', 'status');
+        return this._div;
+    };
+    status.addTo(map);
+
+    function style(feature) {
+        return {
+            fillColor: settings.colors[feature.properties.partinavn] ||
+                settings.default_color,
+            fillOpacity: settings.opacity,
+            color: '#262626',
+            weight: 0.5,
+        };
+    }
+
+    function tooltip(layer) {
+        var properties = layer.feature.properties;
+        var rows = settings.tooltip.fields.map(function(field, i) {
+            var alias = settings.tooltip.aliases[i] || '';
+            var value = properties[field];
+            return '<tr><th>' + alias + '</th><td>' +
+                (value === undefined ? '' : value) + '</td></tr>';
+        });
+        return '<table>' + rows.join('') + '</table>';
+    }
+
+    function highlight(feature, layer) {
+        layer.on({
+            mouseover: function(e) {
+                e.target.setStyle(
+                    {weight: 2.0, fillOpacity: settings.opacity + 0.15}
+                );
+            },
+            mouseout: function(e) {
+                e.target.setStyle(style(feature));
+            },
+        });
+    }
+
+    var loaded = {};
+    var versions = {};
+
+    function entryBounds(entry) {
+        return L.latLngBounds(
+            [entry.bbox[1], entry.bbox[0]], [entry.bbox[3], entry.bbox[2]]
+        );
+    }
+
+    function load(entry) {
+        loaded[entry.file] = null;
+        versions[entry.file] = entry.version;
+        var url = 'layers/' + entry.file + '?v=' + entry.version;
+        fetch(url).then(function(response) {
+            return response.json();
+        }).then(function(data) {
+            loaded[entry.file] = L.geoJson(data, {
+                style: style,
+                onEachFeature: highlight,
+            }).bindTooltip(tooltip, {sticky: true});
+            update();
+        });
+    }
+
+    function update() {
+        var view = map.getBounds();
+        var zoomed = map.getZoom() >= settings.min_zoom;
+        var visible = 0;
+        index.layers.forEach(function(entry) {
+            var show = zoomed && view.intersects(entryBounds(entry));
+            var layer = loaded[entry.file];
+            if (show) {
+                visible += 1;
+                if (layer === undefined) {
+                    load(entry);
+                } else if (layer !== null && !map.hasLayer(layer)) {
+                    layer.addTo(map);
+                }
+            } else if (layer && map.hasLayer(layer)) {
+                map.removeLayer(layer);
+            }
+        });
+        status._div.innerHTML = zoomed ?
+            visible + ' of ' + index.layers.length + ' layers in view' :
+            'Zoom in to show the results';
+    }
+
+    function refresh() {
+        fetch('index.json', {cache: 'no-store'}).then(function(response) {
+            return response.json();
+        }).then(function(data) {
+            data.layers.forEach(function(entry) {
+                var layer = loaded[entry.file];
+                if (layer !== undefined &&
+                        versions[entry.file] !== entry.version) {
+                    // The layer has been updated, load it again:
+                    if (layer && map.hasLayer(layer)) {
+                        map.removeLayer(layer);
+                    }
+                    delete loaded[entry.file];
+                }
+            });
+            index = data;
+            update();
+        });
+    }
+
+    var index = {layers: []};
+    fetch('index.json').then(function(response) {
+        return response.json();
+    }).then(function(data) {
+        index = data;
+        update();
+        map.on('moveend', update);
+        if (settings.refresh) {
+            setInterval(refresh, 1000 * settings.refresh);
+        }
+    });
+</script>
+</body>
+</html>
+""")
+
+
+def layer_filename(name):
+    """Return the file name to use for a layer."""
+    return '{}.geojson'.format(slugify(name))
+
+
+def write_layer(directory, name, data):
+    """Write a single layer to the site and return its index entry.
+
+    Parameters
+    ----------
+    directory : object like pathlib.Path
+        The directory containing the site.
+    name : string
+        The name of the layer.
+    data : dict
+        The geojson data for the layer.
+
+    Returns
+    -------
+    entry : dict
+        The entry for the layer in the index. The ``version`` of the
+        entry changes each time the layer is written.
+
+    """
+    filename = layer_filename(name)
+    layer_dir = directory.joinpath('layers')
+    layer_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = layer_dir.joinpath(filename + '.tmp')
+    with open(tmp_file, 'w') as output:
+        json.dump(data, output)
+    tmp_file.replace(layer_dir.joinpath(filename))
+    return {
+        'name': name,
+        'file': filename,
+        'version': layer_dir.joinpath(filename).stat().st_mtime_ns,
+        'bbox': bounds(flatten_features(data['features'])).tolist(),
+        'features': len(data['features']),
+    }
+
+
+def write_index(directory, entries):
+    """Write the index of layers for the site."""
+    tmp_file = directory.joinpath('index.json.tmp')
+    with open(tmp_file, 'w') as output:
+        json.dump({'layers': entries}, output)
+    tmp_file.replace(directory.joinpath('index.json'))
+
+
+def write_site(geojson_layers, map_settings, directory, page_settings):
+    """Write the layers and a page for loading them to a directory.
+
+    Parameters
+    ----------
+    geojson_layers : list of tuples
+        Each typle is of form (name, geojson-dict) where the
+        name is used as a label and the geojson-dict contains
+        the geojson layer to be shown.
+    map_settings : dict
+        A dict with settings for the map.
+    directory : string or object like pathlib.Path
+        The directory to write the site to.
+    page_settings : dict
+        Settings for the page, that is the ``tiles``, ``colors`` (for
+        the parties), ``opacity``, ``default_color`` and the css file
+        for the legend (``legend_css``).
+
+    Returns
+    -------
+    entries : list of dicts
+        The index entries for the layers written.
+
+    """
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    entries = [
+        write_layer(directory, name, data) for name, data in geojson_layers
+    ]
+    write_index(directory, entries)
+    tooltip = map_settings.get('tooltip', None)
+    if isinstance(tooltip, (list, tuple)):
+        tooltip = tooltip[0] if tooltip else None
+    settings = {
+        'center': [float(i) for i in map_settings.get('center', [63.4, 10.4])],
+        'zoom': map_settings.get('zoom', 9),
+        'bounds': map_settings.get('bounds', None),
+        'min_zoom': map_settings.get('site', {}).get('min_zoom', 9),
+        # Seconds between checking for updated layers:
+        'refresh': map_settings.get('site', {}).get('refresh', None),
+        'tiles': page_settings['tiles'],
+        'colors': page_settings['colors'],
+        'default_color': page_settings['default_color'],
+        'opacity': page_settings['opacity'],
+        'tooltip': {
+            'fields': list(getattr(tooltip, 'fields', ['partinavn'])),
+            'aliases': list(getattr(tooltip, 'aliases', ['Parti:'])),
+        },
+    }
+    html = PAGE.render(
+        title=map_settings.get('title', 'Valg'),
+        settings=settings,
+        colors=page_settings['colors'],
+        opacity=page_settings['opacity'],
+    )
+    with open(directory.joinpath('index.html'), 'w') as output:
+        output.write(html)
+    legend_css = pathlib.Path(page_settings['legend_css'])
+    if legend_css.is_file():
+        directory.joinpath('legend.css').write_text(legend_css.read_text())
+    print('Wrote {} layers to "{}"'.format(len(entries), directory))
+    return entries
+
+
+# Geometry files named by their content (see external_data.py):
+HASHED_FILE = re.compile(r'^[0-9a-f]{20}\.geojson$')
+
+
+# Precompressed copies of files, in order of preference:
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+class LayerRequestHandler(SimpleHTTPRequestHandler):
+    """Serve the site, letting browsers revalidate cached layers.
+
+    Files named by their content never change, so browsers may keep
+    them, and their precompressed copies are sent to browsers which
+    accept them.
+    """
+
+    hashed = False
+
+    def send_head(self):
+        """Send a precompressed copy of a hashed file, if possible."""
+        path = self.translate_path(self.path)
+        self.hashed = bool(HASHED_FILE.match(os.path.basename(path)))
+        if not self.hashed:
+            return super().send_head()
+        accepted = [
+            i.split(';')[0].strip()
+            for i in self.headers.get('Accept-Encoding', '').split(',')
+        ]
+        for encoding, suffix in ENCODINGS:
+            if encoding not in accepted or not os.path.isfile(path + suffix):
+                continue
+            infile = open(path + suffix, 'rb')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/geo+json')
+            self.send_header('Content-Encoding', encoding)
+            self.send_header(
+                'Content-Length', str(os.fstat(infile.fileno()).st_size)
+            )
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return infile
+        return super().send_head()
+
+    def end_headers(self):
+        """Add a cache header before ending the headers."""
+        if self.hashed:
+            self.send_header(
+                'Cache-Control', 'public, max-age=31536000, immutable'
+            )
+        else:
+            self.send_header('Cache-Control', 'no-cache')
+        super().end_headers()
+
+
+def create_server(directory, port=8000):
+    """Create a server for a site on localhost.
+
+    Parameters
+    ----------
+    directory : string or object like pathlib.Path
+        The directory containing the site.
+    port : integer, optional
+        The port to serve the site on.
+
+    Returns
+    -------
+    server : object like http.server.ThreadingHTTPServer
+        The server, which is started with ``serve_forever``.
+
+    """
+    handler = partial(LayerRequestHandler, directory=str(directory))
+    return ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+
+def serve(directory, port=8000):
+    """Serve a site on localhost.
+
+    Parameters
+    ----------
+    directory : string or object like pathlib.Path
+        The directory containing the site.
+    port : integer, optional
+        The port to serve the site on.
+
+    """
+    with create_server(directory, port=port) as server:
+        print(
+            'Serving "{}" at http://127.0.0.1:{}/ (stop with Ctrl-C)'.format(
+                directory, port
+            )
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def add_arguments(parser):
+    """Add the command line arguments for this script."""
+    parser.add_argument('directory', help='The directory with the site.')
+    parser.add_argument(
+        '--port', type=int, default=8000, help='The port to use.'
+    )
+
+
+def run(args):
+    """Serve a site from parsed command line arguments."""
+    serve(args.directory, port=args.port)
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Serve a map site.')
+    add_arguments(PARSER)
+    run(PARSER.parse_args())
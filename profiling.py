@@ -0,0 +1,306 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Measure where the time goes when creating a map.
+
+The steps of creating a map (reading the csv file, extracting the
+results, loading the geometries, adding the results to them, building
+the folium map, rendering the html and saving it) are marked as stages,
+either with :py:func:`stage` or :py:func:`profiled`. When profiling is
+enabled (with ``--profile FILE``), the wall time, the cpu time, the
+peak resident memory and the change in the number of live Python
+objects are recorded for each stage, and a report is written when the
+script is done. The report is either a json summary for each stage, or
+a trace in the Trace Event Format which can be opened as a flame graph
+in chrome://tracing, https://ui.perfetto.dev or https://speedscope.app.
+
+With ``--profile-cprofile DIRECTORY``, each stage is also profiled
+with :py:mod:`cProfile`, and the statistics for each stage are written
+to ``DIRECTORY/<stage>.prof`` (to be read with :py:mod:`pstats` or,
+for instance, snakeviz). Time in a nested stage is only counted for
+the nested stage.
+
+When profiling is not enabled, the stages do nothing.
+"""
+import contextlib
+import cProfile
+import functools
+import gc
+import json
+import os
+import pathlib
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+
+PROFILE = {
+    'enabled': False,
+    'cprofile': None,
+}
+
+
+_RECORD = {
+    'start': None,
+    'stack': [],
+    'events': [],
+    'profilers': {},
+}
+
+
+def peak_rss():
+    """Return the peak resident memory of the process (in bytes)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # The peak is given in bytes on macOS and in kilobytes elsewhere:
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _sample():
+    """Take the measurements done at the start and end of a stage."""
+    return {
+        'wall': time.perf_counter(),
+        'cpu': time.process_time(),
+        'objects': len(gc.get_objects()),
+    }
+
+
+def _switch_profiler(old, new):
+    """Move cProfile from one stage to another."""
+    if PROFILE['cprofile'] is None:
+        return
+    profilers = _RECORD['profilers']
+    if old is not None:
+        profilers[old].disable()
+    if new is not None:
+        if new not in profilers:
+            profilers[new] = cProfile.Profile()
+        profilers[new].enable()
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Record the time and memory used in a stage, if profiling.
+
+    Parameters
+    ----------
+    name : string
+        The name of the stage. Stages with the same name are
+        summed in the report.
+
+    Notes
+    -----
+    Only stages in the main thread are recorded. Work done in other
+    threads should be recorded where the main thread waits for it.
+
+    """
+    if not PROFILE['enabled'] or (
+            threading.current_thread() is not threading.main_thread()):
+        yield
+        return
+    stack = _RECORD['stack']
+    parent = stack[-1] if stack else None
+    _switch_profiler(parent, name)
+    stack.append(name)
+    start = _sample()
+    try:
+        yield
+    finally:
+        end = _sample()
+        stack.pop()
+        _switch_profiler(name, parent)
+        _RECORD['events'].append(
+            {
+                'name': name,
+                'depth': len(stack),
+                'start': start['wall'] - _RECORD['start'],
+                'wall': end['wall'] - start['wall'],
+                'cpu': end['cpu'] - start['cpu'],
+                'objects': end['objects'] - start['objects'],
+                'peak_rss': peak_rss(),
+            }
+        )
+
+
+def profiled(name):
+    """Decorate a function so that each call is recorded as a stage."""
+    def decorator(function):
+        """Wrap the function in a stage."""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            """Call the function in a stage."""
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summarize(events):
+    """Sum the measurements for each stage.
+
+    Parameters
+    ----------
+    events : list of dicts
+        The recorded stages.
+
+    Returns
+    -------
+    summary : dict
+        For each stage, the number of calls, the total wall and cpu
+        time (in seconds), the total change in the number of objects
+        and the largest peak resident memory (in bytes).
+
+    """
+    summary = {}
+    for event in events:
+        total = summary.setdefault(
+            event['name'],
+            {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'objects': 0,
+             'peak_rss': None},
+        )
+        total['calls'] += 1
+        total['wall'] += event['wall']
+        total['cpu'] += event['cpu']
+        total['objects'] += event['objects']
+        if event['peak_rss'] is not None:
+            total['peak_rss'] = max(total['peak_rss'] or 0, event['peak_rss'])
+    return summary
+
+
+def trace_events(events):
+    """Convert the recorded stages to the Trace Event Format."""
+    pid = os.getpid()
+    return {
+        'traceEvents': [
+            {
+                'name': event['name'],
+                'cat': 'valg',
+                'ph': 'X',
+                'ts': event['start'] * 1e6,
+                'dur': event['wall'] * 1e6,
+                'pid': pid,
+                'tid': 0,
+                'args': {
+                    'cpu': event['cpu'],
+                    'objects': event['objects'],
+                    'peak_rss': event['peak_rss'],
+                },
+            }
+            for event in events
+        ],
+        'displayTimeUnit': 'ms',
+    }
+
+
+def write_report(filename, report_format='json'):
+    """Write the recorded stages to a file.
+
+    Parameters
+    ----------
+    filename : string
+        The file to write to.
+    report_format : string, optional
+        Either ``json`` for a summary of each stage (and the recorded
+        stages in the order they ended) or ``trace`` for the Trace
+        Event Format.
+
+    """
+    events = _RECORD['events']
+    if report_format == 'trace':
+        report = trace_events(events)
+    else:
+        report = {
+            'command': sys.argv,
+            'stages': summarize(events),
+            'events': events,
+        }
+    with open(filename, 'w') as output:
+        json.dump(report, output, indent=2)
+    print('Wrote profile to "{}"'.format(filename))
+    if PROFILE['cprofile'] is not None:
+        directory = pathlib.Path(PROFILE['cprofile'])
+        directory.mkdir(parents=True, exist_ok=True)
+        for name, profiler in _RECORD['profilers'].items():
+            profiler.dump_stats(directory.joinpath('{}.prof'.format(name)))
+        print('Wrote cProfile statistics to "{}"'.format(directory))
+
+
+def print_summary(events):
+    """Print the time used in each stage."""
+    summary = summarize(events)
+    print('{:20s} {:>6s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+        'stage', 'calls', 'wall (s)', 'cpu (s)', 'objects', 'rss (MB)'
+    ))
+    for name, total in sorted(summary.items(), key=lambda i: -i[1]['wall']):
+        rss = total['peak_rss']
+        print('{:20s} {:6d} {:10.3f} {:10.3f} {:10d} {:>10s}'.format(
+            name, total['calls'], total['wall'], total['cpu'],
+            total['objects'],
+            '-' if rss is None else '{:.1f}'.format(rss / 1e6),
+        ))
+
+
+@contextlib.contextmanager
+def profile_run(args, name='total'):
+    """Profile a script run if asked for in the command line arguments.
+
+    Parameters
+    ----------
+    args : object like argparse.Namespace
+        The parsed command line arguments, see
+        :py:func:`add_profile_arguments`.
+    name : string, optional
+        The name of the stage covering the whole run.
+
+    """
+    if args.profile is None:
+        yield
+        return
+    PROFILE['enabled'] = True
+    PROFILE['cprofile'] = args.profile_cprofile
+    _RECORD['start'] = time.perf_counter()
+    _RECORD['events'] = []
+    _RECORD['profilers'] = {}
+    try:
+        with stage(name):
+            yield
+    finally:
+        PROFILE['enabled'] = False
+        print_summary(_RECORD['events'])
+        write_report(args.profile, report_format=args.profile_format)
+
+
+def add_profile_arguments(parser):
+    """Add command line arguments for profiling.
+
+    Parameters
+    ----------
+    parser : object like argparse.ArgumentParser
+        The parser to add the arguments to.
+
+    """
+    parser.add_argument(
+        '--profile',
+        default=None,
+        metavar='FILE',
+        help='Record the time and memory used in each stage to this file.',
+    )
+    parser.add_argument(
+        '--profile-format',
+        choices=('json', 'trace'),
+        default='json',
+        help=(
+            'Write the profile as a json summary or as a trace for '
+            'flame graph viewers.'
+        ),
+    )
+    parser.add_argument(
+        '--profile-cprofile',
+        default=None,
+        metavar='DIRECTORY',
+        help='Also write cProfile statistics for each stage here.',
+    )
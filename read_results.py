@@ -0,0 +1,208 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Read the election results from the csv files.
+
+This module only depends on pandas (and not on folium), so that it can
+be imported quickly by scripts which only need the results. The names
+are also available from :py:mod:`map_basics`.
+"""
+from functools import partial
+import os
+import pathlib
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from csv_cache import file_signature, load_cache, save_cache
+from profiling import profiled
+
+
+CSV_CACHE = {
+    'use': True,
+    'rebuild': False,
+    'memory': False,
+}
+
+
+# Results kept in memory (when CSV_CACHE['memory'] is set), by file and
+# variant, together with the size and modification time of the file:
+RESULTS_IN_MEMORY = {}
+
+
+CSV_READING = {
+    'lean': False,
+    'chunksize': None,
+}
+
+
+# The columns (and their types) read when reading lean results. Names
+# and ids are stored as categories, that is, as small integer codes
+# and a table with the distinct values:
+LEAN_COLUMNS = {
+    'Fylkenummer': 'category',
+    'Fylkenavn': 'category',
+    'Kommunenummer': 'category',
+    'Kommunenavn': 'category',
+    'Stemmekretsnummer': 'category',
+    'Stemmekretsnavn': 'category',
+    'Partinavn': 'category',
+    'Oppslutning prosentvis': 'float64',
+}
+
+
+def add_cache_arguments(parser):
+    """Add command line arguments for reading and caching the csv file.
+
+    Parameters
+    ----------
+    parser : object like argparse.ArgumentParser
+        The parser to add the arguments to.
+
+    """
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not read or write the cached version of the csv file.',
+    )
+    parser.add_argument(
+        '--rebuild-cache',
+        action='store_true',
+        help='Parse the csv file and rebuild the cache.',
+    )
+    parser.add_argument(
+        '--lean',
+        action='store_true',
+        help=(
+            'Only read the columns needed for the maps, and store '
+            'names and ids as categories.'
+        ),
+    )
+    parser.add_argument(
+        '--chunksize',
+        type=int,
+        default=None,
+        help='Read the csv file in chunks of this many rows (implies --lean).',
+    )
+
+
+def set_cache_options(args):
+    """Set up the csv cache from parsed command line arguments."""
+    CSV_CACHE['use'] = not args.no_cache
+    CSV_CACHE['rebuild'] = args.rebuild_cache
+    if args.chunksize is not None and args.chunksize < 1:
+        raise SystemExit('--chunksize must be positive')
+    # Only the lean reader reads in chunks:
+    CSV_READING['lean'] = args.lean or args.chunksize is not None
+    CSV_READING['chunksize'] = args.chunksize
+
+
+def _parse_csv_results(result_file):
+    """Parse the results in the given csv file."""
+    results = pd.read_csv(
+        result_file,
+        sep=';',
+        decimal=',',
+        converters={
+            'Fylkenummer': str,
+            'Kommunenummer': str,
+            'Stemmekretsnummer': str
+        },
+    )
+    return results
+
+
+def _concatenate_chunks(chunks):
+    """Concatenate results read in chunks, merging the categories."""
+    chunks = list(chunks)
+    if not chunks:
+        return pd.DataFrame(
+            {key: pd.Series(dtype=val) for key, val in LEAN_COLUMNS.items()}
+        )
+    data = {}
+    for column in chunks[0].columns:
+        if isinstance(chunks[0][column].dtype, pd.CategoricalDtype):
+            data[column] = union_categoricals(
+                [chunk[column] for chunk in chunks]
+            )
+        else:
+            data[column] = np.concatenate(
+                [chunk[column].to_numpy() for chunk in chunks]
+            )
+    return pd.DataFrame(data)
+
+
+def _parse_csv_results_lean(result_file, chunksize=None):
+    """Parse the columns needed for the maps in the given csv file.
+
+    Parameters
+    ----------
+    result_file : string
+        The csv file to read.
+    chunksize : integer, optional
+        If given, the file is read in chunks of this many rows, so
+        that the full text of the file is never held in memory.
+
+    Returns
+    -------
+    results : object like pandas.DataFrame
+        The results, where names and ids are categories.
+
+    """
+    reader = pd.read_csv(
+        result_file,
+        sep=';',
+        decimal=',',
+        usecols=lambda column: column in LEAN_COLUMNS,
+        dtype=LEAN_COLUMNS,
+        chunksize=chunksize,
+    )
+    if chunksize is None:
+        return reader
+    with reader:
+        return _concatenate_chunks(reader)
+
+
+def _read_csv_results(result_file, variant, parse):
+    """Read the results, using the cache file if enabled."""
+    if not CSV_CACHE['use']:
+        return parse(result_file)
+    if not CSV_CACHE['rebuild']:
+        results = load_cache(result_file, variant=variant)
+        if results is not None:
+            return results
+    signature = file_signature(result_file)
+    results = parse(result_file)
+    save_cache(results, result_file, signature=signature, variant=variant)
+    return results
+
+
+@profiled('read_csv')
+def read_csv_results(result_file):
+    """Read the results from the given csv file.
+
+    If enabled in ``CSV_CACHE``, the parsed results are stored in a
+    sidecar cache file which is reused as long as the csv file
+    is unchanged. If ``CSV_READING['lean']`` is set, only the columns
+    in ``LEAN_COLUMNS`` are read. If ``CSV_CACHE['memory']`` is set
+    (as in the daemon, see :py:mod:`valg`), the results are also kept
+    in memory and reused as long as the csv file is unchanged.
+    """
+    print('Reading results from "{}"'.format(result_file))
+    variant = None
+    if CSV_READING['lean']:
+        variant = 'lean'
+        parse = partial(
+            _parse_csv_results_lean, chunksize=CSV_READING['chunksize']
+        )
+    else:
+        parse = _parse_csv_results
+    if not (CSV_CACHE['memory'] and CSV_CACHE['use']):
+        return _read_csv_results(result_file, variant, parse)
+    key = (pathlib.Path(result_file).resolve(), variant)
+    stat = os.stat(result_file)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    kept = RESULTS_IN_MEMORY.get(key)
+    if kept is not None and kept[0] == signature and not CSV_CACHE['rebuild']:
+        return kept[1]
+    results = _read_csv_results(result_file, variant, parse)
+    RESULTS_IN_MEMORY[key] = (signature, results)
+    return results
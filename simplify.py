@@ -0,0 +1,339 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Simplify the polygons in geojson layers, preserving shared borders.
+
+The layers are first split into shared arcs (see :py:mod:`topology`),
+and each arc is simplified once with the Douglas-Peucker algorithm.
+Borders shared by neighbouring areas are therefore simplified in the
+same way for both areas, and no gaps or overlaps are introduced.
+
+For each point, the Douglas-Peucker distance at which it is kept is
+calculated once. Simplifying with a given tolerance is then just a
+matter of selecting the points with a larger distance, which makes it
+cheap to search for the tolerance giving a target output size.
+
+Simplified geometries are cached in ``CACHE_DIR``, keyed by a hash of
+the input geometries and the tolerance or target size.
+"""
+import hashlib
+import json
+import pathlib
+import numpy as np
+from geometry import concatenate_flats, unflatten_geometry
+from topology import Topology
+
+
+CACHE_DIR = pathlib.Path('.valg-cache')
+
+
+# The smallest number of coordinates (including the closing one) a
+# simplified ring can have:
+MIN_RING_POINTS = 4
+
+
+def add_simplify_arguments(parser):
+    """Add command line arguments for simplifying the geometries.
+
+    Parameters
+    ----------
+    parser : object like argparse.ArgumentParser
+        The parser to add the arguments to.
+
+    """
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '--simplify',
+        type=float,
+        default=None,
+        metavar='TOLERANCE',
+        help=(
+            'Simplify the polygons, using the given tolerance '
+            '(in degrees, e.g. 0.0001).'
+        ),
+    )
+    group.add_argument(
+        '--simplify-size',
+        type=int,
+        default=None,
+        metavar='BYTES',
+        help='Simplify the polygons to approximately the given size.',
+    )
+
+
+def get_simplify_settings(args):
+    """Get the simplify settings from parsed command line arguments."""
+    if args.simplify is not None:
+        return {'tolerance': args.simplify}
+    if args.simplify_size is not None:
+        return {'size': args.simplify_size}
+    return None
+
+
+def _segment_distance(points, start, end):
+    """Distance from points to the line segment from start to end."""
+    segment = end - start
+    length2 = np.dot(segment, segment)
+    if length2 == 0.0:
+        return np.hypot(*(points - start).T)
+    along = np.clip(np.dot(points - start, segment) / length2, 0.0, 1.0)
+    closest = start + along[:, np.newaxis] * segment
+    return np.hypot(*(points - closest).T)
+
+
+def douglas_peucker_importance(points):
+    """Calculate the tolerance up to which each point is kept.
+
+    Parameters
+    ----------
+    points : numpy.array
+        The (x, y) coordinates of a line.
+
+    Returns
+    -------
+    importance : numpy.array
+        A point is kept when simplifying with a tolerance smaller
+        than its importance. The end points are always kept.
+
+    """
+    npoint = len(points)
+    importance = np.full(npoint, np.inf)
+    stack = [(0, npoint - 1, np.inf)]
+    while stack:
+        first, last, limit = stack.pop()
+        if last - first < 2:
+            continue
+        dist = _segment_distance(
+            points[first + 1:last], points[first], points[last]
+        )
+        idx = int(np.argmax(dist))
+        # A point can not be more important than the point that
+        # split the segment it is in:
+        value = min(dist[idx], limit)
+        idx += first + 1
+        importance[idx] = value
+        stack.append((first, idx, value))
+        stack.append((idx, last, value))
+    return importance
+
+
+class Simplifier:
+    """Simplify a set of geojson layers with different tolerances.
+
+    Attributes
+    ----------
+    topology : object like topology.Topology
+        The shared arcs for the layers.
+    arcs : list of numpy.arrays
+        The coordinates for each arc.
+    importance : list of numpy.arrays
+        The Douglas-Peucker importance for the points in each arc.
+    usage : numpy.array
+        The number of rings using each arc.
+
+    """
+
+    def __init__(self, geojson_layers):
+        """Split the layers into arcs and rank the points."""
+        self.topology = Topology(geojson_layers)
+        self.arcs = self.topology.arc_coordinates()
+        self.importance = [
+            douglas_peucker_importance(arc) for arc in self.arcs
+        ]
+        self._protect_rings()
+        # How many times each arc is used by the rings:
+        refs = [ref if ref >= 0 else ~ref for ring in self.topology.rings
+                for ref in ring]
+        self.usage = np.bincount(refs, minlength=len(self.arcs))
+        self.nring = len(self.topology.rings)
+        self.sorted_importance = np.sort(np.concatenate(
+            self.importance + [np.zeros(0)]
+        ))
+        finite = np.isfinite(self.sorted_importance)
+        self.sorted_importance = self.sorted_importance[finite]
+
+    def _protect_rings(self, min_points=MIN_RING_POINTS):
+        """Keep enough points in each ring for it to stay a polygon.
+
+        The most important points in the arcs of each ring are made
+        non-removable until the ring keeps at least ``min_points``
+        coordinates for any tolerance. The importance belongs to the
+        arcs, so all the rings sharing an arc keep the same points.
+        """
+        for ring in self.topology.rings:
+            # With only the end points of the arcs, a ring has one
+            # point per arc, plus the closing point:
+            need = min_points - 1 - len(ring)
+            if need <= 0:
+                continue
+            candidates = [
+                (value, arc, idx)
+                for arc in {ref if ref >= 0 else ~ref for ref in ring}
+                for idx, value in enumerate(self.importance[arc])
+                if np.isfinite(value)
+            ]
+            candidates.sort(reverse=True)
+            for _, arc, idx in candidates[:need]:
+                self.importance[arc][idx] = np.inf
+
+    def count_points(self, tolerance):
+        """Count the points in the layers for a given tolerance."""
+        kept = np.array(
+            [np.count_nonzero(i > tolerance) for i in self.importance],
+            dtype=np.int64,
+        )
+        if len(kept) == 0:
+            return 0
+        return int(np.dot(self.usage, kept - 1)) + self.nring
+
+    def tolerance_for_size(self, size, other_bytes, bytes_per_point):
+        """Find the smallest tolerance giving at most the target size.
+
+        Parameters
+        ----------
+        size : integer
+            The target size (in bytes).
+        other_bytes : integer
+            The number of bytes used for things other than
+            coordinates.
+        bytes_per_point : float
+            The (average) number of bytes used for one point.
+
+        Returns
+        -------
+        tolerance : float
+            The tolerance to use.
+
+        """
+        candidates = np.unique(
+            np.concatenate(([0.0], self.sorted_importance))
+        )
+        low, high = 0, len(candidates) - 1
+        while low < high:
+            middle = (low + high) // 2
+            npoint = self.count_points(candidates[middle])
+            if other_bytes + npoint * bytes_per_point <= size:
+                high = middle
+            else:
+                low = middle + 1
+        return float(candidates[low])
+
+    def simplify(self, tolerance):
+        """Return the layers simplified with the given tolerance."""
+        arcs = [
+            arc[importance > tolerance]
+            for arc, importance in zip(self.arcs, self.importance)
+        ]
+        return self.topology.to_layers(arcs=arcs)
+
+
+def _hash_layers(geojson_layers, flats):
+    """Create a key for the geometries in some layers."""
+    sha = hashlib.sha256()
+    for (name, _), flat in zip(geojson_layers, flats):
+        sha.update(str(name).encode('utf-8'))
+        for key in sorted(flat):
+            sha.update(np.ascontiguousarray(flat[key]).tobytes())
+    return sha.hexdigest()
+
+
+def _cache_file(key, settings):
+    """Return the cache file for simplified layers."""
+    if 'tolerance' in settings:
+        name = 'simplify-{}-tolerance-{!r}.npz'.format(
+            key, float(settings['tolerance'])
+        )
+    else:
+        name = 'simplify-{}-size-{}.npz'.format(key, int(settings['size']))
+    return CACHE_DIR.joinpath(name)
+
+
+def _save_cached(cache_file, geojson_layers):
+    """Store the geometries for simplified layers."""
+    flats = Topology.flatten_layers(geojson_layers)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_name(cache_file.name + '.tmp')
+    with open(tmp_file, 'wb') as output:
+        np.savez(output, **concatenate_flats(flats))
+    tmp_file.replace(cache_file)
+
+
+def _load_cached(cache_file, geojson_layers):
+    """Apply cached simplified geometries to some layers."""
+    with np.load(cache_file, allow_pickle=False) as archive:
+        flat = {key: archive[key] for key in archive.files}
+    new_layers = []
+    index = 0
+    for name, data in geojson_layers:
+        new_data = {
+            key: val for key, val in data.items() if key != 'features'
+        }
+        new_data['features'] = []
+        for feature in data['features']:
+            new_feature = {
+                key: val for key, val in feature.items() if key != 'geometry'
+            }
+            new_feature['geometry'] = unflatten_geometry(flat, index)
+            new_data['features'].append(new_feature)
+            index += 1
+        new_layers.append((name, new_data))
+    return new_layers
+
+
+def simplify_layers(geojson_layers, tolerance=None, size=None, cache=True):
+    """Simplify the polygons in geojson layers.
+
+    Parameters
+    ----------
+    geojson_layers : list of tuples
+        Each tuple is of form (name, geojson-dict) where the
+        name is used as a label and the geojson-dict contains
+        the geojson layer to be shown.
+    tolerance : float, optional
+        The tolerance to use for the simplification.
+    size : integer, optional
+        If given (and no tolerance is given), a tolerance is selected
+        so that the layers take up approximately this many bytes.
+    cache : boolean, optional
+        If True, the simplified geometries are cached.
+
+    Returns
+    -------
+    geojson_layers : list of tuples
+        The simplified layers. The features are copies of the
+        original ones, with simplified geometries.
+
+    """
+    if tolerance is None and size is None:
+        return geojson_layers
+    settings = {'tolerance': tolerance} if tolerance is not None else (
+        {'size': size}
+    )
+    cache_file = None
+    if cache:
+        key = _hash_layers(
+            geojson_layers, Topology.flatten_layers(geojson_layers)
+        )
+        cache_file = _cache_file(key, settings)
+        if cache_file.is_file():
+            print('Loading simplified layers from "{}"'.format(cache_file))
+            return _load_cached(cache_file, geojson_layers)
+    simplifier = Simplifier(geojson_layers)
+    if tolerance is None:
+        total = len(json.dumps([data for _, data in geojson_layers]))
+        geometry = len(json.dumps(
+            [
+                feature['geometry'] for _, data in geojson_layers
+                for feature in data['features']
+            ]
+        ))
+        npoint = max(simplifier.count_points(-1.0), 1)
+        tolerance = simplifier.tolerance_for_size(
+            size,
+            other_bytes=total - geometry,
+            bytes_per_point=geometry / npoint,
+        )
+        print('Simplifying with tolerance {:g}'.format(tolerance))
+    new_layers = simplifier.simplify(tolerance)
+    if cache_file is not None:
+        _save_cached(cache_file, new_layers)
+    return new_layers
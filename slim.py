@@ -0,0 +1,160 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Make the layers smaller before they are written to the map.
+
+The features read from the Kartverket files keep all their original
+properties, and coordinates with full precision. Before the layers are
+written, the properties which are not shown in the tooltips or used
+for styling are removed, the coordinates are rounded (5 decimals is
+about 1 m), and points which become equal to the previous point are
+removed. The number of bytes saved is reported for each layer.
+"""
+import json
+from geometry import flatten_features, round_coordinates, unflatten_geometry
+
+
+# Properties used for styling (and filtering, see layer_filter) the
+# features:
+STYLE_PROPERTIES = ('partinavn', 'krets', 'klasse', 'lag')
+
+
+def add_slim_arguments(parser):
+    """Add command line arguments for making the layers smaller.
+
+    Parameters
+    ----------
+    parser : object like argparse.ArgumentParser
+        The parser to add the arguments to.
+
+    """
+    parser.add_argument(
+        '--slim',
+        action='store_true',
+        help=(
+            'Remove properties not used by the map, round the coordinates '
+            'and remove repeated points.'
+        ),
+    )
+    parser.add_argument(
+        '--precision',
+        type=int,
+        default=5,
+        metavar='DECIMALS',
+        help=(
+            'The number of decimals to keep in the coordinates with --slim '
+            '(5 is about 1 m).'
+        ),
+    )
+
+
+def get_slim_settings(args):
+    """Get the settings for slimming from parsed command line arguments."""
+    if not args.slim:
+        return None
+    return {'decimals': args.precision}
+
+
+def tooltip_fields(tooltip):
+    """Return the properties shown by a tooltip."""
+    return tuple(getattr(tooltip, 'fields', None) or ())
+
+
+def kept_properties(tooltips, nlayer):
+    """Return the properties to keep for each layer.
+
+    Parameters
+    ----------
+    tooltips : object like folium.features.GeoJsonTooltip or list
+        The tooltip for all layers, or a list with one for each layer.
+    nlayer : integer
+        The number of layers.
+
+    Returns
+    -------
+    keep : list of tuples of strings
+        The properties to keep for each layer.
+
+    """
+    if not isinstance(tooltips, (list, tuple)):
+        tooltips = [tooltips for _ in range(nlayer)]
+    return [STYLE_PROPERTIES + tooltip_fields(tooltip) for tooltip in tooltips]
+
+
+def slim_layer(geojson_layer, keep, decimals=5):
+    """Make a copy of a layer with fewer properties and points.
+
+    Parameters
+    ----------
+    geojson_layer : dict
+        The geojson layer.
+    keep : iterable of strings
+        The properties to keep.
+    decimals : integer, optional
+        The number of decimals to keep in the coordinates.
+
+    Returns
+    -------
+    geojson_layer : dict
+        The new layer.
+
+    """
+    keep = set(keep)
+    features = geojson_layer['features']
+    flat = round_coordinates(flatten_features(features), decimals)
+    new_layer = {
+        key: val for key, val in geojson_layer.items() if key != 'features'
+    }
+    new_layer['features'] = []
+    for i, feature in enumerate(features):
+        new_feature = {
+            key: val for key, val in feature.items()
+            if key not in ('properties', 'geometry')
+        }
+        new_feature['properties'] = {
+            key: val for key, val in (feature.get('properties') or {}).items()
+            if key in keep
+        }
+        new_feature['geometry'] = unflatten_geometry(flat, i)
+        new_layer['features'].append(new_feature)
+    return new_layer
+
+
+def slim_layers(geojson_layers, keep, decimals=5):
+    """Make the layers smaller and report the bytes saved.
+
+    Parameters
+    ----------
+    geojson_layers : list of tuples
+        Each tuple is of form (name, geojson-dict) where the
+        name is used as a label and the geojson-dict contains
+        the geojson layer to be shown.
+    keep : list of iterables of strings
+        The properties to keep for each layer.
+    decimals : integer, optional
+        The number of decimals to keep in the coordinates.
+
+    Returns
+    -------
+    geojson_layers : list of tuples
+        The new layers.
+
+    """
+    new_layers = []
+    before_total, after_total = 0, 0
+    for (name, data), layer_keep in zip(geojson_layers, keep):
+        new_data = slim_layer(data, layer_keep, decimals=decimals)
+        before = len(json.dumps(data))
+        after = len(json.dumps(new_data))
+        before_total += before
+        after_total += after
+        print('Slimmed "{}": {} -> {} bytes (saved {:.1f} %)'.format(
+            name, before, after, 100.0 * (before - after) / max(before, 1)
+        ))
+        new_layers.append((name, new_data))
+    if len(new_layers) > 1:
+        print('Slimmed all layers: {} -> {} bytes (saved {:.1f} %)'.format(
+            before_total,
+            after_total,
+            100.0 * (before_total - after_total) / max(before_total, 1),
+        ))
+    return new_layers
@@ -0,0 +1,526 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Find the voting area (and its result) containing given points.
+
+A persistent index is built over the voting areas in ``valgkretser/``:
+
+* A uniform grid over the bounding boxes, where each grid cell lists the
+  voting areas whose bounding box overlaps the cell.
+* For each voting area, its edges are sorted into horizontal strips of
+  its bounding box.
+
+To locate a point, the candidate areas are taken from the grid cell
+containing the point, and an exact point-in-polygon test (ray casting)
+is done for each candidate, using only the edges in the strip at the
+height of the point. All steps are vectorized over batches of points.
+
+The index is stored in ``valgkretser/valgkretser.index.npz`` and it is
+rebuilt when the GeoJSON files change. Points are looked up with::
+
+    python spatial_index.py 2019-09-14_partifordeling_4_ko_2019.csv --point 10.39 63.43
+
+or, for many points, with a csv file with ``lon`` and ``lat`` columns::
+
+    python spatial_index.py 2019-09-14_partifordeling_4_ko_2019.csv --points adresser.csv
+"""
+import argparse
+import json
+import pathlib
+import numpy as np
+import pandas as pd
+from geometry import concatenate_flats, feature_bounds, flatten_features
+from geometry_store import STORE_FILE, GeometryStore
+from read_results import (
+    add_cache_arguments,
+    read_csv_results,
+    set_cache_options,
+)
+from winners import find_winners
+
+
+INDEX_FILE = 'valgkretser.index.npz'
+INDEX_VERSION = 1
+VALGKRETS_PATTERN = 'krets-*.geojson'
+# Average number of voting areas per grid cell:
+AREAS_PER_CELL = 0.5
+# Largest number of strips for the edges of one voting area:
+MAX_STRIPS = 256
+
+
+def _source_info(filenames):
+    """Get the values used for checking if an index is stale."""
+    info = []
+    for filename in filenames:
+        stat = filename.stat()
+        info.append([filename.name, stat.st_size, stat.st_mtime_ns])
+    return info
+
+
+def _read_kommune(filename, store):
+    """Read the flat geometry and properties for a kommune."""
+    key = filename.stem
+    if store is not None and key in store and store.is_fresh(key, filename):
+        properties = [i.get('properties', {}) for i in store.properties(key)]
+        return store.flat(key), properties
+    with open(filename, 'r') as infile:
+        features = json.load(infile).get('features', [])
+    return (
+        flatten_features(features),
+        [feature.get('properties', {}) for feature in features],
+    )
+
+
+def _edges(flat):
+    """Return the edges of all rings, and the feature for each edge."""
+    coordinates, rings = flat['coordinates'], flat['rings']
+    count = np.diff(rings)
+    first, last = rings[:-1][count > 0], rings[1:][count > 0] - 1
+    # The next vertex, wrapping around at the end of each ring:
+    nxt = np.arange(1, len(coordinates) + 1)
+    nxt[last] = first
+    ring_feature = np.repeat(
+        np.repeat(
+            np.arange(len(flat['features']) - 1), np.diff(flat['features'])
+        ),
+        np.diff(flat['parts']),
+    )
+    edges = np.column_stack((coordinates, coordinates[nxt]))
+    edge_feature = np.repeat(ring_feature, count)
+    # Horizontal edges are never crossed by a horizontal ray:
+    keep = edges[:, 1] != edges[:, 3]
+    return edges[keep], edge_feature[keep]
+
+
+def _csr(groups, values, ngroup):
+    """Sort values by group and return the offsets for each group."""
+    order = np.argsort(groups, kind='stable')
+    offsets = np.zeros(ngroup + 1, dtype=np.int64)
+    np.cumsum(np.bincount(groups, minlength=ngroup), out=offsets[1:])
+    return offsets, values[order]
+
+
+def _expand_ranges(start, count):
+    """Expand ranges into one index per element of the ranges.
+
+    Returns the index of the range each element belongs to, and the
+    position of the element within its range.
+    """
+    owner = np.repeat(np.arange(len(start)), count)
+    offsets = np.cumsum(count) - count
+    within = np.arange(len(owner)) - np.repeat(offsets, count)
+    return owner, within
+
+
+def build_index(directory='valgkretser', output=None,
+                pattern=VALGKRETS_PATTERN):
+    """Build the spatial index for the voting areas in a directory.
+
+    Parameters
+    ----------
+    directory : string or object like pathlib.Path
+        The directory containing the GeoJSON files for the voting
+        areas, one file per kommune (e.g. ``krets-0301.geojson``).
+    output : string or object like pathlib.Path, optional
+        The file to write the index to. Defaults to ``INDEX_FILE``
+        in the directory.
+    pattern : string, optional
+        A pattern for selecting the GeoJSON files.
+
+    Returns
+    -------
+    index : object like SpatialIndex
+        The index built here.
+
+    """
+    directory = pathlib.Path(directory)
+    output = directory.joinpath(INDEX_FILE) if output is None else output
+    store_file = directory.joinpath(STORE_FILE)
+    store = GeometryStore(store_file) if store_file.is_file() else None
+    filenames = sorted(directory.glob(pattern))
+    flats, kommuner, kretser, navn = [], [], [], []
+    for filename in filenames:
+        flat, properties = _read_kommune(filename, store)
+        flats.append(flat)
+        kommune = filename.stem.split('-', 1)[-1]
+        for prop in properties:
+            kommuner.append(kommune)
+            kretser.append(
+                str(prop.get('valgkretsnummer', '')).rjust(4, '0')
+            )
+            navn.append(str(prop.get('valgkretsnavn', '')))
+    flat = concatenate_flats(flats)
+    arrays = _index_arrays(flat)
+    arrays['kommune'] = np.array(kommuner, dtype=str)
+    arrays['krets'] = np.array(kretser, dtype=str)
+    arrays['kretsnavn'] = np.array(navn, dtype=str)
+    meta = {
+        'version': INDEX_VERSION,
+        'sources': _source_info(filenames),
+    }
+    arrays['meta'] = np.array(json.dumps(meta))
+    tmp_file = pathlib.Path(str(output) + '.tmp')
+    with open(tmp_file, 'wb') as outfile:
+        np.savez(outfile, **arrays)
+    tmp_file.replace(output)
+    print('Indexed {} voting areas in "{}"'.format(len(kommuner), output))
+    return SpatialIndex(arrays)
+
+
+def _index_arrays(flat):
+    """Create the grid and the edge strips for some features."""
+    nfeat = len(flat['features']) - 1
+    bbox = feature_bounds(flat)
+    valid = np.all(np.isfinite(bbox), axis=1)
+    edges, edge_feature = _edges(flat)
+    # Strips for the edges of each feature:
+    nedge = np.bincount(edge_feature, minlength=nfeat)
+    nstrip = np.clip(
+        np.ceil(np.sqrt(nedge)).astype(np.int64), 1, MAX_STRIPS
+    )
+    strip_offset = np.zeros(nfeat + 1, dtype=np.int64)
+    np.cumsum(nstrip, out=strip_offset[1:])
+    height = np.where(valid, bbox[:, 3] - bbox[:, 1], 0.0) / nstrip
+    height[height <= 0] = 1.0
+    ymin = np.where(valid, bbox[:, 1], 0.0)
+    ylow = np.minimum(edges[:, 1], edges[:, 3])
+    yhigh = np.maximum(edges[:, 1], edges[:, 3])
+    last_strip = nstrip[edge_feature] - 1
+    low = np.clip(
+        np.floor((ylow - ymin[edge_feature]) / height[edge_feature]),
+        0, last_strip,
+    ).astype(np.int64)
+    high = np.clip(
+        np.floor((yhigh - ymin[edge_feature]) / height[edge_feature]),
+        0, last_strip,
+    ).astype(np.int64)
+    owner, within = _expand_ranges(low, high - low + 1)
+    strip = strip_offset[edge_feature[owner]] + low[owner] + within
+    strip_start, strip_edges = _csr(strip, owner, strip_offset[-1])
+    # Grid over the bounding boxes:
+    if np.any(valid):
+        extent = np.concatenate(
+            (bbox[valid, :2].min(axis=0), bbox[valid, 2:].max(axis=0))
+        )
+    else:
+        extent = np.array([0.0, 0.0, 1.0, 1.0])
+    size = np.maximum(extent[2:] - extent[:2], 1e-12)
+    ncell = max(int(np.ceil(np.sqrt(nfeat / AREAS_PER_CELL))), 1)
+    shape = np.maximum(
+        np.rint(ncell * size / np.sqrt(size[0] * size[1])), 1
+    ).astype(np.int64)
+    cell_size = size / shape
+    features = np.flatnonzero(valid)
+    cmin = np.clip(
+        np.floor((bbox[features, :2] - extent[:2]) / cell_size), 0, shape - 1
+    ).astype(np.int64)
+    cmax = np.clip(
+        np.floor((bbox[features, 2:] - extent[:2]) / cell_size), 0, shape - 1
+    ).astype(np.int64)
+    span = cmax - cmin + 1
+    owner, within = _expand_ranges(
+        np.arange(len(features)), span[:, 0] * span[:, 1]
+    )
+    cell_x = cmin[owner, 0] + within % span[owner, 0]
+    cell_y = cmin[owner, 1] + within // span[owner, 0]
+    cell_start, cell_features = _csr(
+        cell_y * shape[0] + cell_x, features[owner], int(np.prod(shape))
+    )
+    return {
+        'extent': extent,
+        'shape': shape,
+        'cell_size': cell_size,
+        'cell_start': cell_start,
+        'cell_features': cell_features,
+        'bbox': bbox,
+        'strip_offset': strip_offset,
+        'strip_height': height,
+        'strip_start': strip_start,
+        'strip_edges': strip_edges,
+        'edges': edges,
+        'edge_feature': edge_feature,
+    }
+
+
+class SpatialIndex:
+    """Locate the voting areas containing points.
+
+    Attributes
+    ----------
+    arrays : dict of numpy.arrays
+        The arrays making up the index, see :py:func:`build_index`.
+    kommune : numpy.array
+        The kommune id for each voting area.
+    krets : numpy.array
+        The voting area id (within its kommune) for each voting area.
+    kretsnavn : numpy.array
+        The name of each voting area.
+
+    """
+
+    def __init__(self, arrays):
+        """Set up the index from its arrays."""
+        self.arrays = arrays
+        self.kommune = arrays['kommune']
+        self.krets = arrays['krets']
+        self.kretsnavn = arrays['kretsnavn']
+
+    def _candidates(self, x, y):
+        """Return pairs of (point, feature) for features which may
+        contain the points."""
+        arr = self.arrays
+        extent, shape = arr['extent'], arr['shape']
+        inside = (
+            (x >= extent[0]) & (x <= extent[2]) &
+            (y >= extent[1]) & (y <= extent[3])
+        )
+        points = np.flatnonzero(inside)
+        cell_x = np.clip(
+            np.floor((x[inside] - extent[0]) / arr['cell_size'][0]),
+            0, shape[0] - 1,
+        ).astype(np.int64)
+        cell_y = np.clip(
+            np.floor((y[inside] - extent[1]) / arr['cell_size'][1]),
+            0, shape[1] - 1,
+        ).astype(np.int64)
+        cell = cell_y * shape[0] + cell_x
+        start = arr['cell_start'][cell]
+        count = arr['cell_start'][cell + 1] - start
+        owner, within = _expand_ranges(start, count)
+        point = points[owner]
+        feature = arr['cell_features'][start[owner] + within]
+        bbox = arr['bbox'][feature]
+        px, py = x[point], y[point]
+        keep = (
+            (px >= bbox[:, 0]) & (px <= bbox[:, 2]) &
+            (py >= bbox[:, 1]) & (py <= bbox[:, 3])
+        )
+        return point[keep], feature[keep]
+
+    def _contains(self, x, y, point, feature):
+        """Ray casting test for pairs of (point, feature)."""
+        arr = self.arrays
+        px, py = x[point], y[point]
+        height = arr['strip_height'][feature]
+        nstrip = (
+            arr['strip_offset'][feature + 1] - arr['strip_offset'][feature]
+        )
+        strip = np.clip(
+            np.floor((py - arr['bbox'][feature, 1]) / height), 0, nstrip - 1
+        ).astype(np.int64) + arr['strip_offset'][feature]
+        start = arr['strip_start'][strip]
+        count = arr['strip_start'][strip + 1] - start
+        owner, within = _expand_ranges(start, count)
+        edge = arr['strip_edges'][start[owner] + within]
+        edge_x1, edge_y1, edge_x2, edge_y2 = arr['edges'][edge].T
+        ex, ey = px[owner], py[owner]
+        crosses = (edge_y1 > ey) != (edge_y2 > ey)
+        crossing_x = edge_x1 + (ey - edge_y1) * (edge_x2 - edge_x1) / (
+            edge_y2 - edge_y1
+        )
+        crosses &= ex < crossing_x
+        ncross = np.bincount(owner[crosses], minlength=len(point))
+        return ncross % 2 == 1
+
+    def locate(self, lon, lat, batch_size=100000):
+        """Find the voting area containing each point.
+
+        Parameters
+        ----------
+        lon : array_like
+            The longitude of the points.
+        lat : array_like
+            The latitude of the points.
+        batch_size : integer, optional
+            The number of points to handle at once.
+
+        Returns
+        -------
+        area : numpy.array
+            The index of the voting area containing each point, or -1
+            for points outside all voting areas.
+
+        """
+        lon = np.asarray(lon, dtype=np.float64).ravel()
+        lat = np.asarray(lat, dtype=np.float64).ravel()
+        area = np.full(len(lon), -1, dtype=np.int64)
+        for first in range(0, len(lon), batch_size):
+            x = lon[first:first + batch_size]
+            y = lat[first:first + batch_size]
+            point, feature = self._candidates(x, y)
+            inside = self._contains(x, y, point, feature)
+            # If a point is (wrongly) in several areas, use the first:
+            area[first + point[inside][::-1]] = feature[inside][::-1]
+        return area
+
+    def lookup(self, lon, lat, winners=None):
+        """Find the kommune, voting area and winner for points.
+
+        Parameters
+        ----------
+        lon : array_like
+            The longitude of the points.
+        lat : array_like
+            The latitude of the points.
+        winners : object like pandas.DataFrame, optional
+            The winners as found by :py:func:`winners.find_winners`
+            with the keys ``('Kommunenummer', 'Stemmekretsnummer')``.
+
+        Returns
+        -------
+        found : object like pandas.DataFrame
+            The ``Kommunenummer``, ``Stemmekretsnummer`` and
+            ``Stemmekretsnavn`` for each point, and the ``partinavn``
+            and ``oppslutning`` of the winner if winners are given.
+            Points outside all voting areas get missing values.
+
+        """
+        area = self.locate(lon, lat)
+        found = area >= 0
+        data = {}
+        for column, values in (('Kommunenummer', self.kommune),
+                               ('Stemmekretsnummer', self.krets),
+                               ('Stemmekretsnavn', self.kretsnavn)):
+            column_data = np.full(len(area), None, dtype=object)
+            column_data[found] = values[area[found]]
+            data[column] = column_data
+        found = pd.DataFrame(data)
+        if winners is None:
+            return found
+        keys = pd.MultiIndex.from_arrays(
+            [found['Kommunenummer'], found['Stemmekretsnummer']]
+        )
+        # Kommuner reported as one area have the voting area "0000":
+        whole = pd.MultiIndex.from_arrays(
+            [found['Kommunenummer'], ['0000'] * len(found)]
+        )
+        columns = ['partinavn', 'oppslutning']
+        result = winners[columns].reindex(keys).reset_index(drop=True)
+        result = result.combine_first(
+            winners[columns].reindex(whole).reset_index(drop=True)
+        )
+        for column in columns:
+            found[column] = result[column].to_numpy()
+        return found
+
+
+def load_index(directory='valgkretser', rebuild=False,
+               pattern=VALGKRETS_PATTERN):
+    """Load the spatial index for a directory, building it if needed.
+
+    Parameters
+    ----------
+    directory : string or object like pathlib.Path
+        The directory containing the GeoJSON files for the voting
+        areas.
+    rebuild : boolean, optional
+        If True, the index is always rebuilt.
+    pattern : string, optional
+        A pattern for selecting the GeoJSON files.
+
+    Returns
+    -------
+    index : object like SpatialIndex
+        The spatial index.
+
+    """
+    directory = pathlib.Path(directory)
+    index_file = directory.joinpath(INDEX_FILE)
+    if index_file.is_file() and not rebuild:
+        with np.load(index_file, allow_pickle=False) as archive:
+            meta = json.loads(str(archive['meta']))
+            sources = _source_info(sorted(directory.glob(pattern)))
+            if (meta.get('version') == INDEX_VERSION and
+                    meta['sources'] == sources):
+                return SpatialIndex(
+                    {key: archive[key] for key in archive.files}
+                )
+        print('Spatial index "{}" is out of date'.format(index_file))
+    return build_index(directory, output=index_file, pattern=pattern)
+
+
+def main(raw_data, points, directory='valgkretser', rebuild=False,
+         output=None):
+    """Look up points and print or store the results."""
+    results = read_csv_results(raw_data)
+    winners = find_winners(
+        results, ('Kommunenummer', 'Stemmekretsnummer')
+    )
+    index = load_index(directory, rebuild=rebuild)
+    found = index.lookup(points['lon'], points['lat'], winners=winners)
+    found = pd.concat(
+        [points.reset_index(drop=True), found], axis=1
+    )
+    if output is None:
+        print(found.to_string(index=False))
+    else:
+        found.to_csv(output, sep=';', decimal=',', index=False)
+        print('Wrote {} points to "{}"'.format(len(found), output))
+    return found
+
+
+def add_arguments(parser):
+    """Add the command line arguments for this script."""
+    parser.add_argument(
+        'raw_data',
+        help='The csv file with the election results.',
+    )
+    parser.add_argument(
+        '--point',
+        nargs=2,
+        type=float,
+        action='append',
+        default=[],
+        metavar=('LON', 'LAT'),
+        help='A point to look up (can be given several times).',
+    )
+    parser.add_argument(
+        '--points',
+        default=None,
+        help=(
+            'A csv file (separated by ";") with the points to look up '
+            'in the columns "lon" and "lat".'
+        ),
+    )
+    parser.add_argument(
+        '--output',
+        default=None,
+        help='A csv file to write the results to.',
+    )
+    parser.add_argument(
+        '--directory',
+        default='valgkretser',
+        help='The directory with the GeoJSON files for the voting areas.',
+    )
+    parser.add_argument(
+        '--rebuild-index',
+        action='store_true',
+        help='Rebuild the spatial index.',
+    )
+    add_cache_arguments(parser)
+
+
+def run(args):
+    """Look up points from parsed command line arguments."""
+    set_cache_options(args)
+    points = []
+    if args.point:
+        points.append(pd.DataFrame(args.point, columns=['lon', 'lat']))
+    if args.points is not None:
+        points.append(pd.read_csv(args.points, sep=';', decimal=','))
+    if not points:
+        raise SystemExit('No points given, use --point or --points.')
+    main(
+        args.raw_data,
+        pd.concat(points, ignore_index=True),
+        directory=args.directory,
+        rebuild=args.rebuild_index,
+        output=args.output,
+    )
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Find the voting area and winner for points.'
+    )
+    add_arguments(PARSER)
+    run(PARSER.parse_args())
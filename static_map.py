@@ -0,0 +1,818 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Draw maps as static PNG or SVG images, without a browser.
+
+The features are projected with the web mercator projection (as used
+by the interactive maps) and scaled to fit the image. For PNG images,
+the polygons are filled scanline by scanline with numpy (with the
+even-odd rule, so that holes are left open) on an image which is
+larger than the output by a factor ``SUPERSAMPLE`` in each direction,
+and then averaged down, which smooths the edges. The legend is drawn
+in the lower right corner, with a small built-in bitmap font, and the
+features are fitted so that they do not go under it. SVG images
+contain one path for each feature and are drawn by the viewer.
+
+Only numpy and the standard library (:py:mod:`zlib` for the PNG
+compression) are used, so an image takes milliseconds to create.
+"""
+import math
+import struct
+from xml.sax.saxutils import escape, quoteattr
+import zlib
+import numpy as np
+from geometry import flatten_features
+
+
+IMAGE_FORMATS = ('png', 'svg')
+DEFAULT_SIZE = (800, 800)
+SUPERSAMPLE = 2
+BACKGROUND = '#ffffff'
+# The fraction of the image left empty around the features:
+MARGIN = 0.03
+# The number of rows filled at once (limits the memory used):
+ROW_BLOCK = 32
+# The font size for the legend in SVG images:
+SVG_FONT_SIZE = 12
+
+
+# A 5x7 pixel font, with two more rows for the letters going below the
+# line. Each character is given by its rows (from the top), where the
+# bits are the pixels (from the left) in a row:
+FONT = {
+    ' ': (0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00),
+    '!': (0x04, 0x04, 0x04, 0x04, 0x04, 0x00, 0x04),
+    '"': (0x0A, 0x0A, 0x0A, 0x00, 0x00, 0x00, 0x00),
+    '%': (0x18, 0x19, 0x02, 0x04, 0x08, 0x13, 0x03),
+    '&': (0x0C, 0x12, 0x14, 0x08, 0x15, 0x12, 0x0D),
+    "'": (0x0C, 0x04, 0x08, 0x00, 0x00, 0x00, 0x00),
+    '(': (0x02, 0x04, 0x08, 0x08, 0x08, 0x04, 0x02),
+    ')': (0x08, 0x04, 0x02, 0x02, 0x02, 0x04, 0x08),
+    '+': (0x00, 0x04, 0x04, 0x1F, 0x04, 0x04, 0x00),
+    ',': (0x00, 0x00, 0x00, 0x00, 0x0C, 0x04, 0x08),
+    '-': (0x00, 0x00, 0x00, 0x1F, 0x00, 0x00, 0x00),
+    '.': (0x00, 0x00, 0x00, 0x00, 0x00, 0x0C, 0x0C),
+    '/': (0x00, 0x01, 0x02, 0x04, 0x08, 0x10, 0x00),
+    '0': (0x0E, 0x11, 0x13, 0x15, 0x19, 0x11, 0x0E),
+    '1': (0x04, 0x0C, 0x04, 0x04, 0x04, 0x04, 0x0E),
+    '2': (0x0E, 0x11, 0x01, 0x02, 0x04, 0x08, 0x1F),
+    '3': (0x1F, 0x02, 0x04, 0x02, 0x01, 0x11, 0x0E),
+    '4': (0x02, 0x06, 0x0A, 0x12, 0x1F, 0x02, 0x02),
+    '5': (0x1F, 0x10, 0x1E, 0x01, 0x01, 0x11, 0x0E),
+    '6': (0x06, 0x08, 0x10, 0x1E, 0x11, 0x11, 0x0E),
+    '7': (0x1F, 0x01, 0x02, 0x04, 0x08, 0x08, 0x08),
+    '8': (0x0E, 0x11, 0x11, 0x0E, 0x11, 0x11, 0x0E),
+    '9': (0x0E, 0x11, 0x11, 0x0F, 0x01, 0x02, 0x0C),
+    ':': (0x00, 0x0C, 0x0C, 0x00, 0x0C, 0x0C, 0x00),
+    ';': (0x00, 0x0C, 0x0C, 0x00, 0x0C, 0x04, 0x08),
+    '=': (0x00, 0x00, 0x1F, 0x00, 0x1F, 0x00, 0x00),
+    '?': (0x0E, 0x11, 0x01, 0x02, 0x04, 0x00, 0x04),
+    'A': (0x0E, 0x11, 0x11, 0x11, 0x1F, 0x11, 0x11),
+    'B': (0x1E, 0x11, 0x11, 0x1E, 0x11, 0x11, 0x1E),
+    'C': (0x0E, 0x11, 0x10, 0x10, 0x10, 0x11, 0x0E),
+    'D': (0x1C, 0x12, 0x11, 0x11, 0x11, 0x12, 0x1C),
+    'E': (0x1F, 0x10, 0x10, 0x1E, 0x10, 0x10, 0x1F),
+    'F': (0x1F, 0x10, 0x10, 0x1E, 0x10, 0x10, 0x10),
+    'G': (0x0E, 0x11, 0x10, 0x17, 0x11, 0x11, 0x0F),
+    'H': (0x11, 0x11, 0x11, 0x1F, 0x11, 0x11, 0x11),
+    'I': (0x0E, 0x04, 0x04, 0x04, 0x04, 0x04, 0x0E),
+    'J': (0x07, 0x02, 0x02, 0x02, 0x02, 0x12, 0x0C),
+    'K': (0x11, 0x12, 0x14, 0x18, 0x14, 0x12, 0x11),
+    'L': (0x10, 0x10, 0x10, 0x10, 0x10, 0x10, 0x1F),
+    'M': (0x11, 0x1B, 0x15, 0x15, 0x11, 0x11, 0x11),
+    'N': (0x11, 0x11, 0x19, 0x15, 0x13, 0x11, 0x11),
+    'O': (0x0E, 0x11, 0x11, 0x11, 0x11, 0x11, 0x0E),
+    'P': (0x1E, 0x11, 0x11, 0x1E, 0x10, 0x10, 0x10),
+    'Q': (0x0E, 0x11, 0x11, 0x11, 0x15, 0x12, 0x0D),
+    'R': (0x1E, 0x11, 0x11, 0x1E, 0x14, 0x12, 0x11),
+    'S': (0x0F, 0x10, 0x10, 0x0E, 0x01, 0x01, 0x1E),
+    'T': (0x1F, 0x04, 0x04, 0x04, 0x04, 0x04, 0x04),
+    'U': (0x11, 0x11, 0x11, 0x11, 0x11, 0x11, 0x0E),
+    'V': (0x11, 0x11, 0x11, 0x11, 0x11, 0x0A, 0x04),
+    'W': (0x11, 0x11, 0x11, 0x15, 0x15, 0x15, 0x0A),
+    'X': (0x11, 0x11, 0x0A, 0x04, 0x0A, 0x11, 0x11),
+    'Y': (0x11, 0x11, 0x11, 0x0A, 0x04, 0x04, 0x04),
+    'Z': (0x1F, 0x01, 0x02, 0x04, 0x08, 0x10, 0x1F),
+    '_': (0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x1F),
+    'a': (0x00, 0x00, 0x0E, 0x01, 0x0F, 0x11, 0x0F),
+    'b': (0x10, 0x10, 0x16, 0x19, 0x11, 0x11, 0x1E),
+    'c': (0x00, 0x00, 0x0E, 0x10, 0x10, 0x11, 0x0E),
+    'd': (0x01, 0x01, 0x0D, 0x13, 0x11, 0x11, 0x0F),
+    'e': (0x00, 0x00, 0x0E, 0x11, 0x1F, 0x10, 0x0E),
+    'f': (0x06, 0x09, 0x08, 0x1C, 0x08, 0x08, 0x08),
+    'g': (
+        0x00, 0x00, 0x0F, 0x11, 0x11, 0x11, 0x0F, 0x01, 0x0E,
+    ),
+    'h': (0x10, 0x10, 0x16, 0x19, 0x11, 0x11, 0x11),
+    'i': (0x04, 0x00, 0x0C, 0x04, 0x04, 0x04, 0x0E),
+    'j': (
+        0x02, 0x00, 0x06, 0x02, 0x02, 0x02, 0x02, 0x12, 0x0C,
+    ),
+    'k': (0x10, 0x10, 0x12, 0x14, 0x18, 0x14, 0x12),
+    'l': (0x0C, 0x04, 0x04, 0x04, 0x04, 0x04, 0x0E),
+    'm': (0x00, 0x00, 0x1A, 0x15, 0x15, 0x11, 0x11),
+    'n': (0x00, 0x00, 0x16, 0x19, 0x11, 0x11, 0x11),
+    'o': (0x00, 0x00, 0x0E, 0x11, 0x11, 0x11, 0x0E),
+    'p': (
+        0x00, 0x00, 0x1E, 0x11, 0x11, 0x11, 0x1E, 0x10, 0x10,
+    ),
+    'q': (
+        0x00, 0x00, 0x0F, 0x11, 0x11, 0x11, 0x0F, 0x01, 0x01,
+    ),
+    'r': (0x00, 0x00, 0x16, 0x19, 0x10, 0x10, 0x10),
+    's': (0x00, 0x00, 0x0E, 0x10, 0x0E, 0x01, 0x1E),
+    't': (0x08, 0x08, 0x1C, 0x08, 0x08, 0x09, 0x06),
+    'u': (0x00, 0x00, 0x11, 0x11, 0x11, 0x13, 0x0D),
+    'v': (0x00, 0x00, 0x11, 0x11, 0x11, 0x0A, 0x04),
+    'w': (0x00, 0x00, 0x11, 0x11, 0x15, 0x15, 0x0A),
+    'x': (0x00, 0x00, 0x11, 0x0A, 0x04, 0x0A, 0x11),
+    'y': (
+        0x00, 0x00, 0x11, 0x11, 0x11, 0x11, 0x0F, 0x01, 0x0E,
+    ),
+    'z': (0x00, 0x00, 0x1F, 0x02, 0x04, 0x08, 0x1F),
+    'Å': (0x04, 0x00, 0x0E, 0x11, 0x1F, 0x11, 0x11),
+    'Æ': (0x0F, 0x14, 0x14, 0x1F, 0x14, 0x14, 0x17),
+    'Ø': (0x0E, 0x13, 0x15, 0x15, 0x15, 0x19, 0x0E),
+    'å': (0x04, 0x00, 0x0E, 0x01, 0x0F, 0x11, 0x0F),
+    'æ': (0x00, 0x00, 0x1A, 0x05, 0x0F, 0x14, 0x0F),
+    'é': (0x02, 0x04, 0x0E, 0x11, 0x1F, 0x10, 0x0E),
+    'ø': (0x00, 0x01, 0x0E, 0x13, 0x15, 0x19, 0x0E),
+}
+# Drawn for characters missing in the font:
+MISSING_CHARACTER = (0x1F, 0x11, 0x11, 0x11, 0x11, 0x11, 0x1F)
+FONT_WIDTH = 5
+FONT_HEIGHT = 9
+
+
+def parse_color(color):
+    """Convert a css hex color to rgb values and an opacity.
+
+    Parameters
+    ----------
+    color : string
+        The color, as ``#rgb``, ``#rrggbb`` or ``#rrggbbaa``.
+
+    Returns
+    -------
+    rgb : object like numpy.ndarray
+        The red, green and blue values (0 to 255).
+    alpha : float
+        The opacity given with the color (1 if not given).
+
+    """
+    value = color.lstrip('#')
+    if len(value) == 3:
+        value = ''.join(i * 2 for i in value)
+    rgb = np.array([int(value[i:i + 2], 16) for i in (0, 2, 4)], dtype=float)
+    alpha = int(value[6:8], 16) / 255 if len(value) == 8 else 1.0
+    return rgb, alpha
+
+
+def mercator(coordinates):
+    """Project longitudes and latitudes with web mercator.
+
+    Parameters
+    ----------
+    coordinates : object like numpy.ndarray
+        The longitudes and latitudes (in degrees), shape (n, 2).
+
+    Returns
+    -------
+    projected : object like numpy.ndarray
+        The projected x and y (pointing north) coordinates.
+
+    """
+    lon = np.radians(coordinates[:, 0])
+    lat = np.radians(np.clip(coordinates[:, 1], -85.0, 85.0))
+    return np.column_stack((lon, np.log(np.tan(np.pi / 4 + lat / 2))))
+
+
+class Projection:
+    """Project coordinates onto the pixels of an image.
+
+    Attributes
+    ----------
+    origin : object like numpy.ndarray
+        The projected coordinates of the upper left corner.
+    scale : float
+        The number of pixels per projected unit.
+
+    """
+
+    def __init__(self, coordinates, width, height, margin=MARGIN,
+                 reserve=None):
+        """Fit the given coordinates into an image.
+
+        Parameters
+        ----------
+        coordinates : object like numpy.ndarray
+            All longitudes and latitudes to show, shape (n, 2).
+        width : integer
+            The width of the image.
+        height : integer
+            The height of the image.
+        margin : float, optional
+            The fraction of the image to leave empty on each side.
+        reserve : tuple of floats, optional
+            The width and height of a box in the lower right corner
+            (for the legend) which the coordinates should not cover.
+
+        """
+        projected = mercator(coordinates)
+        low = projected.min(axis=0)
+        high = projected.max(axis=0)
+        span = np.maximum(high - low, 1e-9)
+        size = np.array([width, height], dtype=float)
+        areas = [size]
+        if reserve is not None:
+            # Keep clear of the box by fitting the coordinates either
+            # to the left of it or above it, whichever is larger:
+            areas = [size - (reserve[0], 0), size - (0, reserve[1])]
+        area = max(
+            areas, key=lambda i: np.min((i - 2 * margin * size) / span)
+        )
+        usable = np.maximum(area - 2 * margin * size, 1)
+        self.scale = float(np.min(usable / span))
+        center = (low + high) / 2
+        self.origin = center + np.array([-area[0], area[1]]) / (
+            2 * self.scale
+        )
+
+    def __call__(self, coordinates):
+        """Return the pixel coordinates for longitudes and latitudes."""
+        projected = mercator(coordinates)
+        return np.column_stack((
+            (projected[:, 0] - self.origin[0]) * self.scale,
+            (self.origin[1] - projected[:, 1]) * self.scale,
+        ))
+
+
+def feature_rings(flat, pixels, index):
+    """Return the rings (in pixels) of a flattened feature."""
+    parts = flat['parts']
+    rings = flat['rings']
+    first = parts[flat['features'][index]]
+    last = parts[flat['features'][index + 1]]
+    return [
+        pixels[rings[i]:rings[i + 1]] for i in range(first, last)
+        if rings[i + 1] - rings[i] > 1
+    ]
+
+
+def _edges(rings):
+    """Return the edges of closed rings as x0, y0, x1, y1 columns."""
+    edges = []
+    for ring in rings:
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack((ring, ring[:1]))
+        edges.append(np.hstack((ring[:-1], ring[1:])))
+    return np.vstack(edges)
+
+
+class Canvas:
+    """An rgb image which polygons, lines and text can be drawn on.
+
+    Attributes
+    ----------
+    pixels : object like numpy.ndarray
+        The color values, shape (height, width, 3).
+
+    """
+
+    def __init__(self, width, height, background=BACKGROUND):
+        """Create an image filled with the background color."""
+        rgb, _ = parse_color(background)
+        self.pixels = np.empty((height, width, 3))
+        self.pixels[:] = rgb
+
+    @property
+    def width(self):
+        """Return the width of the image."""
+        return self.pixels.shape[1]
+
+    @property
+    def height(self):
+        """Return the height of the image."""
+        return self.pixels.shape[0]
+
+    def fill(self, rings, color, opacity=1.0):
+        """Fill polygons (with holes), using the even-odd rule.
+
+        Parameters
+        ----------
+        rings : list of object like numpy.ndarray
+            The rings of the polygons, in pixel coordinates. The
+            polygons should not overlap.
+        color : string
+            The fill color.
+        opacity : float, optional
+            The opacity of the fill.
+
+        """
+        if not rings:
+            return
+        rgb, alpha = parse_color(color)
+        alpha *= opacity
+        x0, y0, x1, y1 = _edges(rings).T
+        # Horizontal edges never cross the center of a row:
+        keep = y0 != y1
+        x0, y0, x1, y1 = x0[keep], y0[keep], x1[keep], y1[keep]
+        if not len(x0):
+            return
+        low = np.minimum(y0, y1)
+        high = np.maximum(y0, y1)
+        slope = (x1 - x0) / (y1 - y0)
+        # The pixel rows covered, sampled at their centers:
+        row_min = max(0, math.ceil(low.min() - 0.5))
+        row_max = min(self.height - 1, math.floor(high.max() - 0.5))
+        for start in range(row_min, row_max + 1, ROW_BLOCK):
+            stop = min(start + ROW_BLOCK, row_max + 1)
+            # Only the edges reaching these rows are needed:
+            near = (high > start + 0.5) & (low <= stop - 0.5)
+            if not near.any():
+                continue
+            self._fill_rows(
+                start, stop, x0[near], y0[near], x1[near], y1[near],
+                slope[near], rgb, alpha,
+            )
+
+    def _fill_rows(self, start, stop, x0, y0, x1, y1, slope, rgb, alpha):
+        """Fill the spans inside the given edges for a block of rows."""
+        col_min = max(0, math.floor(min(x0.min(), x1.min())))
+        col_max = min(self.width, math.ceil(max(x0.max(), x1.max())) + 1)
+        if col_max <= col_min:
+            return
+        ncol = col_max - col_min
+        center = np.arange(start, stop)[:, None] + 0.5
+        cross = (y0 <= center) != (y1 <= center)
+        count = cross.sum(axis=1)
+        if not count.any():
+            return
+        crossing = np.where(cross, x0 + (center - y0) * slope, np.inf)
+        crossing.sort(axis=1)
+        crossing = crossing[:, :count.max()]
+        end = crossing[:, 1::2]
+        begin = crossing[:, 0::2][:, :end.shape[1]]
+        valid = np.isfinite(end)
+        row_index = np.broadcast_to(
+            np.arange(stop - start)[:, None], end.shape
+        )[valid]
+        first = np.clip(
+            np.ceil(begin[valid] - 0.5) - col_min, 0, ncol
+        ).astype(np.int64)
+        last = np.clip(
+            np.floor(end[valid] - 0.5) + 1 - col_min, 0, ncol
+        ).astype(np.int64)
+        change = np.zeros((stop - start, ncol + 1), dtype=np.int32)
+        np.add.at(change, (row_index, first), 1)
+        np.add.at(change, (row_index, last), -1)
+        inside = np.cumsum(change[:, :ncol], axis=1) > 0
+        region = self.pixels[start:stop, col_min:col_max]
+        region[inside] = region[inside] * (1 - alpha) + rgb * alpha
+
+    def stroke(self, rings, color, opacity=1.0, width=1.0):
+        """Draw the outlines of rings.
+
+        Parameters
+        ----------
+        rings : list of object like numpy.ndarray
+            The rings to draw, in pixel coordinates.
+        color : string
+            The line color.
+        opacity : float, optional
+            The opacity of the lines.
+        width : float, optional
+            The width of the lines in pixels.
+
+        """
+        if not rings or width <= 0:
+            return
+        rgb, alpha = parse_color(color)
+        alpha *= opacity
+        x0, y0, x1, y1 = _edges(rings).T
+        # Sample each edge at every half pixel:
+        steps = np.ceil(2 * np.hypot(x1 - x0, y1 - y0)).astype(np.int64) + 1
+        edge = np.repeat(np.arange(len(steps)), steps)
+        offset = np.arange(len(edge)) - np.repeat(
+            np.cumsum(steps) - steps, steps
+        )
+        fraction = offset / np.maximum(steps[edge] - 1, 1)
+        x = x0[edge] + fraction * (x1 - x0)[edge]
+        y = y0[edge] + fraction * (y1 - y0)[edge]
+        radius = max(int(round(width)) - 1, 0) / 2
+        shifts = np.arange(-math.floor(radius), math.ceil(radius) + 1)
+        shift_x, shift_y = (i.ravel() for i in np.meshgrid(shifts, shifts))
+        columns = (np.floor(x)[:, None] + shift_x).ravel()
+        rows = (np.floor(y)[:, None] + shift_y).ravel()
+        keep = (columns >= 0) & (columns < self.width) & (rows >= 0) & (
+            rows < self.height
+        )
+        index = np.unique(
+            rows[keep].astype(np.int64) * self.width +
+            columns[keep].astype(np.int64)
+        )
+        flat = self.pixels.reshape(-1, 3)
+        flat[index] = flat[index] * (1 - alpha) + rgb * alpha
+
+    def rectangle(self, left, top, right, bottom, color, opacity=1.0):
+        """Fill a rectangle given by its edges (in pixels)."""
+        rgb, alpha = parse_color(color)
+        alpha *= opacity
+        left, right = max(int(left), 0), min(int(right), self.width)
+        top, bottom = max(int(top), 0), min(int(bottom), self.height)
+        region = self.pixels[top:bottom, left:right]
+        region[:] = region * (1 - alpha) + rgb * alpha
+
+    def text(self, left, top, text, color='#000000', scale=1):
+        """Write text with the built-in font, from the upper left."""
+        for i, character in enumerate(text):
+            glyph = FONT.get(character, MISSING_CHARACTER)
+            for row, bits in enumerate(glyph):
+                for column in range(FONT_WIDTH):
+                    if bits & (1 << (FONT_WIDTH - 1 - column)):
+                        x = left + (i * (FONT_WIDTH + 1) + column) * scale
+                        y = top + row * scale
+                        self.rectangle(x, y, x + scale, y + scale, color)
+
+    def downsample(self, factor):
+        """Return a smaller canvas, averaging blocks of pixels."""
+        height = self.height // factor
+        width = self.width // factor
+        small = Canvas(width, height)
+        small.pixels = self.pixels[:height * factor, :width * factor].reshape(
+            height, factor, width, factor, 3
+        ).mean(axis=(1, 3))
+        return small
+
+    def png(self):
+        """Return the image encoded as PNG."""
+        pixels = np.clip(np.round(self.pixels), 0, 255).astype(np.uint8)
+        # Each row starts with the filter type (0, no filtering):
+        raw = np.hstack((
+            np.zeros((self.height, 1), dtype=np.uint8),
+            pixels.reshape(self.height, -1),
+        ))
+
+        def chunk(kind, data):
+            """Create a PNG chunk."""
+            return (
+                struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+            )
+
+        # 8 bits per channel, color type 2 (rgb), no interlacing:
+        header = struct.pack(
+            '>IIBBBBB', self.width, self.height, 8, 2, 0, 0, 0
+        )
+        return b''.join((
+            b'\x89PNG\r\n\x1a\n',
+            chunk(b'IHDR', header),
+            chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)),
+            chunk(b'IEND', b''),
+        ))
+
+
+def _wrap(text, length):
+    """Split text into lines with at most the given length."""
+    lines = []
+    for word in text.split():
+        if lines and len(lines[-1]) + 1 + len(word) <= length:
+            lines[-1] += ' ' + word
+        else:
+            lines.append(word)
+    return lines
+
+
+def legend_layout(legend, width, height, char_width, line_height):
+    """Place the parts of a legend in the lower right corner.
+
+    Parameters
+    ----------
+    legend : dict
+        The legend, with a ``title`` and either ``labels`` (a list of
+        dicts with ``text``, ``color`` and ``opacity``, as for
+        :py:class:`legend.Legend`) or a ``color_map`` (a branca color
+        map, drawn as a color bar).
+    width : integer
+        The width of the image.
+    height : integer
+        The height of the image.
+    char_width : float
+        The width of a character.
+    line_height : float
+        The height of a line of text.
+
+    Returns
+    -------
+    shapes : list of tuples
+        The parts of the legend, as ``('box', left, top, right,
+        bottom)``, ``('swatch', left, top, right, bottom, color,
+        opacity)``, ``('bar', left, top, right, bottom, colors)`` and
+        ``('text', left, top, text, bold)``.
+
+    """
+    pad = line_height / 2
+    max_chars = max(int((width / 2 - 2 * pad) / char_width), 10)
+    title = _wrap(legend.get('title', ''), max_chars)
+    if 'color_map' in legend:
+        color_map = legend['color_map']
+        low = '{:.2f}'.format(color_map.vmin)
+        high = '{:.2f}'.format(color_map.vmax)
+        bar_width = max(
+            char_width * (len(low) + len(high) + 2),
+            min(width / 3, char_width * max_chars),
+        )
+        content_width = bar_width
+        nline = 2
+    else:
+        labels = legend.get('labels', [])
+        swatch = 2 * line_height
+        texts = [label['text'][:max_chars] for label in labels]
+        content_width = swatch + pad + char_width * max(
+            [len(i) for i in texts] or [0]
+        )
+        nline = len(labels)
+    content_width = max(
+        content_width, char_width * max([len(i) for i in title] or [0])
+    )
+    box_width = content_width + 2 * pad
+    box_height = (len(title) + nline) * line_height + 2 * pad + pad / 2
+    left = width - box_width - pad
+    top = height - box_height - pad
+    shapes = [('box', left, top, left + box_width, top + box_height)]
+    y = top + pad
+    for line in title:
+        shapes.append(('text', left + pad, y, line, True))
+        y += line_height
+    y += pad / 2
+    if 'color_map' in legend:
+        samples = np.linspace(color_map.vmin, color_map.vmax, 64)
+        shapes.append((
+            'bar', left + pad, y, left + pad + bar_width,
+            y + 0.8 * line_height, [color_map(i) for i in samples],
+        ))
+        y += line_height
+        shapes.append(('text', left + pad, y, low, False))
+        shapes.append((
+            'text', left + pad + bar_width - char_width * len(high), y,
+            high, False,
+        ))
+        return shapes
+    for label, text in zip(labels, texts):
+        shapes.append((
+            'swatch', left + pad, y + 0.1 * line_height,
+            left + pad + swatch, y + 0.9 * line_height, label['color'],
+            label.get('opacity', 1.0),
+        ))
+        shapes.append(('text', left + 2 * pad + swatch, y, text, False))
+        y += line_height
+    return shapes
+
+
+def _font_scale(width):
+    """Return the scale for the built-in font on an image."""
+    return 2 if width >= 500 else 1
+
+
+def _font_metrics(image_format, width):
+    """Return the width of a character and the height of a line."""
+    if image_format == 'svg':
+        return 0.6 * SVG_FONT_SIZE, 1.5 * SVG_FONT_SIZE
+    scale = _font_scale(width)
+    return (FONT_WIDTH + 1) * scale, (FONT_HEIGHT + 4) * scale
+
+
+def legend_space(legend, width, height, image_format):
+    """Return the width and height taken by a legend and its padding.
+
+    The space is measured from the lower right corner of the image,
+    see :py:func:`legend_layout`.
+    """
+    char_width, line_height = _font_metrics(image_format, width)
+    _, left, top, _, _ = legend_layout(
+        legend, width, height, char_width, line_height
+    )[0]
+    return width - left, height - top
+
+
+def draw_legend(canvas, legend):
+    """Draw a legend (see :py:func:`legend_layout`) on a canvas."""
+    scale = _font_scale(canvas.width)
+    char_width, line_height = _font_metrics('png', canvas.width)
+    shapes = legend_layout(
+        legend, canvas.width, canvas.height, char_width, line_height
+    )
+    for shape in shapes:
+        kind, left, top = shape[:3]
+        if kind == 'box':
+            canvas.rectangle(left, top, shape[3], shape[4], '#ffffff', 0.8)
+            canvas.stroke(
+                [np.array([[left, top], [shape[3], top],
+                           [shape[3], shape[4]], [left, shape[4]]])],
+                '#808080', width=scale,
+            )
+        elif kind == 'swatch':
+            canvas.rectangle(left, top, shape[3], shape[4], shape[5], shape[6])
+        elif kind == 'bar':
+            colors = shape[5]
+            step = (shape[3] - left) / len(colors)
+            for i, color in enumerate(colors):
+                canvas.rectangle(
+                    left + i * step, top, left + (i + 1) * step + 1,
+                    shape[4], color,
+                )
+        else:
+            text_top = top + (line_height - FONT_HEIGHT * scale) / 2
+            canvas.text(int(left), int(text_top), shape[3], scale=scale)
+            if shape[4]:
+                # Bold: draw the text again, one pixel to the right.
+                canvas.text(int(left) + 1, int(text_top), shape[3],
+                            scale=scale)
+
+
+def _svg_path(rings):
+    """Create the path data for the rings of a polygon."""
+    return ' '.join(
+        'M' + ' L'.join('{:.1f} {:.1f}'.format(x, y) for x, y in ring) + ' Z'
+        for ring in rings
+    )
+
+
+def svg_document(shapes, width, height, legend=None):
+    """Create an SVG image.
+
+    Parameters
+    ----------
+    shapes : list of tuples
+        The rings (in pixels) and style for each feature.
+    width : integer
+        The width of the image.
+    height : integer
+        The height of the image.
+    legend : dict, optional
+        The legend to draw, see :py:func:`legend_layout`.
+
+    Returns
+    -------
+    svg : string
+        The SVG document.
+
+    """
+    lines = [
+        '<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" '
+        'viewBox="0 0 {0} {1}">'.format(width, height),
+        '<rect width="100%" height="100%" fill="{}"/>'.format(BACKGROUND),
+    ]
+    for rings, style in shapes:
+        if not rings:
+            continue
+        fill, alpha = parse_color(style.get('fillColor', '#262626'))
+        stroke, stroke_alpha = parse_color(style.get('color', '#262626'))
+        lines.append(
+            '<path d="{}" fill="rgb({:.0f},{:.0f},{:.0f})" '
+            'fill-opacity="{:.3g}" fill-rule="evenodd" '
+            'stroke="rgb({:.0f},{:.0f},{:.0f})" stroke-opacity="{:.3g}" '
+            'stroke-width="{:.3g}"/>'.format(
+                _svg_path(rings), *fill,
+                alpha * style.get('fillOpacity', 1.0), *stroke,
+                stroke_alpha * style.get('opacity', 1.0),
+                style.get('weight', 1.0),
+            )
+        )
+    if legend is not None:
+        font_size = SVG_FONT_SIZE
+        shapes = legend_layout(
+            legend, width, height, *_font_metrics('svg', width)
+        )
+        lines.append(
+            '<g font-family="sans-serif" font-size="{}">'.format(font_size)
+        )
+        for shape in shapes:
+            kind, left, top = shape[:3]
+            if kind == 'box':
+                lines.append(
+                    '<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" '
+                    'height="{:.1f}" rx="6" fill="white" fill-opacity="0.8" '
+                    'stroke="grey" stroke-width="2"/>'.format(
+                        left, top, shape[3] - left, shape[4] - top
+                    )
+                )
+            elif kind == 'swatch':
+                lines.append(
+                    '<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" '
+                    'height="{:.1f}" fill={} fill-opacity="{:.3g}" '
+                    'stroke="#999"/>'.format(
+                        left, top, shape[3] - left, shape[4] - top,
+                        quoteattr(shape[5]), shape[6],
+                    )
+                )
+            elif kind == 'bar':
+                stops = ''.join(
+                    '<stop offset="{:.3f}" stop-color={}/>'.format(
+                        i / max(len(shape[5]) - 1, 1), quoteattr(color[:7])
+                    )
+                    for i, color in enumerate(shape[5])
+                )
+                lines.append(
+                    '<defs><linearGradient id="colorbar">{}'
+                    '</linearGradient></defs>'.format(stops)
+                )
+                lines.append(
+                    '<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" '
+                    'height="{:.1f}" fill="url(#colorbar)"/>'.format(
+                        left, top, shape[3] - left, shape[4] - top
+                    )
+                )
+            else:
+                lines.append(
+                    '<text x="{:.1f}" y="{:.1f}" dominant-baseline='
+                    '"hanging"{}>{}</text>'.format(
+                        left, top + 0.25 * font_size,
+                        ' font-weight="bold"' if shape[4] else '',
+                        escape(shape[3]),
+                    )
+                )
+        lines.append('</g>')
+    lines.append('</svg>')
+    return '\n'.join(lines) + '\n'
+
+
+def render_image(geojson_layers, style_function, output, size=DEFAULT_SIZE,
+                 legend=None, supersample=SUPERSAMPLE):
+    """Draw map layers as a PNG or SVG image.
+
+    Parameters
+    ----------
+    geojson_layers : list of tuples
+        Each tuple is of form (name, geojson-dict), as given to
+        :py:func:`map_basics.produce_map`.
+    style_function : callable
+        The function giving the style (``fillColor``,
+        ``fillOpacity``, ``color``, ``weight`` and ``opacity``) for
+        a feature, as used for the interactive maps.
+    output : string
+        The file to write. The format is given by the suffix,
+        ``.png`` or ``.svg``.
+    size : tuple of integers, optional
+        The width and height of the image.
+    legend : dict, optional
+        The legend to draw, see :py:func:`legend_layout`.
+    supersample : integer, optional
+        For PNG images, draw on an image this many times larger in
+        each direction and average down, to smooth the edges.
+
+    """
+    width, height = size
+    image_format = output.rsplit('.', 1)[-1].lower()
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError('Unknown image format "{}"'.format(image_format))
+    features = [
+        feature for _, layer in geojson_layers
+        for feature in layer['features']
+    ]
+    flat = flatten_features(features)
+    factor = supersample if image_format == 'png' else 1
+    shapes = []
+    if len(flat['coordinates']):
+        reserve = None
+        if legend is not None:
+            reserve = [
+                i * factor
+                for i in legend_space(legend, width, height, image_format)
+            ]
+        projection = Projection(
+            flat['coordinates'], width * factor, height * factor,
+            reserve=reserve,
+        )
+        pixels = projection(flat['coordinates'])
+        shapes = [
+            (feature_rings(flat, pixels, i), style_function(feature))
+            for i, feature in enumerate(features)
+        ]
+    if image_format == 'svg':
+        with open(output, 'w', encoding='utf-8') as outfile:
+            outfile.write(svg_document(shapes, width, height, legend=legend))
+        return
+    canvas = Canvas(width * factor, height * factor)
+    # Features with the same style are drawn together:
+    fills = {}
+    strokes = {}
+    for rings, style in shapes:
+        fills.setdefault(
+            (style.get('fillColor', '#262626'), style.get('fillOpacity', 1.0)),
+            [],
+        ).extend(rings)
+        strokes.setdefault(
+            (style.get('color', '#262626'), style.get('opacity', 1.0),
+             style.get('weight', 1.0)),
+            [],
+        ).extend(rings)
+    for (color, opacity), rings in fills.items():
+        canvas.fill(rings, color, opacity)
+    for (color, opacity, weight), rings in strokes.items():
+        canvas.stroke(rings, color, opacity, weight * factor)
+    if factor > 1:
+        canvas = canvas.downsample(factor)
+    if legend is not None:
+        draw_legend(canvas, legend)
+    with open(output, 'wb') as outfile:
+        outfile.write(canvas.png())
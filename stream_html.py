@@ -0,0 +1,183 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Write the layers of a map page to the file one by one.
+
+Rendering a folium map with many layers keeps the geojson data, the
+copies made by folium and the rendered page in memory at the same
+time. Here, the page is rendered without any layers, but with a marker
+(:py:class:`LayerSlot`) where the layers go. The page is written up to
+the marker, then each layer is written directly to the file as it is
+produced (one feature at a time), and then the rest of the page. The
+layers are styled in the browser by a :py:class:`client_style.ClassStyle`,
+so only the features themselves are written. More features can be added
+to a layer which is already written (see :py:func:`write_features`), so
+that a layer collecting features from many files (e.g. the voting areas
+won by a party) can be written one file at a time.
+"""
+import json
+from branca.element import MacroElement
+from jinja2 import Template
+
+
+MARKER = '/* Streamed layers */'
+
+
+# Characters escaped in the json written to the page, so that the data
+# can not end the script element:
+_SCRIPT_ESCAPES = {
+    ord('<'): '\\u003c',
+    ord('>'): '\\u003e',
+    ord('&'): '\\u0026',
+}
+
+
+class LayerSlot(MacroElement):
+    """A marker in the script of the page, where the layers are written.
+
+    It must be added to the map after the ``ClassStyle`` and the
+    ``LayerControl`` used by the layers. The written layers are kept in
+    a list named by the slot, so that features can be added to them.
+    """
+
+    _template = Template(
+        '{% macro script(this, kwargs) %}\n'
+        'var {{ this.get_name() }} = [];\n' + MARKER + '\n{% endmacro %}'
+    )
+
+    def __init__(self):
+        """Set up the marker."""
+        super().__init__()
+        self._name = 'LayerSlot'
+
+
+def split_page(html):
+    """Split a rendered page at the marker for the layers.
+
+    Parameters
+    ----------
+    html : string
+        The page, rendered with a :py:class:`LayerSlot`.
+
+    Returns
+    -------
+    head : string
+        The page before the layers.
+    tail : string
+        The page after the layers.
+
+    """
+    head, found, tail = html.partition(MARKER)
+    if not found:
+        raise ValueError('The page has no slot for the layers')
+    return head, tail
+
+
+def script_json(value):
+    """Return json for a value, which is safe to put in a script."""
+    return json.dumps(value, ensure_ascii=False).translate(_SCRIPT_ESCAPES)
+
+
+_LAYER_SCRIPT = """
+            (function() {{
+                var layer = L.geoJson(null, {{style: {style}.style}});
+                layer.options.onEachFeature = {style}.onEachFeature(layer);
+                var tooltip = {tooltip};
+                if (tooltip.fields.length) {{
+                    layer.bindTooltip(function(item) {{
+                        var properties = item.feature.properties;
+                        var rows = tooltip.fields.map(function(field, i) {{
+                            var value = properties[field];
+                            var alias = tooltip.labels ?
+                                '<th>' + (tooltip.aliases[i] || '') + '</th>' :
+                                '';
+                            return '<tr>' + alias + '<td>' +
+                                (value === undefined ? '' : value) +
+                                '</td></tr>';
+                        }});
+                        return '<table>' + rows.join('') + '</table>';
+                    }}, {{sticky: true}});
+                }}
+                layer.addTo({map});
+                {control}.addOverlay(layer, {name});
+                {layers}.push(layer);
+                layer.addData(["""
+
+
+def write_layer(outfile, name, geojson_data, names, tooltip=None):
+    """Write the script for one layer to the page.
+
+    Parameters
+    ----------
+    outfile : object like io.TextIOBase
+        The file the page is written to.
+    name : string
+        The name of the layer (shown in the layer control).
+    geojson_data : dict
+        The geojson data for the layer.
+    names : dict
+        The names of the variables for the ``map``, the layer
+        ``control``, the ``style`` (a ``ClassStyle``) and the list of
+        written ``layers`` (the :py:class:`LayerSlot`) in the page.
+    tooltip : object like folium.features.GeoJsonTooltip, optional
+        The tooltip for the layer. Only its fields, aliases and
+        labels are used.
+
+    """
+    settings = {
+        'fields': list(getattr(tooltip, 'fields', None) or []),
+        'aliases': list(getattr(tooltip, 'aliases', None) or []),
+        'labels': bool(getattr(tooltip, 'labels', True)),
+    }
+    outfile.write(
+        _LAYER_SCRIPT.format(
+            style=names['style'],
+            map=names['map'],
+            control=names['control'],
+            layers=names['layers'],
+            name=script_json(name),
+            tooltip=script_json(settings),
+        )
+    )
+    _write_features(outfile, geojson_data)
+    outfile.write(']);\n            })();\n')
+
+
+def write_features(outfile, index, geojson_data, names):
+    """Write the script adding features to a layer already written.
+
+    Parameters
+    ----------
+    outfile : object like io.TextIOBase
+        The file the page is written to.
+    index : integer
+        The position of the layer among the written layers.
+    geojson_data : dict
+        The geojson data with the features to add.
+    names : dict
+        The names of the variables in the page, see
+        :py:func:`write_layer`.
+
+    """
+    outfile.write(
+        '\n            {}[{}].addData(['.format(names['layers'], index)
+    )
+    _write_features(outfile, geojson_data)
+    outfile.write(']);\n')
+
+
+def _write_features(outfile, geojson_data):
+    """Write the features of a layer, one at a time."""
+    for i, feature in enumerate(geojson_data['features']):
+        if i:
+            outfile.write(',')
+        outfile.write('\n')
+        outfile.write(script_json(feature))
+
+
+def write_bounds(outfile, map_name, bounds):
+    """Write the script fitting the map to some bounds."""
+    outfile.write(
+        '\n            {}.fitBounds({});\n'.format(
+            map_name, script_json(bounds)
+        )
+    )
@@ -0,0 +1,382 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Create synthetic election results and matching geometries.
+
+The results are written in the same format as the csv files from
+valgresultat.no (separated by ``;`` and with decimal commas), and the
+geometries as one GeoJSON file per kommune in ``valgkretser/`` and
+``kommuner/``. The voting areas are cells in a jittered grid where each
+border is created once, so neighbouring voting areas (and kommuner)
+share their borders exactly, as in the real data. Some voting areas
+consist of several polygons, and some kommuner only report results for
+the whole kommune. Example::
+
+    python synthetic_data.py syntetisk --kommuner 100 --kretser 40
+"""
+import argparse
+import json
+import pathlib
+import numpy as np
+
+
+FYLKER = {
+    '03': 'Oslo',
+    '11': 'Rogaland',
+    '15': 'Møre og Romsdal',
+    '18': 'Nordland',
+    '30': 'Viken',
+    '34': 'Innlandet',
+    '38': 'Vestfold og Telemark',
+    '42': 'Agder',
+    '46': 'Vestland',
+    '50': 'Trøndelag',
+    '54': 'Troms og Finnmark',
+}
+
+
+PARTIES = (
+    ('A', 'Arbeiderpartiet', 25.0),
+    ('H', 'Høyre', 20.0),
+    ('SP', 'Senterpartiet', 14.0),
+    ('FRP', 'Fremskrittspartiet', 8.0),
+    ('SV', 'SV - Sosialistisk Venstreparti', 6.0),
+    ('MDG', 'Miljøpartiet De Grønne', 7.0),
+    ('KRF', 'Kristelig Folkeparti', 4.0),
+    ('V', 'Venstre', 4.0),
+    ('RØDT', 'Rødt', 4.0),
+    ('FNB', 'Folkeaksjonen Nei til mer bompenger', 3.0),
+    ('PP', 'Pensjonistpartiet', 1.0),
+    ('PIR', 'Piratpartiet', 0.5),
+    ('DEMN', 'Demokratene i Norge', 0.5),
+    ('KYST', 'Kystpartiet', 0.5),
+)
+
+
+COLUMNS = (
+    'Fylkenummer',
+    'Fylkenavn',
+    'Kommunenummer',
+    'Kommunenavn',
+    'Stemmekretsnummer',
+    'Stemmekretsnavn',
+    'Partikode',
+    'Partinavn',
+    'Oppslutning prosentvis',
+    'Antall stemmeberettigede',
+    'Antall forhåndsstemmer',
+    'Antall valgtingstemmer',
+    'Antall stemmer totalt',
+)
+
+
+CRS = {
+    'type': 'name',
+    'properties': {'name': 'urn:ogc:def:crs:OGC:1.3:CRS84'},
+}
+
+
+def _decimal(value):
+    """Format a number with a decimal comma."""
+    return '{:.2f}'.format(value).replace('.', ',')
+
+
+def create_kommuner(nkommune):
+    """Create ids and names for the kommuner, spread over the fylker."""
+    fylker = list(FYLKER)
+    kommuner = []
+    for i in range(nkommune):
+        fylke = fylker[i % len(fylker)]
+        kommune_id = '{}{:02d}'.format(fylke, i // len(fylker) + 1)
+        kommuner.append((fylke, kommune_id, 'Kommune {}'.format(kommune_id)))
+    return kommuner
+
+
+class Lattice:
+    """A jittered grid where each cell border is created once.
+
+    Attributes
+    ----------
+    nx, ny : integer
+        The number of cells in each direction.
+    corners : numpy.array
+        The jittered corners of the cells.
+    horizontal : numpy.array
+        The points on the horizontal borders, from left to right.
+    vertical : numpy.array
+        The points on the vertical borders, from bottom to top.
+
+    """
+
+    def __init__(self, nx, ny, vertices=8, cell_size=0.02, origin=(5.0, 58.0),
+                 rng=None):
+        """Create the corners and the borders of the cells.
+
+        Parameters
+        ----------
+        nx, ny : integer
+            The number of cells in each direction.
+        vertices : integer, optional
+            The number of points added along each border.
+        cell_size : float, optional
+            The size of a cell (in degrees).
+        origin : tuple of floats, optional
+            The lower left corner of the grid.
+        rng : object like numpy.random.Generator, optional
+            The random number generator to use.
+
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        self.nx, self.ny = nx, ny
+        x = origin[0] + cell_size * np.arange(nx + 1)
+        y = origin[1] + cell_size * np.arange(ny + 1)
+        corners = np.stack(np.meshgrid(x, y, indexing='ij'), axis=-1)
+        corners[1:-1, 1:-1] += rng.uniform(
+            -0.25 * cell_size, 0.25 * cell_size, size=(nx - 1, ny - 1, 2)
+        ) if nx > 1 and ny > 1 else 0.0
+        self.corners = corners
+        along = np.linspace(0.0, 1.0, vertices + 2)[1:-1]
+        wiggle = 0.1 * cell_size
+        # Border (i, j) -> (i + 1, j):
+        start, end = corners[:-1, :], corners[1:, :]
+        self.horizontal = (
+            start[:, :, np.newaxis] +
+            along[:, np.newaxis] * (end - start)[:, :, np.newaxis]
+        )
+        self.horizontal[..., 1] += rng.uniform(
+            -wiggle, wiggle, size=self.horizontal.shape[:-1]
+        )
+        self.horizontal[:, [0, -1], :, 1] = start[:, [0, -1], np.newaxis, 1]
+        # Border (i, j) -> (i, j + 1):
+        start, end = corners[:, :-1], corners[:, 1:]
+        self.vertical = (
+            start[:, :, np.newaxis] +
+            along[:, np.newaxis] * (end - start)[:, :, np.newaxis]
+        )
+        self.vertical[..., 0] += rng.uniform(
+            -wiggle, wiggle, size=self.vertical.shape[:-1]
+        )
+        self.vertical[[0, -1], :, :, 0] = start[[0, -1], :, np.newaxis, 0]
+
+    def _bottom(self, i, j):
+        """Points from corner (i, j) to corner (i + 1, j)."""
+        return [self.corners[i, j]] + list(self.horizontal[i, j])
+
+    def _right(self, i, j):
+        """Points from corner (i, j) to corner (i, j + 1)."""
+        return [self.corners[i, j]] + list(self.vertical[i, j])
+
+    def _top(self, i, j):
+        """Points from corner (i + 1, j) to corner (i, j)."""
+        return [self.corners[i + 1, j]] + list(self.horizontal[i, j][::-1])
+
+    def _left(self, i, j):
+        """Points from corner (i, j + 1) to corner (i, j)."""
+        return [self.corners[i, j + 1]] + list(self.vertical[i, j][::-1])
+
+    def cell(self, i, j):
+        """Return the closed ring (counter-clockwise) for a cell."""
+        ring = (
+            self._bottom(i, j) + self._right(i + 1, j) +
+            self._top(i, j + 1) + self._left(i, j)
+        )
+        ring.append(ring[0])
+        return np.round(np.array(ring), 6).tolist()
+
+    def block(self, i0, j0, nx, ny):
+        """Return the closed ring (counter-clockwise) around a block."""
+        ring = []
+        for i in range(i0, i0 + nx):
+            ring += self._bottom(i, j0)
+        for j in range(j0, j0 + ny):
+            ring += self._right(i0 + nx, j)
+        for i in reversed(range(i0, i0 + nx)):
+            ring += self._top(i, j0 + ny)
+        for j in reversed(range(j0, j0 + ny)):
+            ring += self._left(i0, j)
+        ring.append(ring[0])
+        return np.round(np.array(ring), 6).tolist()
+
+
+def _polygon_geometry(rings):
+    """Create a Polygon or MultiPolygon from exterior rings."""
+    if len(rings) == 1:
+        return {'type': 'Polygon', 'coordinates': [rings[0]]}
+    return {'type': 'MultiPolygon', 'coordinates': [[i] for i in rings]}
+
+
+def _results(rng, nparty):
+    """Draw the oppslutning for the parties in one voting area."""
+    parties = PARTIES[:nparty]
+    mean = np.array([i[2] for i in parties])
+    share = rng.dirichlet(mean * 2.0 / mean.min() + 0.5)
+    return 100.0 * share
+
+
+def create_data(output, nkommune=20, nkrets=20, nparty=12, vertices=8,
+                whole=0.1, seed=1):
+    """Create synthetic results and geometries.
+
+    Parameters
+    ----------
+    output : string or object like pathlib.Path
+        The directory to write to.
+    nkommune : integer, optional
+        The number of kommuner.
+    nkrets : integer, optional
+        The number of voting areas in each kommune.
+    nparty : integer, optional
+        The number of parties (at most ``len(PARTIES)``).
+    vertices : integer, optional
+        The number of points along each border between two grid cells.
+    whole : float, optional
+        The fraction of the kommuner reporting results for the whole
+        kommune only (as voting area "0000").
+    seed : integer, optional
+        Seed for the random number generator.
+
+    Returns
+    -------
+    info : dict
+        The files written, the kommuner, fylker and parties.
+
+    """
+    rng = np.random.default_rng(seed)
+    output = pathlib.Path(output)
+    krets_dir = output.joinpath('valgkretser')
+    kommune_dir = output.joinpath('kommuner')
+    krets_dir.mkdir(parents=True, exist_ok=True)
+    kommune_dir.mkdir(parents=True, exist_ok=True)
+    nparty = min(nparty, len(PARTIES))
+    kommuner = create_kommuner(nkommune)
+    side = int(np.ceil(np.sqrt(nkrets)))
+    columns = int(np.ceil(np.sqrt(nkommune)))
+    rows = int(np.ceil(nkommune / columns))
+    lattice = Lattice(columns * side, rows * side, vertices=vertices, rng=rng)
+    result_file = output.joinpath('resultater.csv')
+    with open(result_file, 'w') as outfile:
+        outfile.write(';'.join(COLUMNS) + '\n')
+        for k, (fylke, kommune_id, kommune_navn) in enumerate(kommuner):
+            i0, j0 = side * (k % columns), side * (k // columns)
+            cells = [
+                (i0 + i % side, j0 + i // side) for i in range(side * side)
+            ]
+            features = []
+            for krets in range(nkrets):
+                # The remaining cells are added to the last voting area:
+                own = cells[krets:krets + 1] if krets < nkrets - 1 else (
+                    cells[krets:]
+                )
+                features.append(
+                    {
+                        'type': 'Feature',
+                        'properties': {
+                            'valgkretsnummer': krets + 1,
+                            'valgkretsnavn': 'Krets {:04d}'.format(krets + 1),
+                            'kommunenummer': int(kommune_id),
+                            'objtype': 'Valgkrets',
+                        },
+                        'geometry': _polygon_geometry(
+                            [lattice.cell(i, j) for i, j in own]
+                        ),
+                    }
+                )
+            with open(krets_dir.joinpath(
+                    'krets-{}.geojson'.format(kommune_id)), 'w') as geo:
+                json.dump(
+                    {'type': 'FeatureCollection', 'crs': CRS,
+                     'features': features},
+                    geo,
+                )
+            with open(kommune_dir.joinpath(
+                    'kommune-{}.geojson'.format(kommune_id)), 'w') as geo:
+                json.dump(
+                    {
+                        'type': 'FeatureCollection',
+                        'crs': CRS,
+                        'features': [
+                            {
+                                'type': 'Feature',
+                                'properties': {
+                                    'kommunenummer': int(kommune_id),
+                                    'navn': kommune_navn,
+                                },
+                                'geometry': _polygon_geometry(
+                                    [lattice.block(i0, j0, side, side)]
+                                ),
+                            }
+                        ],
+                    },
+                    geo,
+                )
+            if rng.random() < whole:
+                kretser = [('0000', 'Hele kommunen')]
+            else:
+                kretser = [
+                    ('{:04d}'.format(i + 1), 'Krets {:04d}'.format(i + 1))
+                    for i in range(nkrets)
+                ]
+            for krets_id, krets_navn in kretser:
+                voters = int(rng.integers(200, 5000))
+                total = int(voters * rng.uniform(0.5, 0.8))
+                early = int(total * rng.uniform(0.2, 0.5))
+                for (code, name, _), share in zip(
+                        PARTIES[:nparty], _results(rng, nparty)):
+                    votes = int(round(total * share / 100.0))
+                    outfile.write(';'.join((
+                        fylke, FYLKER[fylke], kommune_id, kommune_navn,
+                        krets_id, krets_navn, code, name, _decimal(share),
+                        str(voters), str(early * votes // max(total, 1)),
+                        str(votes - early * votes // max(total, 1)),
+                        str(votes),
+                    )) + '\n')
+    return {
+        'results': str(result_file),
+        'kommuner': [i[1] for i in kommuner],
+        'fylker': sorted({i[0] for i in kommuner}),
+        'parties': [i[1] for i in PARTIES[:nparty]],
+    }
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Create synthetic election results and geometries.'
+    )
+    PARSER.add_argument('output', help='The directory to write to.')
+    PARSER.add_argument(
+        '--kommuner', type=int, default=20, help='The number of kommuner.'
+    )
+    PARSER.add_argument(
+        '--kretser',
+        type=int,
+        default=20,
+        help='The number of voting areas in each kommune.',
+    )
+    PARSER.add_argument(
+        '--parties', type=int, default=12, help='The number of parties.'
+    )
+    PARSER.add_argument(
+        '--vertices',
+        type=int,
+        default=8,
+        help='The number of points along each border.',
+    )
+    PARSER.add_argument(
+        '--whole',
+        type=float,
+        default=0.1,
+        help='The fraction of kommuner reporting only one result.',
+    )
+    PARSER.add_argument(
+        '--seed', type=int, default=1, help='Seed for the random numbers.'
+    )
+    ARGS = PARSER.parse_args()
+    INFO = create_data(
+        ARGS.output,
+        nkommune=ARGS.kommuner,
+        nkrets=ARGS.kretser,
+        nparty=ARGS.parties,
+        vertices=ARGS.vertices,
+        whole=ARGS.whole,
+        seed=ARGS.seed,
+    )
+    print('Wrote results to "{}"'.format(INFO['results']))
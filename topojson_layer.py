@@ -0,0 +1,110 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Add layers stored in one shared TopoJSON topology to a folium map.
+
+The topology is embedded in the map once (by :py:class:`TopologyData`)
+and each layer (a :py:class:`SharedTopoJson`) refers to one of its
+objects. Borders shared between layers are therefore only stored once.
+"""
+import folium
+from branca.element import MacroElement
+from jinja2 import Template
+
+
+class TopologyData(MacroElement):
+    """Embed a TopoJSON topology in a map."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = {{ this.data|tojson }};
+        {% endmacro %}
+        """)
+
+    def __init__(self, data):
+        """Set up the topology.
+
+        Parameters
+        ----------
+        data : dict
+            The TopoJSON topology.
+
+        """
+        super().__init__()
+        self._name = 'TopologyData'
+        self.data = data
+
+
+class SharedTopoJson(folium.TopoJson):
+    """A layer created from an object in an embedded topology."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.geoJson(
+                topojson.feature(
+                    {{ this.topology.get_name() }},
+                    {{ this.topology.get_name() }}.objects[
+                        {{ this.object_name|tojson }}
+                    ]
+                ),
+                {
+                    style: function(feature) {
+                        return feature.properties.style;
+                    },
+                    onEachFeature: function(feature, layer) {
+                        layer.on({
+                            mouseover: function(e) {
+                                e.target.setStyle(feature.properties.highlight);
+                            },
+                            mouseout: function(e) {
+                                {{ this.get_name() }}.resetStyle(e.target);
+                            },
+                        });
+                    },
+                }
+            ).addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+        """)
+
+    def __init__(self, topology, object_name, style_function=None,
+                 highlight_function=None, name=None, tooltip=None):
+        """Set up the layer.
+
+        Parameters
+        ----------
+        topology : object like TopologyData
+            The embedded topology.
+        object_name : string
+            The object in the topology to show in this layer.
+        style_function : callable, optional
+            A style function for defining the style to use when drawing
+            the geometries.
+        highlight_function : callable, optional
+            A function defining the style to use when highlighting.
+        name : string, optional
+            The name of the layer.
+        tooltip : object like folium.features.GeoJsonTooltip, optional
+            A tooltip to add to the layer.
+
+        """
+        super().__init__(
+            topology.data,
+            'objects.{}'.format(object_name),
+            style_function=style_function,
+            name=name,
+            tooltip=tooltip,
+        )
+        self._name = 'SharedTopoJson'
+        self.topology = topology
+        self.object_name = object_name
+        self.highlight_function = highlight_function or (lambda x: {})
+        # The topology is rendered before this layer, so the styles
+        # must be stored in it right away:
+        self.style_data()
+
+    def style_data(self):
+        """Store the style and highlighting for each geometry."""
+        objects = self.data['objects'][self.object_name]
+        for geometry in objects['geometries']:
+            properties = geometry.setdefault('properties', {})
+            properties['style'] = self.style_function(geometry)
+            properties['highlight'] = self.highlight_function(geometry)
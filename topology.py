@@ -0,0 +1,315 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Split polygon layers into shared arcs.
+
+Neighbouring voting areas share most of their boundaries. Here, the
+rings of all features are cut at junctions (points where the
+neighbouring vertices differ between rings) into arcs, and identical
+arcs are stored only once. A ring is then described by a list of arc
+references, where ``~i`` means that arc ``i`` is traversed in reverse
+(as in TopoJSON).
+"""
+import copy
+import numpy as np
+from geometry import GEOMETRY_NAMES, flatten_features
+
+
+class Topology:
+    """A set of geojson layers, described by shared arcs.
+
+    Attributes
+    ----------
+    points : numpy.array
+        The unique (x, y) points.
+    arcs : list of numpy.arrays
+        The indices of the points making up each arc.
+    layers : list of tuples
+        The ``(name, geojson-dict)`` layers this topology was
+        created from.
+    rings : list of lists of integers
+        The arc references for each ring (in the order the rings
+        appear in the flat arrays for the layers).
+    flats : list of dicts
+        The flat arrays for the features in each layer,
+        see :py:func:`geometry.flatten_features`.
+
+    """
+
+    def __init__(self, geojson_layers):
+        """Build the topology for the given layers.
+
+        Parameters
+        ----------
+        geojson_layers : list of tuples
+            Each tuple is of form (name, geojson-dict).
+
+        """
+        self.layers = geojson_layers
+        self.flats = self.flatten_layers(geojson_layers)
+        self.points = np.zeros((0, 2))
+        self.arcs = []
+        self.rings = []
+        self._build()
+
+    @staticmethod
+    def flatten_layers(geojson_layers):
+        """Return the flat arrays for the features in each layer."""
+        return [
+            flatten_features(data['features']) for _, data in geojson_layers
+        ]
+
+    def _ring_point_ids(self):
+        """Identify the unique points and return the points for each ring."""
+        coordinates = [flat['coordinates'] for flat in self.flats]
+        coordinates = np.concatenate(coordinates) if coordinates else (
+            np.zeros((0, 2))
+        )
+        self.points, point_id = np.unique(
+            coordinates, axis=0, return_inverse=True
+        )
+        point_id = point_id.ravel()
+        rings = []
+        shift = 0
+        for flat in self.flats:
+            offsets = flat['rings'] + shift
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                ids = point_id[start:end]
+                # Skip the closing point of the ring:
+                if len(ids) > 1 and ids[0] == ids[-1]:
+                    ids = ids[:-1]
+                rings.append(ids)
+            shift += len(flat['coordinates'])
+        return rings
+
+    def _junctions(self, rings):
+        """Find points where rings join or split."""
+        junction = np.zeros(len(self.points), dtype=bool)
+        if not rings:
+            return junction
+        current = np.concatenate(rings)
+        previous = np.concatenate([np.roll(ring, 1) for ring in rings])
+        following = np.concatenate([np.roll(ring, -1) for ring in rings])
+        pairs = np.column_stack(
+            (
+                current,
+                np.minimum(previous, following),
+                np.maximum(previous, following),
+            )
+        )
+        pairs = np.unique(pairs, axis=0)
+        count = np.bincount(pairs[:, 0], minlength=len(self.points))
+        junction[count > 1] = True
+        return junction
+
+    def _add_arc(self, ids, arc_index):
+        """Add an arc, or find an existing equal arc."""
+        key = ids.tobytes()
+        if key in arc_index:
+            return arc_index[key]
+        reverse = ids[::-1].tobytes()
+        if reverse in arc_index:
+            return ~arc_index[reverse]
+        arc_index[key] = len(self.arcs)
+        self.arcs.append(ids)
+        return arc_index[key]
+
+    def _build(self):
+        """Cut the rings into arcs at the junctions."""
+        rings = self._ring_point_ids()
+        junction = self._junctions(rings)
+        arc_index = {}
+        for ids in rings:
+            if len(ids) == 0:
+                self.rings.append([])
+                continue
+            cuts = np.flatnonzero(junction[ids])
+            if len(cuts) == 0:
+                # A closed ring with no junctions. Start it at the lowest
+                # point id and store it in one direction only, so that
+                # equal rings give equal arcs:
+                ids = np.roll(ids, -int(np.argmin(ids)))
+                closed = np.append(ids, ids[0])
+                if len(ids) > 1 and ids[1] > ids[-1]:
+                    ref = ~self._add_arc(closed[::-1].copy(), arc_index)
+                else:
+                    ref = self._add_arc(closed, arc_index)
+                self.rings.append([ref])
+                continue
+            ids = np.roll(ids, -cuts[0])
+            cuts = cuts - cuts[0]
+            ends = np.append(cuts[1:], len(ids))
+            closed = np.append(ids, ids[0])
+            self.rings.append(
+                [
+                    self._add_arc(closed[start:end + 1], arc_index)
+                    for start, end in zip(cuts, ends)
+                ]
+            )
+
+    def arc_coordinates(self):
+        """Return the coordinates for each arc."""
+        return [self.points[arc] for arc in self.arcs]
+
+    @staticmethod
+    def ring_coordinates(ring, arcs):
+        """Assemble the coordinates for a ring from its arcs.
+
+        Parameters
+        ----------
+        ring : list of integers
+            The arc references for the ring.
+        arcs : list of numpy.arrays
+            The coordinates for each arc.
+
+        Returns
+        -------
+        coordinates : numpy.array
+            The coordinates of the closed ring.
+
+        """
+        pieces = []
+        for i, ref in enumerate(ring):
+            coords = arcs[ref] if ref >= 0 else arcs[~ref][::-1]
+            pieces.append(coords if i == 0 else coords[1:])
+        if not pieces:
+            return np.zeros((0, 2))
+        return np.concatenate(pieces)
+
+    def _quantized_arcs(self, quantization):
+        """Quantize and delta-encode the arcs."""
+        if len(self.points) == 0:
+            return [], {'scale': [1, 1], 'translate': [0, 0]}
+        low = self.points.min(axis=0)
+        high = self.points.max(axis=0)
+        scale = (high - low) / (quantization - 1)
+        scale[scale == 0] = 1.0
+        quantized = np.round((self.points - low) / scale).astype(np.int64)
+        arcs = []
+        for arc in self.arcs:
+            coords = quantized[arc]
+            delta = np.diff(coords, axis=0)
+            # Remove points which end up on top of the previous one:
+            moved = np.any(delta != 0, axis=1)
+            moved[-1] = True
+            delta = delta[moved]
+            arcs.append(np.vstack((coords[:1], delta)).tolist())
+        transform = {'scale': scale.tolist(), 'translate': low.tolist()}
+        return arcs, transform
+
+    def to_topojson(self, quantization=100000):
+        """Convert the layers to a TopoJSON topology.
+
+        Parameters
+        ----------
+        quantization : integer, optional
+            The number of distinct values to use for the coordinates
+            in each dimension.
+
+        Returns
+        -------
+        topology : dict
+            The TopoJSON topology, with the objects ``layer0``,
+            ``layer1`` and so on for the layers.
+        object_names : list of strings
+            The names of the objects for the layers.
+
+        """
+        arcs, transform = self._quantized_arcs(quantization)
+        objects = {}
+        object_names = []
+        ring = 0
+        for i, ((_, data), flat) in enumerate(zip(self.layers, self.flats)):
+            geometries = []
+            for j, feature in enumerate(data['features']):
+                polygons = []
+                parts = range(flat['features'][j], flat['features'][j + 1])
+                for part in parts:
+                    nring = flat['parts'][part + 1] - flat['parts'][part]
+                    polygons.append(
+                        [
+                            [int(ref) for ref in self.rings[ring + k]]
+                            for k in range(nring)
+                        ]
+                    )
+                    ring += nring
+                geometry_type = GEOMETRY_NAMES[int(flat['geometry_type'][j])]
+                geometry = {
+                    'type': geometry_type,
+                    'properties': copy.copy(feature.get('properties', {})),
+                }
+                if geometry_type == 'Polygon':
+                    geometry['arcs'] = polygons[0]
+                elif geometry_type == 'MultiPolygon':
+                    geometry['arcs'] = polygons
+                if 'id' in feature:
+                    geometry['id'] = feature['id']
+                geometries.append(geometry)
+            name = 'layer{}'.format(i)
+            objects[name] = {
+                'type': 'GeometryCollection',
+                'geometries': geometries,
+            }
+            object_names.append(name)
+        topology = {
+            'type': 'Topology',
+            'transform': transform,
+            'objects': objects,
+            'arcs': arcs,
+        }
+        return topology, object_names
+
+    def to_layers(self, arcs=None):
+        """Recreate the layers from (possibly modified) arcs.
+
+        Parameters
+        ----------
+        arcs : list of numpy.arrays, optional
+            The coordinates for each arc. If not given, the full
+            arcs are used.
+
+        Returns
+        -------
+        geojson_layers : list of tuples
+            Each tuple is of form (name, geojson-dict), where the
+            geometries are created from the arcs.
+
+        """
+        if arcs is None:
+            arcs = self.arc_coordinates()
+        new_layers = []
+        ring = 0
+        for (name, data), flat in zip(self.layers, self.flats):
+            new_data = {
+                key: val for key, val in data.items() if key != 'features'
+            }
+            features = []
+            for i, feature in enumerate(data['features']):
+                new_feature = {
+                    key: copy.copy(val) for key, val in feature.items()
+                    if key != 'geometry'
+                }
+                polygons = []
+                parts = range(flat['features'][i], flat['features'][i + 1])
+                for part in parts:
+                    polygon = []
+                    nring = flat['parts'][part + 1] - flat['parts'][part]
+                    for _ in range(nring):
+                        coords = self.ring_coordinates(self.rings[ring], arcs)
+                        polygon.append(coords.tolist())
+                        ring += 1
+                    polygons.append(polygon)
+                geometry_type = GEOMETRY_NAMES[int(flat['geometry_type'][i])]
+                if geometry_type is None:
+                    new_feature['geometry'] = None
+                elif geometry_type == 'Polygon':
+                    new_feature['geometry'] = {
+                        'type': 'Polygon', 'coordinates': polygons[0],
+                    }
+                else:
+                    new_feature['geometry'] = {
+                        'type': 'MultiPolygon', 'coordinates': polygons,
+                    }
+                features.append(new_feature)
+            new_data['features'] = features
+            new_layers.append((name, new_data))
+        return new_layers
@@ -0,0 +1,436 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""One command for creating the maps and the other tasks.
+
+Each task is a subcommand, and only the modules needed by the chosen
+subcommand are imported (so that, for instance, listing the kommuner
+in a fylke does not import folium)::
+
+    python valg.py kommuner-i-fylke 2019-09-14_partifordeling_4_ko_2019.csv 50
+    python valg.py valgkretser 2019-09-14_partifordeling_4_ko_2019.csv 5001
+
+Importing pandas and folium and reading the results still takes a
+while. To avoid this for repeated commands, a daemon can be started
+which keeps the modules imported and the parsed results and geometries
+in memory::
+
+    python valg.py daemon start --preload 2019-09-14_partifordeling_4_ko_2019.csv
+
+While the daemon is running, the commands are sent to it and run there
+(in the directory the command was given in), unless ``--no-daemon``
+is given. Commands which keep running (serving a site or watching the
+results) are always run directly.
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import traceback
+
+
+# The subcommands, with the module running them and a description:
+COMMANDS = {
+    'parti-i-kommune': (
+        'kart_parti_i_kommune',
+        'Map the results for a party in the voting areas of a kommune.',
+    ),
+    'valgkretser': (
+        'kart_resultat_valgkretser_i_kommune',
+        'Map the largest party in the voting areas of kommuner.',
+    ),
+    'kommuner': (
+        'kart_resultat_kommuner_i_fylke',
+        'Map the largest party in the kommuner of fylker.',
+    ),
+    'parti-i-kommuner': (
+        'kart_resultat_parti_i_kommuner',
+        'Map the kommuner where the given parties are largest.',
+    ),
+    'parti-i-valgkretser': (
+        'kart_resultat_parti_i_valgkretser',
+        'Map the voting areas where the given parties are largest.',
+    ),
+    'endring': (
+        'kart_endring_parti_i_kommune',
+        'Map the change for a party in the voting areas of a kommune.',
+    ),
+    'kommuner-i-fylke': (
+        'get_kommuner_i_fylke',
+        'Print the kommuner in a fylke.',
+    ),
+    'hierarki': (
+        'hierarchy',
+        'Print the fylker and kommuner in the results.',
+    ),
+    'batch': (
+        'batch',
+        'Create many maps in parallel, reading the results only once.',
+    ),
+    'punkter': (
+        'spatial_index',
+        'Find the voting area and winner for points.',
+    ),
+    'arkiv': (
+        'election_store',
+        'Store several elections together and compare them.',
+    ),
+    'lager': (
+        'geometry_store',
+        'Pack GeoJSON files into geometry stores.',
+    ),
+    'server': (
+        'map_server',
+        'Serve a map site.',
+    ),
+}
+
+
+def default_socket():
+    """Return the default socket for the daemon."""
+    if 'VALG_SOCKET' in os.environ:
+        return os.environ['VALG_SOCKET']
+    user = getattr(os, 'getuid', lambda: 0)()
+    return os.path.join(tempfile.gettempdir(), 'valg-{}.sock'.format(user))
+
+
+def parse_command(command, argv):
+    """Import the module for a subcommand and parse its arguments.
+
+    Parameters
+    ----------
+    command : string
+        The subcommand.
+    argv : list of strings
+        The arguments for the subcommand.
+
+    Returns
+    -------
+    module : object like module
+        The module running the subcommand.
+    args : object like argparse.Namespace
+        The parsed arguments.
+
+    """
+    module_name, description = COMMANDS[command]
+    module = importlib.import_module(module_name)
+    parser = argparse.ArgumentParser(
+        prog='valg {}'.format(command), description=description
+    )
+    module.add_arguments(parser)
+    return module, parser.parse_args(argv)
+
+
+def _runs_forever(command, args):
+    """Check if a command keeps running (and should not use the daemon)."""
+    return command == 'server' or getattr(args, 'serve', False) or (
+        getattr(args, 'watch', False)
+    )
+
+
+def _exit_code(error):
+    """Get the exit code from a SystemExit, printing its message."""
+    if error.code is None or isinstance(error.code, int):
+        return error.code or 0
+    print(error.code, file=sys.stderr)
+    return 1
+
+
+class _Output(io.TextIOBase):
+    """Send the text written by a command to the client."""
+
+    def __init__(self, connection, stream):
+        """Set up the output for the given stream."""
+        super().__init__()
+        self.connection = connection
+        self.stream = stream
+
+    def writable(self):
+        """The output can be written to."""
+        return True
+
+    def write(self, text):
+        """Send text to the client."""
+        if text:
+            _send(self.connection, {self.stream: text})
+        return len(text)
+
+
+def _send(connection, message):
+    """Send a message (a line of json) over a connection."""
+    try:
+        connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+    except OSError:
+        # The client has gone, but the command is allowed to finish.
+        pass
+
+
+class Daemon:
+    """Run commands sent by clients, keeping the data in memory.
+
+    Attributes
+    ----------
+    socket_path : string
+        The unix socket the daemon listens on.
+    started : float
+        The time the daemon was started.
+    served : integer
+        The number of commands run.
+
+    """
+
+    def __init__(self, socket_path):
+        """Import the modules and enable keeping data in memory."""
+        self.socket_path = socket_path
+        self.started = time.time()
+        self.served = 0
+        for module_name, _ in COMMANDS.values():
+            importlib.import_module(module_name)
+        self.read_results = importlib.import_module('read_results')
+        self.map_basics = importlib.import_module('map_basics')
+        self.read_results.CSV_CACHE['memory'] = True
+        self.map_basics.GEOJSON_CACHE['memory'] = True
+
+    def preload(self, result_files=(), directories=()):
+        """Read results and geometries into memory."""
+        for result_file in result_files:
+            self.read_results.read_csv_results(result_file)
+        for directory in directories:
+            for filename in sorted(os.listdir(directory)):
+                if filename.endswith('.geojson'):
+                    self.map_basics.load_geojson_file(
+                        os.path.join(directory, filename)
+                    )
+
+    def status(self):
+        """Return information about the daemon."""
+        return {
+            'pid': os.getpid(),
+            'socket': self.socket_path,
+            'uptime': time.time() - self.started,
+            'served': self.served,
+            'results': len(self.read_results.RESULTS_IN_MEMORY),
+            'geometries': len(self.map_basics.GEOJSON_IN_MEMORY),
+        }
+
+    def handle(self, connection):
+        """Handle a request from a client.
+
+        Returns
+        -------
+        out : boolean
+            False if the daemon was asked to stop.
+
+        """
+        try:
+            with connection.makefile('r', encoding='utf-8') as infile:
+                request = json.loads(infile.readline() or '{}')
+        except ValueError:
+            request = None
+        if not isinstance(request, dict):
+            # A malformed request should not stop the daemon:
+            _send(connection, {'stderr': 'Malformed request\n'})
+            _send(connection, {'exit': 1})
+            return True
+        if request.get('stop'):
+            _send(connection, {'exit': 0})
+            return False
+        if request.get('status'):
+            _send(connection, {'status': self.status()})
+            return True
+        command = request.get('command')
+        if command not in COMMANDS:
+            _send(connection, {'local': True})
+            return True
+        code = 0
+        stdout = _Output(connection, 'stdout')
+        stderr = _Output(connection, 'stderr')
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(stderr):
+            try:
+                os.chdir(request['cwd'])
+                module, args = parse_command(command, request['args'])
+                if _runs_forever(command, args):
+                    _send(connection, {'local': True})
+                    return True
+                module.run(args)
+            except SystemExit as error:
+                code = _exit_code(error)
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()
+                code = 1
+        self.served += 1
+        _send(connection, {'exit': code})
+        return True
+
+    def serve(self):
+        """Listen for commands until asked to stop."""
+        if _connect(self.socket_path) is not None:
+            raise SystemExit(
+                'A daemon is already running on "{}"'.format(self.socket_path)
+            )
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(self.socket_path)
+            os.chmod(self.socket_path, 0o600)
+            server.listen()
+            print('Daemon (pid {}) listening on "{}"'.format(
+                os.getpid(), self.socket_path
+            ))
+            running = True
+            while running:
+                connection, _ = server.accept()
+                with connection:
+                    running = self.handle(connection)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.socket_path)
+        print('Daemon stopped')
+
+
+def _connect(socket_path):
+    """Connect to a running daemon, if any."""
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except OSError:
+        connection.close()
+        return None
+    return connection
+
+
+def send_request(socket_path, request):
+    """Send a request to the daemon and pass on its output.
+
+    Parameters
+    ----------
+    socket_path : string
+        The socket of the daemon.
+    request : dict
+        The request to send.
+
+    Returns
+    -------
+    reply : dict or None
+        The last message from the daemon (with the exit code or the
+        status), or None if there is no daemon or if the command
+        should be run directly.
+
+    """
+    connection = _connect(socket_path)
+    if connection is None:
+        return None
+    with connection:
+        connection.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with connection.makefile('r', encoding='utf-8') as infile:
+            for line in infile:
+                message = json.loads(line)
+                if 'stdout' in message:
+                    sys.stdout.write(message['stdout'])
+                elif 'stderr' in message:
+                    sys.stderr.write(message['stderr'])
+                elif 'local' in message:
+                    return None
+                else:
+                    return message
+    print('Lost the connection to the daemon', file=sys.stderr)
+    return {'exit': 1}
+
+
+def daemon(argv, socket_path):
+    """Start, stop or check the daemon."""
+    parser = argparse.ArgumentParser(
+        prog='valg daemon',
+        description='Keep the results and geometries in memory.',
+    )
+    parser.add_argument('action', choices=('start', 'stop', 'status'))
+    parser.add_argument(
+        '--preload',
+        nargs='+',
+        default=[],
+        metavar='CSV',
+        help='Result files to read when starting.',
+    )
+    parser.add_argument(
+        '--preload-geometries',
+        nargs='+',
+        default=[],
+        metavar='DIRECTORY',
+        help='Directories with GeoJSON files to load when starting.',
+    )
+    args = parser.parse_args(argv)
+    if not hasattr(socket, 'AF_UNIX'):
+        raise SystemExit('The daemon needs unix sockets.')
+    if args.action == 'start':
+        server = Daemon(socket_path)
+        server.preload(args.preload, args.preload_geometries)
+        server.serve()
+        return
+    reply = send_request(socket_path, {args.action: True})
+    if reply is None:
+        raise SystemExit('No daemon running on "{}"'.format(socket_path))
+    if args.action == 'status':
+        print(json.dumps(reply['status'], indent=2))
+    else:
+        print('Stopped the daemon on "{}"'.format(socket_path))
+
+
+def main(argv=None):
+    """Run a subcommand, in the daemon if it is running."""
+    parser = argparse.ArgumentParser(
+        prog='valg',
+        description='Create maps from election results.',
+        epilog='Commands: {}'.format('; '.join(
+            '{}: {}'.format(key, val[1]) for key, val in COMMANDS.items()
+        ) + '; daemon: Keep the results and geometries in memory.'),
+    )
+    parser.add_argument(
+        '--no-daemon',
+        action='store_true',
+        help='Run the command directly, even if a daemon is running.',
+    )
+    parser.add_argument(
+        '--socket',
+        default=default_socket(),
+        help='The socket of the daemon.',
+    )
+    parser.add_argument(
+        'command',
+        choices=list(COMMANDS) + ['daemon'],
+        help='The command to run.',
+    )
+    parser.add_argument(
+        'args',
+        nargs=argparse.REMAINDER,
+        help='Arguments for the command (see "valg COMMAND -h").',
+    )
+    args = parser.parse_args(argv)
+    if args.command == 'daemon':
+        daemon(args.args, args.socket)
+        return 0
+    if not args.no_daemon:
+        reply = send_request(
+            args.socket,
+            {'command': args.command, 'args': args.args, 'cwd': os.getcwd()},
+        )
+        if reply is not None:
+            return reply['exit']
+    module, command_args = parse_command(args.command, args.args)
+    module.run(command_args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
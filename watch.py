@@ -0,0 +1,121 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Follow a result file which is updated while the votes are counted.
+
+The result file is polled for changes, and it is only read when it has
+stopped changing (so that a file which is being written is not read).
+The new results are compared to the previous ones, so that only the
+areas with changed results need to be updated.
+"""
+import os
+import time
+import pandas as pd
+from read_results import read_csv_results
+
+
+KEYS = ('Kommunenummer', 'Stemmekretsnummer', 'Partinavn')
+VALUE = 'Oppslutning prosentvis'
+
+
+def stat_signature(filename):
+    """Return the size and modification time of a file (or None)."""
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def wait_for_change(filename, signature, interval=2.0):
+    """Wait until a file has changed and is no longer being written.
+
+    Parameters
+    ----------
+    filename : string
+        The file to watch.
+    signature : tuple
+        The signature (see :py:func:`stat_signature`) of the file when
+        it was last read.
+    interval : float, optional
+        The number of seconds between checking the file.
+
+    Returns
+    -------
+    signature : tuple
+        The signature of the changed file.
+
+    """
+    while True:
+        time.sleep(interval)
+        current = stat_signature(filename)
+        if current is None or current == signature:
+            continue
+        # Wait for the file to settle before reading it:
+        time.sleep(min(interval, 0.5))
+        if stat_signature(filename) == current:
+            return current
+
+
+def watch_results(result_file, interval=2.0):
+    """Read the results each time the result file changes.
+
+    Parameters
+    ----------
+    result_file : string
+        The csv file with the results.
+    interval : float, optional
+        The number of seconds between checking the file.
+
+    Yields
+    ------
+    results : object like pandas.DataFrame
+        The new results.
+
+    """
+    signature = stat_signature(result_file)
+    print('Watching "{}" for changes (stop with Ctrl-C)'.format(result_file))
+    while True:
+        signature = wait_for_change(result_file, signature, interval)
+        yield read_csv_results(result_file)
+
+
+def changed_rows(old, new, keys=KEYS, value=VALUE):
+    """Find the rows where the results have changed.
+
+    Parameters
+    ----------
+    old : object like pandas.DataFrame
+        The previous results.
+    new : object like pandas.DataFrame
+        The new results.
+    keys : tuple of strings, optional
+        The columns identifying a row.
+    value : string, optional
+        The column with the value to compare.
+
+    Returns
+    -------
+    changed : object like pandas.DataFrame
+        The keys for the rows which are new, removed or have a
+        different value.
+
+    """
+    keys = list(keys)
+    joined = pd.concat(
+        [
+            old.set_index(keys)[value].rename('old'),
+            new.set_index(keys)[value].rename('new'),
+        ],
+        axis=1,
+        join='outer',
+    )
+    same = (joined['old'] == joined['new']) | (
+        joined['old'].isna() & joined['new'].isna()
+    )
+    return joined.index[~same.to_numpy()].to_frame(index=False)
+
+
+def changed_kommuner(old, new):
+    """Return the kommuner where the results have changed."""
+    changed = changed_rows(old, new)
+    return sorted(str(i) for i in changed['Kommunenummer'].unique())
@@ -0,0 +1,87 @@
+# Copyright (c) 2019, Anders Lervik.
+# Distributed under the MIT License. See LICENSE for more info.
+"""Find the largest parties in areas from the election results.
+
+All areas are handled in a single grouped pass over the results: The
+results are sorted once by area and oppslutning, and the first and
+second row of each area are the winner and the runner-up.
+"""
+import numpy as np
+from profiling import profiled
+
+
+VALUE = 'Oppslutning prosentvis'
+PARTY = 'Partinavn'
+
+
+@profiled('extract')
+def find_winners(results, keys, columns=()):
+    """Find the winner and runner-up for all areas.
+
+    Parameters
+    ----------
+    results : object like pandas.DataFrame
+        The election results.
+    keys : tuple of strings
+        The columns defining the areas, for instance
+        ``('Kommunenummer', 'Stemmekretsnummer')``.
+    columns : tuple of strings, optional
+        Additional columns (e.g. names of the areas) to include for
+        each area. The values are taken from the winning row.
+
+    Returns
+    -------
+    winners : object like pandas.DataFrame
+        The winners, indexed by the given keys. It contains the
+        columns ``partinavn`` and ``oppslutning`` for the winner,
+        ``partinavn_nummer_to`` and ``oppslutning_nummer_to`` for the
+        runner-up, ``margin`` (the difference in oppslutning between
+        them), and the requested additional columns.
+
+    """
+    keys = list(keys)
+    ordered = results.sort_values(
+        keys + [VALUE],
+        ascending=[True for _ in keys] + [False],
+        na_position='last',
+        kind='mergesort',
+    )
+    rank = ordered.groupby(
+        keys, sort=False, observed=True
+    ).cumcount().to_numpy()
+    winners = ordered.loc[rank == 0, keys + [PARTY, VALUE] + list(columns)]
+    winners = winners.rename(
+        columns={PARTY: 'partinavn', VALUE: 'oppslutning'}
+    ).set_index(keys)
+    runner_up = ordered.loc[rank == 1, keys + [PARTY, VALUE]].rename(
+        columns={
+            PARTY: 'partinavn_nummer_to',
+            VALUE: 'oppslutning_nummer_to',
+        }
+    ).set_index(keys)
+    winners = winners.join(runner_up, how='left')
+    winners['margin'] = winners['oppslutning'] - np.nan_to_num(
+        winners['oppslutning_nummer_to'].to_numpy(dtype=float)
+    )
+    return winners
+
+
+def area_dict(winners, columns):
+    """Convert (a selection of) winners into a dict.
+
+    Parameters
+    ----------
+    winners : object like pandas.DataFrame
+        The winners as returned by :py:func:`find_winners`.
+    columns : dict
+        The columns to include, the keys are the column names in
+        winners and the values the keys to use in the dict.
+
+    Returns
+    -------
+    area : dict of dicts
+        The winner for each area, keyed by the index of winners.
+
+    """
+    data = winners[list(columns)].rename(columns=columns)
+    return data.to_dict('index')